@@ -0,0 +1,192 @@
+"""
+Дайджест заявок для канала админов.
+
+При обычной нагрузке каждая заявка публикуется отдельным сообщением.
+Когда заявок становится больше порога в минуту, бот переходит в режим
+дайджеста: заявки копятся в буфере и публикуются одним сообщением,
+сгруппированным по городам, раз в interval секунд или по набору
+max_leads заявок. Длинный дайджест делится на несколько сообщений
+по лимиту Telegram в 4096 символов только между заявками, чтобы не
+разрезать HTML-разметку. Когда поток стихает, бот возвращается
+к отдельным сообщениям.
+"""
+
+import asyncio
+import html
+import logging
+import time
+from collections import deque
+from datetime import datetime
+
+# Лимит длины сообщения Telegram
+MESSAGE_LIMIT = 4096
+
+# Длина имени, телефона и других полей заявки в дайджесте: длина имени ничем
+# не ограничена, а строка заявки должна целиком помещаться в одно сообщение
+FIELD_LIMIT = 100
+
+# Режимы работы
+MODE_AUTO = "auto"
+MODE_ON = "on"
+MODE_OFF = "off"
+
+
+def clip(text, limit: int = FIELD_LIMIT) -> str:
+    """Текст не длиннее limit символов (обрезанный - с многоточием)"""
+    text = str(text)
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def split_message(blocks: list, limit: int = MESSAGE_LIMIT) -> list:
+    """Склейка блоков [(текст, заявки)] в сообщения [(текст, заявки)] не длиннее limit символов
+
+    Блоки не разрезаются: каждая заявка целиком попадает в одно сообщение.
+    """
+    messages = []
+    current, current_leads = "", []
+    for text, leads in blocks:
+        candidate = f"{current}\n{text}" if current else text
+        if current and len(candidate) > limit:
+            messages.append((current, current_leads))
+            current, current_leads = text, list(leads)
+        else:
+            current, current_leads = candidate, current_leads + list(leads)
+    if current:
+        messages.append((current, current_leads))
+    return messages
+
+
+class AdminDigest:
+    """Буфер заявок с автоматическим переключением в режим дайджеста"""
+
+    def __init__(self, send, interval: float = 60, max_leads: int = 30,
+                 rate_threshold: int = 10, quiet_threshold: int = 3, window: float = 60,
+                 mode: str = MODE_AUTO):
+        self._send = send  # корутина send(text) для публикации в канал
+        self.interval = interval
+        self.max_leads = max_leads
+        self.rate_threshold = rate_threshold
+        self.quiet_threshold = quiet_threshold
+        self.window = window
+        self.mode = mode
+
+        self.active = mode == MODE_ON
+        self._arrivals = deque()
+        self._buffer = []
+        self._full = None
+        self._task = None
+
+        self.digests_sent = 0
+        self.leads_in_digests = 0
+
+    def _rate(self) -> int:
+        """Заявок за последнее окно"""
+        now = time.monotonic()
+        while self._arrivals and now - self._arrivals[0] > self.window:
+            self._arrivals.popleft()
+        return len(self._arrivals)
+
+    def _update_mode(self):
+        if self.mode == MODE_ON:
+            self.active = True
+        elif self.mode == MODE_OFF:
+            self.active = False
+        else:
+            rate = self._rate()
+            if not self.active and rate >= self.rate_threshold:
+                self.active = True
+                logging.info(f"Канал админов переведен в режим дайджеста ({rate} заявок за {self.window:.0f} с)")
+            elif self.active and rate <= self.quiet_threshold and not self._buffer:
+                self.active = False
+                logging.info("Канал админов возвращен к отдельным сообщениям")
+
+    def set_mode(self, mode: str):
+        """Ручное переключение режима: on, off или auto"""
+        self.mode = mode
+        self._update_mode()
+
+    def offer(self, lead: dict) -> bool:
+        """Учет заявки; True - заявка попала в дайджест, отдельно отправлять не нужно"""
+        self._arrivals.append(time.monotonic())
+        self._update_mode()
+        if not self.active:
+            return False
+
+        self._buffer.append(lead)
+        self.start()
+        if len(self._buffer) >= self.max_leads:
+            self._full.set()
+        return True
+
+    def start(self):
+        """Запуск фоновой публикации дайджестов"""
+        if self._full is None:
+            self._full = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+            self._update_mode()
+
+    async def flush(self):
+        """Публикация накопленных заявок"""
+        if not self._buffer:
+            return
+        leads, self._buffer = self._buffer, []
+        parts = self.format(leads)
+
+        for number, (text, part_leads) in enumerate(parts):
+            try:
+                await self._send(text)
+            except Exception as e:
+                # В буфер возвращаются только неотправленные заявки - они уйдут со следующим дайджестом
+                unsent = [lead for _, rest in parts[number:] for lead in rest]
+                logging.error(f"Ошибка отправки дайджеста в канал админов: {e}, не отправлено заявок: {len(unsent)}")
+                self._buffer = unsent + self._buffer
+                return
+            self.leads_in_digests += len(part_leads)
+
+        self.digests_sent += 1
+        logging.info(f"Дайджест отправлен в канал админов: {len(leads)} заявок")
+
+    def format(self, leads: list) -> list:
+        """Дайджест, сгруппированный по городам: [(текст сообщения, заявки в нем)]"""
+        by_city = {}
+        for lead in leads:
+            by_city.setdefault(lead['city'], []).append(lead)
+
+        blocks = [(
+            f"🗂 <b>ДАЙДЖЕСТ ЗАЯВОК: {len(leads)}</b>\n"
+            f"📅 {datetime.now().strftime('%d.%m.%Y %H:%M')}",
+            []
+        )]
+        for city, city_leads in sorted(by_city.items(), key=lambda item: -len(item[1])):
+            for number, lead in enumerate(city_leads):
+                username = f"@{lead['username']}" if lead.get('username') else "без username"
+                line = (
+                    f"• {lead['time']} {html.escape(clip(lead['name']))}, {html.escape(clip(lead['phone']))}, "
+                    f"{html.escape(clip(username))}, <a href='tg://user?id={lead['user_id']}'>{lead['user_id']}</a>"
+                )
+                # Заголовок города - в одном блоке с первой заявкой города
+                if number == 0:
+                    line = f"\n📍 <b>{html.escape(clip(city))}</b> ({len(city_leads)})\n{line}"
+                blocks.append((line, [lead]))
+        return split_message(blocks)
+
+    def stats(self) -> dict:
+        return {
+            'mode': self.mode,
+            'active': self.active,
+            'buffered': len(self._buffer),
+            'rate': self._rate(),
+            'digests_sent': self.digests_sent,
+            'leads_in_digests': self.leads_in_digests
+        }
@@ -0,0 +1,642 @@
+"""
+Нагрузочный тест воронки регистрации.
+
+Тысячи виртуальных пользователей проходят /start -> выбор города -> имя ->
+контакт через настоящий диспетчер бота (dp из bot.py). Вместо Telegram
+используется фейковая сессия Bot API, вместо Google Таблиц - таблица
+в памяти; у обоих настраиваются задержка и доля ошибок.
+
+Отчет: пропускная способность, p50/p95/p99 задержки каждого обработчика,
+задержка цикла событий, рост памяти, время дозаписи заявок в таблицу.
+Результат сохраняется в JSON для сравнения прогонов:
+
+    python benchmark.py --users 2000 --concurrency 200
+    python benchmark.py --sheets-latency 0.3 --sheets-error-rate 0.05
+    python benchmark.py --compare benchmark-results/benchmark-20250101-120000.json
+
+Все файлы бота (журнал, состояния FSM, кэши) создаются во временной папке.
+"""
+
+import argparse
+import asyncio
+import gc
+import importlib
+import json
+import logging
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from urllib.parse import unquote
+
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramNetworkError
+from aiogram.types import Message, MessageId, User
+
+from city_keyboards import CITY_PREFIX
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Шаги воронки в порядке прохождения
+STEPS = ("start", "city", "name", "contact")
+
+
+# =====================================================
+# ФЕЙКОВЫЙ TELEGRAM
+# =====================================================
+
+class FakeTelegramSession(BaseSession):
+    """Сессия Bot API без сети: отвечает на запросы сама, с задержкой и ошибками"""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = {}
+        self.errors = 0
+        self.last_markup = {}      # {chat_id: клавиатура последнего сообщения}
+        self.last_message_id = {}  # {chat_id: ID последнего сообщения бота}
+        self._message_ids = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        api_method = method.__api_method__
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(random.uniform(self.latency * 0.5, self.latency * 1.5))
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            raise TelegramNetworkError(method=method, message="Ошибка, внесенная тестом")
+
+        if api_method in ("sendMessage", "sendPhoto", "editMessageText"):
+            return self._message(bot, method)
+        if api_method == "getMe":
+            return User(id=bot.id, is_bot=True, first_name="bot")
+        if api_method == "copyMessage":
+            self._message_ids += 1
+            return MessageId(message_id=self._message_ids)
+        return True
+
+    def _message(self, bot, method) -> Message:
+        chat_id = int(method.chat_id)
+        message_id = getattr(method, "message_id", None)
+        if message_id is None:
+            self._message_ids += 1
+            message_id = self._message_ids
+        self.last_message_id[chat_id] = message_id
+        self.last_markup[chat_id] = getattr(method, "reply_markup", None)
+
+        data = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "channel"},
+            "from": {"id": bot.id, "is_bot": True, "first_name": "bot"}
+        }
+        if method.__api_method__ == "sendPhoto":
+            data["photo"] = [{"file_id": f"bench-photo-{message_id}", "file_unique_id": "bench", "width": 1, "height": 1}]
+            data["caption"] = method.caption
+        else:
+            data["text"] = method.text
+        return Message.model_validate(data, context={"bot": bot})
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+
+# =====================================================
+# ФЕЙКОВЫЕ GOOGLE ТАБЛИЦЫ
+# =====================================================
+
+_RANGE_RE = re.compile(r"^(?:'((?:[^']|'')*)'!)?([A-Z]+)(\d+)?(?::([A-Z]+)(\d+)?)?$")
+
+
+def _column_index(letters: str) -> int:
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord("A") + 1
+    return index - 1
+
+
+def make_fake_sheets(base_class, error_class):
+    """Класс таблицы в памяти с интерфейсом AsyncSheets (запросы не уходят в сеть)"""
+
+    class FakeSheets(base_class):
+        def __init__(self, client, cities: int = 30, latency: float = 0.0,
+                     error_rate: float = 0.0, throttle_rate: float = 0.0, max_concurrency: int = 4):
+            super().__init__(client, max_concurrency=max_concurrency)
+            self.latency = latency
+            self.error_rate = error_rate
+            self.throttle_rate = throttle_rate
+            self.injected_errors = 0
+            self.rows_appended = 0
+            self.sheets = {
+                "Лист1": [],
+                "Города": [["Город", "Адрес"]] + [
+                    [f"Город {n}", f"ул. Тестовая, {n}"] for n in range(1, cities + 1)
+                ]
+            }
+
+        def _parse(self, range_: str):
+            match = _RANGE_RE.match(unquote(range_))
+            title = (match.group(1) or "Лист1").replace("''", "'")
+            first_column = _column_index(match.group(2))
+            first_row = int(match.group(3) or 1)
+            last_column = _column_index(match.group(4)) if match.group(4) else first_column
+            last_row = int(match.group(5)) if match.group(5) else None
+            return self.sheets.setdefault(title, []), title, first_row, last_row, first_column, last_column
+
+        async def _get_token(self) -> str:
+            return "benchmark"
+
+        async def _send(self, method, path, params, json_data, timeout):
+            if self.latency:
+                await asyncio.sleep(random.uniform(self.latency * 0.5, self.latency * 1.5))
+            roll = random.random()
+            if roll < self.throttle_rate:
+                self.injected_errors += 1
+                raise error_class(429, "Quota exceeded (внесено тестом)", 1.0)
+            if roll < self.throttle_rate + self.error_rate:
+                self.injected_errors += 1
+                raise error_class(500, "Internal error (внесено тестом)")
+            return self._handle(method, path, json_data)
+
+        def _handle(self, method, path, json_data):
+            if path == "":
+                return {"sheets": [
+                    {"properties": {"sheetId": index, "title": title, "index": index}}
+                    for index, title in enumerate(self.sheets)
+                ]}
+            if path == ":batchUpdate":
+                for request in json_data["requests"]:
+                    if "insertDimension" in request:
+                        rows = list(self.sheets.values())[request["insertDimension"]["range"]["sheetId"]]
+                        rows.insert(request["insertDimension"]["range"]["startIndex"], [])
+                return {}
+
+            range_ = path[len("/values/"):]
+            if range_.endswith(":append"):
+                rows, title, *_ = self._parse(range_[:-len(":append")])
+                while rows and not any(rows[-1]):
+                    rows.pop()
+                first = len(rows) + 1
+                rows.extend([str(value) for value in row] for row in json_data["values"])
+                self.rows_appended += len(json_data["values"])
+                return {"updates": {"updatedRange": f"'{title}'!A{first}:F{len(rows)}"}}
+
+            rows, title, first_row, last_row, first_column, last_column = self._parse(range_)
+            if method == "PUT":
+                for offset, values in enumerate(json_data["values"]):
+                    index = first_row - 1 + offset
+                    while len(rows) <= index:
+                        rows.append([])
+                    rows[index] = [str(value) for value in values]
+                return {}
+
+            selected = rows[first_row - 1:last_row]
+            values = [row[first_column:last_column + 1] for row in selected]
+            while values and not any(values[-1]):
+                values.pop()
+            return {"values": values}
+
+    return FakeSheets
+
+
+# =====================================================
+# ИЗМЕРЕНИЯ
+# =====================================================
+
+def percentile(values: list, q: float) -> float:
+    """Перцентиль по отсортированному списку (метод ближайшего ранга)"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(q / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def summarize(samples: list) -> dict:
+    """Сводка задержек в миллисекундах"""
+    values = sorted(samples)
+    return {
+        'count': len(values),
+        'mean_ms': round(sum(values) / len(values) * 1000, 3) if values else 0,
+        'p50_ms': round(percentile(values, 50) * 1000, 3),
+        'p95_ms': round(percentile(values, 95) * 1000, 3),
+        'p99_ms': round(percentile(values, 99) * 1000, 3),
+        'max_ms': round(values[-1] * 1000, 3) if values else 0
+    }
+
+
+def rss_bytes() -> int:
+    """Текущий объем памяти процесса"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # Не Linux: пиковое значение вместо текущего
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage if sys.platform == "darwin" else usage * 1024
+
+
+class LoopLagMonitor:
+    """Задержка цикла событий: насколько позже запланированного просыпается задача"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - expected))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        self._task.cancel()
+
+
+# =====================================================
+# ВИРТУАЛЬНЫЕ ПОЛЬЗОВАТЕЛИ
+# =====================================================
+
+class Funnel:
+    """Прохождение воронки регистрации виртуальными пользователями"""
+
+    def __init__(self, bot_module, session: FakeTelegramSession, think_time: float = 0.0):
+        self.bot_module = bot_module
+        self.bot = bot_module.bot
+        self.dp = bot_module.dp
+        self.session = session
+        self.think_time = think_time
+        self.latencies = {step: [] for step in STEPS}
+        self.errors = {step: 0 for step in STEPS}
+        self.completed = 0
+        self._update_id = 0
+
+    async def _step(self, step: str, payload: dict):
+        self._update_id += 1
+        started = time.perf_counter()
+        try:
+            await self.dp.feed_raw_update(self.bot, {"update_id": self._update_id, **payload})
+        except Exception as e:
+            self.errors[step] += 1
+            logging.debug(f"Ошибка на шаге {step}: {e}")
+            return False
+        finally:
+            self.latencies[step].append(time.perf_counter() - started)
+        if self.think_time:
+            await asyncio.sleep(random.uniform(0, self.think_time * 2))
+        return True
+
+    async def run_user(self, number: int):
+        user_id = 6_000_000_000 + number
+        user = {"id": user_id, "is_bot": False, "first_name": f"Тест{number}", "username": f"bench{number}"}
+        chat = {"id": user_id, "type": "private", "first_name": user["first_name"]}
+        now = int(time.time())
+
+        def message(**fields):
+            return {"message": {"message_id": number, "date": now, "chat": chat, "from": user, **fields}}
+
+        await self._step("start", message(
+            text="/start", entities=[{"type": "bot_command", "offset": 0, "length": 6}]
+        ))
+
+        # Нажимаем на случайную кнопку города из клавиатуры, которую прислал бот
+        markup = self.session.last_markup.get(user_id)
+        buttons = [button for row in getattr(markup, "inline_keyboard", None) or [] for button in row
+                   if button.callback_data and button.callback_data.startswith(f"{CITY_PREFIX}:")]
+        if not buttons:
+            self.errors["city"] += 1
+            return
+        await self._step("city", {"callback_query": {
+            "id": str(number),
+            "from": user,
+            "chat_instance": str(user_id),
+            "data": random.choice(buttons).callback_data,
+            "message": {
+                "message_id": self.session.last_message_id[user_id],
+                "date": now,
+                "chat": chat,
+                "from": {"id": self.bot.id, "is_bot": True, "first_name": "bot"},
+                "text": "city"
+            }
+        }})
+
+        await self._step("name", message(text=f"Тест {number}"))
+
+        if await self._step("contact", message(contact={
+            "phone_number": f"+79{number:09d}",
+            "first_name": user["first_name"],
+            "user_id": user_id
+        })):
+            self.completed += 1
+
+
+# =====================================================
+# ПРОГОН
+# =====================================================
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+            capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def load_bot(workdir: str):
+    """Импорт bot.py с рабочей папкой workdir: все файлы бота создаются там"""
+    sys.path.insert(0, REPO_DIR)
+    os.chdir(workdir)
+    config = importlib.import_module("config") if os.path.exists(os.path.join(REPO_DIR, "config.py")) else None
+    # Изображения нужны для отправки поздравлений
+    for image in [getattr(config, "CONGRATULATIONS_IMAGE_PATH", "image.png"),
+                  *getattr(config, "CITY_IMAGES", {}).values()]:
+        source = os.path.join(REPO_DIR, image)
+        if os.path.exists(source) and not os.path.isabs(image):
+            os.makedirs(os.path.dirname(os.path.join(workdir, image)) or workdir, exist_ok=True)
+            shutil.copy(source, os.path.join(workdir, image))
+    return importlib.import_module("bot")
+
+
+def measure_registration_index(entries: int) -> dict:
+    """Размер индекса повторных регистраций и стоимость поиска на entries заявках"""
+    from registrations import RegistrationIndex
+
+    rows = [(number + 1, f"+79{number:09d}", 5_000_000_000 + number) for number in range(entries)]
+    index = RegistrationIndex()
+    started = time.perf_counter()
+    index.load(rows)
+    load_seconds = time.perf_counter() - started
+
+    sample = random.sample(rows, min(entries, 100000))
+    started = time.perf_counter()
+    for _, phone, user_id in sample:
+        index.find(phone, user_id)
+    hit_seconds = (time.perf_counter() - started) / len(sample)
+    started = time.perf_counter()
+    for number in range(len(sample)):
+        index.find(f"+78{number:09d}", 1)
+    miss_seconds = (time.perf_counter() - started) / len(sample)
+    return {
+        'entries': entries,
+        'memory_mb': round(index.nbytes / 1024 / 1024, 1),
+        'load_seconds': round(load_seconds, 3),
+        'lookup_hit_us': round(hit_seconds * 1e6, 2),
+        'lookup_miss_us': round(miss_seconds * 1e6, 2)
+    }
+
+
+async def run_benchmark(args) -> dict:
+    rss_start = rss_bytes()
+    import_started = time.perf_counter()
+    bot_module = load_bot(args.workdir)
+    import_seconds = time.perf_counter() - import_started
+    logging.getLogger().setLevel(logging.WARNING)
+
+    from ratelimit import TokenBucket
+    from sheets import AsyncSheets, SheetsAPIError
+    from telegram_sender import RateLimitMiddleware
+
+    # Подменяем Telegram и Google Таблицы
+    session = FakeTelegramSession(latency=args.telegram_latency, error_rate=args.telegram_error_rate)
+    if args.telegram_limits:
+        session.middleware(RateLimitMiddleware(bot_module.outbound_limiter, admin_chats=[bot_module.ADMIN_CHANNEL_ID]))
+    # Замеры Bot API, как на настоящей сессии бота
+    session.middleware(bot_module.metrics.BotAPIMetricsMiddleware())
+    bot_module.bot.session = session
+    fake_sheets = make_fake_sheets(AsyncSheets, SheetsAPIError)(
+        bot_module.sheets_client, cities=args.cities, latency=args.sheets_latency,
+        error_rate=args.sheets_error_rate, throttle_rate=args.sheets_throttle_rate
+    )
+    # Замеры и предохранитель - как у настоящего клиента
+    fake_sheets.on_request = bot_module.sheets_api.on_request
+    fake_sheets.breaker = bot_module.sheets_api.breaker
+    bot_module.sheets_api = fake_sheets
+    if args.sheets_quota:
+        bot_module.sheets_writer.bucket = TokenBucket(rate=args.sheets_quota / 60, capacity=5)
+
+    # Прогрев и запуск фоновых служб, как в main()
+    warm_up_started = time.perf_counter()
+    await bot_module.warm_up()
+    warm_up_seconds = time.perf_counter() - warm_up_started
+    bot_module.startup_report.ready()
+
+    funnel = Funnel(bot_module, session, think_time=args.think_time)
+    monitor = LoopLagMonitor()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def run_user(number: int):
+        async with semaphore:
+            await funnel.run_user(number)
+
+    gc.collect()
+    rss_before = rss_bytes()
+    monitor.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(run_user(number) for number in range(args.users)))
+    funnel_seconds = time.perf_counter() - started
+
+    # Повторные регистрации части пользователей: новых заявок быть не должно
+    repeats = Funnel(bot_module, session, think_time=args.think_time)
+    repeat_numbers = random.sample(range(args.users), int(args.users * args.repeat_rate))
+    await asyncio.gather(*(repeats.run_user(number) for number in repeat_numbers))
+
+    # Дожидаемся фоновых этапов и записи всех заявок в таблицу
+    if bot_module.background_tasks:
+        await asyncio.wait(bot_module.background_tasks, timeout=args.drain_timeout)
+    drain_started = time.perf_counter()
+    while bot_module.sheets_writer.depth and time.perf_counter() - drain_started < args.drain_timeout:
+        await asyncio.sleep(0.05)
+    drain_seconds = time.perf_counter() - drain_started
+    monitor.stop()
+    rss_after = rss_bytes()
+    index_stats = bot_module.registration_index.stats()
+
+    await bot_module.admin_digest.flush()
+    await bot_module.sheets_writer.stop()
+    await bot_module.submission_store.close()
+    await bot_module.dp.fsm.storage.close()
+
+    total_updates = sum(len(samples) for samples in funnel.latencies.values())
+    startup = bot_module.startup_report
+    lag = sorted(monitor.samples)
+    return {
+        'started_at': datetime.now().isoformat(timespec="seconds"),
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'config': {key: value for key, value in vars(args).items() if key not in ("workdir", "output", "compare")},
+        'results': {
+            'users': args.users,
+            'completed': funnel.completed,
+            'funnel_seconds': round(funnel_seconds, 3),
+            'users_per_second': round(funnel.completed / funnel_seconds, 1),
+            'updates_per_second': round(total_updates / funnel_seconds, 1),
+            'handlers': {step: summarize(funnel.latencies[step]) for step in STEPS},
+            'errors': funnel.errors,
+            'loop_lag': {
+                'p50_ms': round(percentile(lag, 50) * 1000, 3),
+                'p99_ms': round(percentile(lag, 99) * 1000, 3),
+                'max_ms': round(lag[-1] * 1000, 3) if lag else 0
+            },
+            'memory': {
+                'rss_start_mb': round(rss_start / 1024 / 1024, 1),
+                'rss_before_mb': round(rss_before / 1024 / 1024, 1),
+                'rss_after_mb': round(rss_after / 1024 / 1024, 1),
+                'growth_mb': round((rss_after - rss_before) / 1024 / 1024, 1),
+                'growth_per_user_kb': round((rss_after - rss_before) / 1024 / max(args.users, 1), 2)
+            },
+            'sheets': {
+                'rows_written': fake_sheets.rows_appended,
+                'requests': fake_sheets.requests_total,
+                'injected_errors': fake_sheets.injected_errors,
+                'writer_queue_left': bot_module.sheets_writer.depth,
+                'drain_seconds': round(drain_seconds, 3)
+            },
+            'telegram': {
+                'calls': session.calls,
+                'injected_errors': session.errors
+            },
+            'repeats': {
+                'users': len(repeat_numbers),
+                'completed': repeats.completed,
+                'detected': index_stats['duplicates']
+            },
+            'registration_index': measure_registration_index(args.index_entries) if args.index_entries else None,
+            'startup': {
+                'import_seconds': round(import_seconds, 3),
+                'warm_up_seconds': round(warm_up_seconds, 3),
+                'phases': startup.stats()['phases'],
+                'first_update_after_ready_seconds': (
+                    round(startup.first_update_at - startup.ready_at, 3) if startup.first_update_at else None
+                )
+            }
+        }
+    }
+
+
+def print_report(report: dict):
+    results = report['results']
+    print(f"\nПользователей: {results['users']}, прошли воронку: {results['completed']} "
+          f"за {results['funnel_seconds']} с")
+    print(f"Пропускная способность: {results['users_per_second']} польз./с, "
+          f"{results['updates_per_second']} обновлений/с\n")
+    print(f"{'шаг':<10}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}{'ошибок':>8}")
+    for step, summary in results['handlers'].items():
+        print(f"{step:<10}{summary['p50_ms']:>10}{summary['p95_ms']:>10}{summary['p99_ms']:>10}"
+              f"{summary['max_ms']:>10}{results['errors'][step]:>8}")
+    lag = results['loop_lag']
+    memory = results['memory']
+    sheets = results['sheets']
+    print(f"\nЗадержка цикла событий: p50 {lag['p50_ms']} мс, p99 {lag['p99_ms']} мс, max {lag['max_ms']} мс")
+    print(f"Память: {memory['rss_before_mb']} -> {memory['rss_after_mb']} МБ "
+          f"(+{memory['growth_mb']} МБ, {memory['growth_per_user_kb']} КБ на пользователя)")
+    print(f"Таблица: записано строк {sheets['rows_written']}, запросов {sheets['requests']}, "
+          f"внесено ошибок {sheets['injected_errors']}, осталось в очереди {sheets['writer_queue_left']}, "
+          f"дозапись {sheets['drain_seconds']} с")
+    repeats = results['repeats']
+    if repeats['users']:
+        print(f"Повторные регистрации: {repeats['users']}, распознано {repeats['detected']}")
+    index = results['registration_index']
+    if index:
+        print(f"Индекс регистраций на {index['entries']} заявках: {index['memory_mb']} МБ, "
+              f"загрузка {index['load_seconds']} с, поиск {index['lookup_hit_us']} мкс "
+              f"(не найдено - {index['lookup_miss_us']} мкс)")
+    startup = results['startup']
+    warm_up_phases = sorted(
+        ((phase, seconds) for phase, seconds in startup['phases'].items()
+         if phase not in ("imports", "init", "local_state", "warm_up")),
+        key=lambda item: -item[1]
+    )
+    print(f"Запуск: импорт бота {startup['import_seconds']} с, прогрев {startup['warm_up_seconds']} с"
+          + (f" (дольше всего {warm_up_phases[0][0]} {warm_up_phases[0][1]} с)" if warm_up_phases else "")
+          + f", первое обновление через {startup['first_update_after_ready_seconds']} с после готовности")
+
+
+def print_comparison(report: dict, previous: dict):
+    """Сравнение с прошлым прогоном: положительный процент - стало хуже"""
+    old, new = previous['results'], report['results']
+
+    def delta(old_value, new_value, higher_is_better=False):
+        if not old_value:
+            return "—"
+        change = (new_value - old_value) / old_value * 100
+        if higher_is_better:
+            change = -change
+        return f"{change:+.1f}%"
+
+    print(f"\nСравнение с прогоном {previous.get('started_at')} ({previous.get('revision')}):")
+    print(f"  пользователей/с: {old['users_per_second']} -> {new['users_per_second']} "
+          f"({delta(old['users_per_second'], new['users_per_second'], True)})")
+    for step in STEPS:
+        old_p95 = old['handlers'][step]['p95_ms']
+        new_p95 = new['handlers'][step]['p95_ms']
+        print(f"  {step} p95: {old_p95} -> {new_p95} мс ({delta(old_p95, new_p95)})")
+    print(f"  задержка цикла p99: {old['loop_lag']['p99_ms']} -> {new['loop_lag']['p99_ms']} мс "
+          f"({delta(old['loop_lag']['p99_ms'], new['loop_lag']['p99_ms'])})")
+    if 'startup' in old:
+        for key, title in (('import_seconds', "импорт бота"), ('warm_up_seconds', "прогрев")):
+            print(f"  {title}: {old['startup'][key]} -> {new['startup'][key]} с "
+                  f"({delta(old['startup'][key], new['startup'][key])})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест воронки регистрации")
+    parser.add_argument("--users", type=int, default=2000, help="Число виртуальных пользователей")
+    parser.add_argument("--concurrency", type=int, default=200, help="Пользователей одновременно")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Средняя пауза между шагами (сек)")
+    parser.add_argument("--cities", type=int, default=30)
+    parser.add_argument("--telegram-latency", type=float, default=0.02, help="Задержка ответа Bot API (сек)")
+    parser.add_argument("--telegram-error-rate", type=float, default=0.0, help="Доля ошибок Bot API")
+    parser.add_argument("--telegram-limits", action="store_true", help="Включить ограничения частоты Telegram")
+    parser.add_argument("--repeat-rate", type=float, default=0.1, help="Доля пользователей, регистрирующихся повторно")
+    parser.add_argument("--index-entries", type=int, default=1_000_000,
+                        help="Размер индекса регистраций для замера памяти и поиска (0 - не замерять)")
+    parser.add_argument("--sheets-latency", type=float, default=0.15, help="Задержка ответа Google Таблиц (сек)")
+    parser.add_argument("--sheets-error-rate", type=float, default=0.0, help="Доля ошибок 500")
+    parser.add_argument("--sheets-throttle-rate", type=float, default=0.0, help="Доля ответов 429")
+    parser.add_argument("--sheets-quota", type=float, default=None, help="Квота записи в минуту (по умолчанию из настроек)")
+    parser.add_argument("--drain-timeout", type=float, default=120, help="Сколько ждать дозаписи в таблицу (сек)")
+    parser.add_argument("--output", default=None, help="Файл JSON с результатами")
+    parser.add_argument("--compare", default=None, help="Файл JSON прошлого прогона для сравнения")
+    args = parser.parse_args()
+
+    output = args.output or os.path.join(
+        REPO_DIR, "benchmark-results", f"benchmark-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    previous = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+
+    with tempfile.TemporaryDirectory(prefix="bot-benchmark-") as workdir:
+        args.workdir = workdir
+        report = asyncio.run(run_benchmark(args))
+        os.chdir(REPO_DIR)
+
+    print_report(report)
+    if previous:
+        print_comparison(report, previous)
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\nРезультаты сохранены в {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,41 @@
 import asyncio
+import html
+import json
 import logging
+import os
+import signal
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+from aiohttp import web
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.exceptions import TelegramBadRequest
+from admin_digest import MODE_AUTO, MODE_OFF, MODE_ON, AdminDigest
+from broadcast import Broadcast, BroadcastError
+from circuit_breaker import STATE_CLOSED, STATE_HALF_OPEN, STATE_OPEN, CircuitBreaker
+from city_keyboards import CITY_PREFIX, PAGE_PREFIX, CityKeyboards
+from export import Exporter, parse_export_args
+from fsm_storage import create_storage
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove, BufferedInputFile, InlineKeyboardButton, InlineKeyboardMarkup
-import gspread
-from google.oauth2.service_account import Credentials
+from aiogram.types import KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove, BufferedInputFile, FSInputFile, InlineKeyboardButton, InlineKeyboardMarkup
+from journal import SubmissionJournal
+import metrics
+from profiler import Profiler, ProfilerBusy, dump_tasks
+from photo_cache import PhotoCache
+from shared_state import SharedState
+from startup import FirstUpdateMiddleware, StartupReport
+from ratelimit import TokenBucket
+from registrations import RegistrationIndex
+from seen_users import SeenUsers
+from sheets import AsyncSheets, SheetsClient, SheetsWriter, quote_sheet_range, updated_last_row
+from submissions import create_submission_store, row_to_record
+from supervisor import Supervisor, UpdateRouter
+from telegram_sender import PRIORITY_ADMIN, PRIORITY_BULK, PRIORITY_USER, OutboundLimiter, RateLimitMiddleware
+from webhook import WebhookServer
 
 # =====================================================
 # НАСТРОЙКИ БОТА
@@ -23,6 +51,81 @@ except ImportError:
     GOOGLE_SHEET_ID = "YOUR_GOOGLE_SHEET_ID"
     DEFAULT_ADMINS = [7533811917]  # Админ по умолчанию
     CONGRATULATIONS_IMAGE_PATH = "congratulations_image.png"
+    CITIES_REFRESH_INTERVAL = 300  # Интервал обновления списка городов (сек)
+    CITIES_SNAPSHOT_PATH = "cities_snapshot.json"  # Последний загруженный список городов
+    CITY_KEYBOARD_PAGE_SIZE = 20  # Городов на одной странице клавиатуры выбора города
+    SHEETS_API_URL = "https://sheets.googleapis.com/v4/spreadsheets"
+    SHEETS_MAX_CONCURRENCY = 4  # Одновременных запросов к Google Таблицам
+    SHEETS_TIMEOUT = 15  # Таймаут одного запроса к Google Таблицам (сек)
+    SHEETS_BREAKER_FAILURES = 5  # Сбоев подряд, после которых таблица считается недоступной
+    SHEETS_BREAKER_RESET_TIMEOUT = 5  # Первая пауза перед пробным запросом (сек)
+    SHEETS_BREAKER_MAX_TIMEOUT = 300  # Максимальная пауза перед пробным запросом (сек)
+    SHEETS_WRITE_QUOTA_PER_MINUTE = 50  # Запросов на запись в минуту
+    SHEETS_BATCH_SIZE = 50  # Максимум строк в одной пачке
+    SHEETS_BATCH_MAX_DELAY = 2.0  # Максимальная задержка записи строки (сек)
+    JOURNAL_PATH = "submissions.journal"  # Журнал заявок прежних версий (переносится в базу заявок)
+    SUBMISSION_STORE = "sqlite"  # Основное хранилище заявок
+    SUBMISSIONS_DB_PATH = "submissions.sqlite3"  # База заявок (общая для всех процессов)
+    SUBMISSIONS_COMMIT_DELAY = 0.02  # Окно группировки заявок в одну транзакцию (сек)
+    REGISTRATION_DEDUP = True  # Повторная регистрация не создает новую заявку
+    EXPORT_MAX_ROWS_PER_FILE = 100000  # Строк в одном файле выгрузки /export
+    EXPORT_MAX_FILE_MB = 45  # Размер одного файла выгрузки (МБ)
+    SHEET_LAYOUT_CHECK_INTERVAL = 600  # Интервал проверки структуры листа (сек)
+    STATS_CHECK_INTERVAL = 900  # Интервал проверки правок таблицы вне бота (сек)
+    CITY_IMAGES = {}  # Отдельные изображения для городов: {город: путь}
+    PHOTO_CACHE_PATH = "photo_cache.json"  # Кэш file_id загруженных изображений
+    TELEGRAM_GLOBAL_RATE = 30  # Сообщений в секунду для всего бота
+    TELEGRAM_PRIVATE_CHAT_RATE = 1  # Сообщений в секунду в один личный чат
+    TELEGRAM_GROUP_CHAT_RATE_PER_MINUTE = 20  # Сообщений в минуту в одну группу/канал
+    ADMIN_DIGEST_MODE = "auto"  # Дайджест заявок в канале админов: auto, on или off
+    ADMIN_DIGEST_RATE_THRESHOLD = 10  # Заявок в минуту для перехода в режим дайджеста
+    ADMIN_DIGEST_QUIET_THRESHOLD = 3  # Заявок в минуту для возврата к отдельным сообщениям
+    ADMIN_DIGEST_INTERVAL = 60  # Как часто публиковать дайджест (сек)
+    ADMIN_DIGEST_MAX_LEADS = 30  # Публиковать дайджест сразу при наборе стольких заявок
+    FSM_STORAGE = "sqlite"  # Хранилище незавершенных анкет: memory, sqlite или redis
+    FSM_SQLITE_PATH = "fsm.sqlite3"
+    FSM_REDIS_URL = "redis://localhost:6379/0"
+    FSM_DRAFT_TTL = 86400  # Через сколько секунд удалять брошенные анкеты
+    RUN_MODE = "polling"  # Способ получения обновлений: polling или webhook
+    WEBHOOK_URL = ""  # Публичный адрес сервера, например https://bot.example.com
+    WEBHOOK_PATH = "/telegram/webhook"
+    WEBHOOK_SECRET = ""  # Секретный токен для проверки запросов от Telegram
+    WEBHOOK_HOST = "0.0.0.0"
+    WEBHOOK_PORT = 8080
+    WEBHOOK_WORKERS = 32  # Одновременно обрабатываемых обновлений
+    WORKERS = 1  # Число процессов-обработчиков (больше 1 - запуск через супервизор)
+    WORKER_BASE_PORT = 8100  # Порты процессов: WORKER_BASE_PORT, WORKER_BASE_PORT + 1, ...
+    SHARED_REDIS_URL = "redis://localhost:6379/0"  # Общие данные процессов
+    SEEN_USERS_PATH = "seen_users.bin"  # Пользователи, получившие приветствие
+    SEEN_USERS_MAX_MB = 64  # Лимит памяти для списка этих пользователей (МБ)
+    SEEN_USERS_SNAPSHOT_INTERVAL = 60  # Как часто сохранять список на диск (сек)
+    BROADCAST_STATE_PATH = "broadcast.json"  # Прогресс рассылки
+    BLOCKED_USERS_PATH = "blocked_users.bin"  # Пользователи, заблокировавшие бота
+    BROADCAST_RATE = 20  # Сообщений рассылки в секунду (остальное - ответам пользователям)
+    BROADCAST_CONCURRENCY = 8  # Одновременных отправок рассылки
+    METRICS_HOST = "127.0.0.1"  # Адрес HTTP-сервера метрик Prometheus
+    METRICS_PORT = 9464  # Порт метрик (0 - не запускать); процессы-обработчики - следующие порты
+
+# Номер процесса-обработчика, если бот запущен супервизором в нескольких процессах
+WORKER_ID = int(os.environ['BOT_WORKER_ID']) if 'BOT_WORKER_ID' in os.environ else None
+
+if WORKER_ID is not None:
+    # У каждого процесса свои анкеты: пользователь всегда попадает в один процесс.
+    # База заявок общая, журнал прежних версий переносит в нее первый процесс.
+    # Кэш file_id изображений тоже общий: процессы дописывают его под блокировкой файла
+    JOURNAL_PATH = f"{JOURNAL_PATH}.w{WORKER_ID}"
+    FSM_SQLITE_PATH = f"{FSM_SQLITE_PATH}.w{WORKER_ID}"
+    SEEN_USERS_PATH = f"{SEEN_USERS_PATH}.w{WORKER_ID}"
+    BROADCAST_STATE_PATH = f"{BROADCAST_STATE_PATH}.w{WORKER_ID}"
+    BLOCKED_USERS_PATH = f"{BLOCKED_USERS_PATH}.w{WORKER_ID}"
+    CITIES_SNAPSHOT_PATH = f"{CITIES_SNAPSHOT_PATH}.w{WORKER_ID}"
+    if METRICS_PORT:
+        METRICS_PORT += WORKER_ID + 1
+    BROADCAST_RATE /= WORKERS
+    # Лимиты Telegram и Google общие на всего бота - делим их между процессами
+    TELEGRAM_GLOBAL_RATE /= WORKERS
+    TELEGRAM_GROUP_CHAT_RATE_PER_MINUTE /= WORKERS
+    SHEETS_WRITE_QUOTA_PER_MINUTE /= WORKERS
 
 # =====================================================
 # СОСТОЯНИЯ FSM
@@ -38,62 +141,99 @@ class RegistrationForm(StatesGroup):
 # =====================================================
 
 logging.basicConfig(level=logging.INFO)
+
+# Время запуска: от создания процесса до готовности и первого обработанного обновления
+startup_report = StartupReport()
+startup_report.mark("imports")
+
+# Создание Bot не обращается к сети: соединение с Bot API открывается при прогреве в main()
 bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+
+# Все исходящие сообщения проходят через общий ограничитель частоты
+outbound_limiter = OutboundLimiter(
+    global_rate=TELEGRAM_GLOBAL_RATE,
+    private_rate=TELEGRAM_PRIVATE_CHAT_RATE,
+    group_rate=TELEGRAM_GROUP_CHAT_RATE_PER_MINUTE / 60
+)
+bot.session.middleware(RateLimitMiddleware(outbound_limiter, admin_chats=[ADMIN_CHANNEL_ID]))
+# Замер запросов к Bot API - после ограничителя, чтобы не учитывать ожидание в очереди
+bot.session.middleware(metrics.BotAPIMetricsMiddleware())
+# Незавершенные анкеты сохраняются между перезапусками (см. FSM_STORAGE)
+storage = create_storage(FSM_STORAGE, sqlite_path=FSM_SQLITE_PATH, redis_url=FSM_REDIS_URL, ttl=FSM_DRAFT_TTL)
 dp = Dispatcher(storage=storage)
 
+# Метрики обработчиков подключаются к диспетчеру, без правки самих обработчиков
+dp.update.outer_middleware(metrics.UpdateMetricsMiddleware())
+dp.update.outer_middleware(FirstUpdateMiddleware(startup_report))
+dp.message.middleware(metrics.HandlerMetricsMiddleware())
+dp.callback_query.middleware(metrics.HandlerMetricsMiddleware())
+
 # =====================================================
 # УТИЛИТЫ ДЛЯ РАБОТЫ С GOOGLE ТАБЛИЦАМИ
 # =====================================================
 
+# Общий клиент: авторизация, HTTP-сессия и листы переиспользуются всеми функциями
+sheets_client = SheetsClient(GOOGLE_CREDENTIALS_PATH, GOOGLE_SHEET_ID)
+
+def sheets_breaker_changed(breaker: CircuitBreaker, previous: str):
+    """Уведомление админов о недоступности и восстановлении Google Таблиц"""
+    if breaker.state == STATE_OPEN and previous == STATE_CLOSED:
+        text = (
+            "🔌 <b>Google Таблицы недоступны</b>\n"
+            f"Ошибка: {html.escape(breaker.last_error or '')}\n"
+            "Заявки сохраняются в базу и будут дописаны в таблицу после восстановления, "
+            "список городов берется из сохраненной копии."
+        )
+    elif breaker.state == STATE_CLOSED:
+        text = "✅ <b>Google Таблицы снова доступны</b>"
+    else:
+        return
+    spawn_background(notify_admins(text))
+
+# Предохранитель: при недоступности таблицы запросы сразу получают отказ, а не ждут таймаута
+sheets_breaker = CircuitBreaker(
+    "Google Таблицы",
+    failure_threshold=SHEETS_BREAKER_FAILURES,
+    reset_timeout=SHEETS_BREAKER_RESET_TIMEOUT,
+    max_timeout=SHEETS_BREAKER_MAX_TIMEOUT,
+    on_state_change=sheets_breaker_changed
+)
+
+# Асинхронный слой для обработчиков: не блокирует цикл событий
+sheets_api = AsyncSheets(
+    sheets_client,
+    base_url=SHEETS_API_URL,
+    max_concurrency=SHEETS_MAX_CONCURRENCY,
+    timeout=SHEETS_TIMEOUT,
+    on_request=metrics.observe_sheets_request,
+    breaker=sheets_breaker
+)
+
+# Заголовки листа с заявками
+SHEET_HEADERS = ['Город', 'Имя', 'Телефон', 'Username', 'User ID', 'Дата']
+HEADER_RANGE = 'A1:F1'
+
+# Оформление строки заголовков
+HEADER_FORMAT = {
+    "textFormat": {"bold": True},
+    "backgroundColor": {"red": 0.9, "green": 0.9, "blue": 0.9},
+    "horizontalAlignment": "CENTER"
+}
+
 def init_google_sheets():
-    """Инициализация подключения к Google Таблицам"""
+    """Получение листа с заявками через общий клиент Google Таблиц"""
     try:
-        # Определяем область доступа
-        scopes = [
-            "https://www.googleapis.com/auth/spreadsheets",
-            "https://www.googleapis.com/auth/drive"
-        ]
-        
-        # Загружаем учетные данные
-        credentials = Credentials.from_service_account_file(
-            GOOGLE_CREDENTIALS_PATH, scopes=scopes
-        )
-        
-        # Создаем клиент
-        client = gspread.authorize(credentials)
-        
-        # Открываем таблицу
-        sheet = client.open_by_key(GOOGLE_SHEET_ID).sheet1
-        
-        return sheet
+        return sheets_client.sheet1
     except Exception as e:
         logging.error(f"Ошибка инициализации Google Sheets: {e}")
+        sheets_client.reset()
         return None
 
-def get_cities_and_addresses():
+async def get_cities_and_addresses():
     """Получение списка городов и адресов из листа 'Города'"""
     try:
-        # Определяем область доступа
-        scopes = [
-            "https://www.googleapis.com/auth/spreadsheets",
-            "https://www.googleapis.com/auth/drive"
-        ]
-        
-        # Загружаем учетные данные
-        credentials = Credentials.from_service_account_file(
-            GOOGLE_CREDENTIALS_PATH, scopes=scopes
-        )
-        
-        # Создаем клиент
-        client = gspread.authorize(credentials)
-        
-        # Открываем таблицу и лист "Города"
-        spreadsheet = client.open_by_key(GOOGLE_SHEET_ID)
-        cities_sheet = spreadsheet.worksheet("Города")
-        
         # Получаем данные из столбцов A и B начиная со второй строки
-        cities_data = cities_sheet.get('A2:B')
+        cities_data = await sheets_api.get_values(quote_sheet_range("Города", "A2:B"))
         
         # Создаем словарь {город: адрес}
         cities_dict = {}
@@ -112,31 +252,145 @@ def get_cities_and_addresses():
         logging.error(f"Ошибка получения списка городов: {e}")
         return [], {}
 
+class CityCatalog:
+    """Кэш списка городов и адресов в памяти с фоновым обновлением
+
+    Последний загруженный список сохраняется на диск (snapshot_path), поэтому
+    после перезапуска во время недоступности таблицы регистрация продолжает работать.
+    """
+
+    def __init__(self, loader, refresh_interval: int, snapshot_path: str = None, page_size: int = 20):
+        self._loader = loader
+        self.refresh_interval = refresh_interval
+        self.snapshot_path = snapshot_path
+        self.cities = []       # Города в порядке из таблицы
+        self.addresses = {}    # {город: адрес}
+        self.version = 0       # Увеличивается при каждом изменении списка
+        self.loaded_at = None
+        self.keyboards = CityKeyboards(page_size)  # Готовые клавиатуры текущей версии
+        self._lock = asyncio.Lock()
+
+    def __bool__(self):
+        return bool(self.cities)
+
+    def get_address(self, city: str):
+        """Адрес магазина по названию города (без обращения к сети)"""
+        return self.addresses.get(city)
+
+    def load_snapshot(self) -> bool:
+        """Загрузка последнего сохраненного списка с диска"""
+        if not self.snapshot_path:
+            return False
+        try:
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logging.error(f"Ошибка чтения сохраненного списка городов: {e}")
+            return False
+        self.cities = snapshot['cities']
+        self.addresses = snapshot['addresses']
+        self.version = snapshot.get('version', 0)
+        self.loaded_at = datetime.fromisoformat(snapshot['loaded_at'])
+        self.keyboards.build(self.cities, self.version)
+        logging.info(
+            f"Загружен сохраненный список городов: {len(self.cities)} городов, "
+            f"версия {self.version} от {self.loaded_at.strftime('%d.%m.%Y %H:%M')}"
+        )
+        return True
+
+    def _write_snapshot(self, snapshot: dict):
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(tmp_path, self.snapshot_path)
+
+    async def refresh(self) -> bool:
+        """Перезагрузка списка городов из Google Таблицы"""
+        async with self._lock:
+            cities_list, cities_dict = await self._loader()
+
+            # При ошибке загрузки оставляем предыдущий список
+            if not cities_list:
+                logging.warning("Список городов не обновлен, используется предыдущая версия")
+                return False
+
+            changed = cities_list != self.cities or cities_dict != self.addresses
+            if changed:
+                self.cities = cities_list
+                self.addresses = cities_dict
+                self.version += 1
+                self.keyboards.build(cities_list, self.version)
+                logging.info(f"Список городов обновлен: {len(cities_list)} городов, версия {self.version}")
+
+            self.loaded_at = datetime.now()
+            if self.snapshot_path:
+                snapshot = {
+                    'cities': self.cities,
+                    'addresses': self.addresses,
+                    'version': self.version,
+                    'loaded_at': self.loaded_at.isoformat()
+                }
+                try:
+                    await asyncio.to_thread(self._write_snapshot, snapshot)
+                except Exception as e:
+                    logging.error(f"Ошибка сохранения списка городов: {e}")
+            return True
+
+    async def run_refresh_loop(self):
+        """Фоновое обновление списка городов"""
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logging.error(f"Ошибка фонового обновления списка городов: {e}")
+
+# Общие данные процессов-обработчиков (только при запуске в нескольких процессах)
+shared_state = SharedState(SHARED_REDIS_URL, WORKER_ID) if WORKER_ID is not None else None
+
+async def get_shared_cities_and_addresses():
+    """Список городов для процесса-обработчика: из таблицы его загружает один процесс, остальные берут снимок"""
+    try:
+        snapshot = await shared_state.load_catalog()
+        if snapshot and time.time() - snapshot['at'] < CITIES_REFRESH_INTERVAL:
+            return snapshot['cities'], snapshot['addresses']
+        if snapshot and not await shared_state.try_lock("cities", CITIES_REFRESH_INTERVAL / 2):
+            # Таблицу уже читает другой процесс
+            return snapshot['cities'], snapshot['addresses']
+    except Exception as e:
+        logging.error(f"Ошибка чтения общего списка городов: {e}")
+        return await get_cities_and_addresses()
+    
+    cities_list, cities_dict = await get_cities_and_addresses()
+    if cities_list:
+        try:
+            await shared_state.publish_catalog(cities_list, cities_dict)
+        except Exception as e:
+            logging.error(f"Ошибка публикации общего списка городов: {e}")
+    elif snapshot:
+        return snapshot['cities'], snapshot['addresses']
+    return cities_list, cities_dict
+
+city_catalog = CityCatalog(
+    get_shared_cities_and_addresses if shared_state else get_cities_and_addresses,
+    CITIES_REFRESH_INTERVAL,
+    snapshot_path=CITIES_SNAPSHOT_PATH,
+    page_size=CITY_KEYBOARD_PAGE_SIZE
+)
+
 def get_spreadsheet_info():
-    """Получение информации о всей таблице и всех листах"""
+    """Получение информации о всей таблице и всех листах (синхронно, для test_sheets.py)"""
     try:
-        # Определяем область доступа
-        scopes = [
-            "https://www.googleapis.com/auth/spreadsheets",
-            "https://www.googleapis.com/auth/drive"
-        ]
-        
-        # Загружаем учетные данные
-        credentials = Credentials.from_service_account_file(
-            GOOGLE_CREDENTIALS_PATH, scopes=scopes
-        )
-        
-        # Создаем клиент
-        client = gspread.authorize(credentials)
-        
-        # Открываем таблицу
-        spreadsheet = client.open_by_key(GOOGLE_SHEET_ID)
+        spreadsheet = sheets_client.spreadsheet
         
         info = {
             'title': spreadsheet.title,
             'id': spreadsheet.id,
             'url': spreadsheet.url,
-            'sheets': []
+            'sheets': [],
+            'client': sheets_client.stats()
         }
         
         # Получаем информацию о всех листах
@@ -146,7 +400,7 @@ def get_spreadsheet_info():
                 'id': sheet.id,
                 'rows': sheet.row_count,
                 'cols': sheet.col_count,
-                'is_active': sheet == spreadsheet.sheet1
+                'is_active': sheet.id == sheets_client.sheet1.id
             }
             info['sheets'].append(sheet_info)
         
@@ -154,10 +408,11 @@ def get_spreadsheet_info():
         
     except Exception as e:
         logging.error(f"Ошибка получения информации о таблице: {e}")
+        sheets_client.reset()
         return None
 
 def setup_google_sheet_headers():
-    """Настройка заголовков в Google Таблице (можно вызвать отдельно для проверки)"""
+    """Настройка заголовков в Google Таблице (синхронно, для запуска из test_sheets.py)"""
     try:
         sheet = init_google_sheets()
         if not sheet:
@@ -171,7 +426,7 @@ def setup_google_sheet_headers():
         all_values = sheet.get_all_values()
         
         # Проверяем наличие правильных заголовков (с городом)
-        headers = ['Город', 'Имя', 'Телефон', 'Username', 'User ID', 'Дата']
+        headers = SHEET_HEADERS
         
         print(f"\n🔍 Проверка заголовков...")
         print(f"📝 Ожидаемые заголовки: {headers}")
@@ -199,11 +454,7 @@ def setup_google_sheet_headers():
         
         # Форматируем заголовки
         try:
-            sheet.format('A1:F1', {
-                "textFormat": {"bold": True},
-                "backgroundColor": {"red": 0.9, "green": 0.9, "blue": 0.9},
-                "horizontalAlignment": "CENTER"
-            })
+            sheet.format('A1:F1', HEADER_FORMAT)
             print("🎨 Заголовки отформатированы")
         except Exception as format_error:
             print(f"⚠️ Заголовки созданы, но форматирование не удалось: {format_error}")
@@ -214,53 +465,379 @@ def setup_google_sheet_headers():
         print(f"❌ Ошибка настройки заголовков: {e}")
         return False
 
-async def save_to_google_sheets(name: str, phone: str, username: str, user_id: int, city: str):
-    """Сохранение данных в Google Таблицы"""
+async def fetch_spreadsheet_info():
+    """Получение информации о всей таблице и всех листах через асинхронный слой"""
     try:
-        sheet = init_google_sheets()
-        if sheet:
-            # Проверяем наличие заголовков и создаем их если нужно
-            all_values = sheet.get_all_values()
-            
-            # Обновленные заголовки с городом
-            headers = ['Город', 'Имя', 'Телефон', 'Username', 'User ID', 'Дата']
-            
-            # Если таблица пустая или первая строка не содержит заголовки
-            if not all_values or (all_values and all_values[0] != headers):
-                logging.info("Создание заголовков в Google Таблице...")
-                
-                # Если есть данные, но нет заголовков - вставляем их в начало
-                if all_values:
-                    sheet.insert_row(headers, 1)
-                else:
-                    # Если таблица пустая - просто добавляем заголовки
-                    sheet.append_row(headers)
-                
-                # Форматируем заголовки (делаем жирными)
-                try:
-                    sheet.format('A1:F1', {
-                        "textFormat": {
-                            "bold": True
-                        },
-                        "backgroundColor": {
-                            "red": 0.9,
-                            "green": 0.9,
-                            "blue": 0.9
-                        }
-                    })
-                except Exception as format_error:
-                    logging.warning(f"Не удалось отформатировать заголовки: {format_error}")
-            
-            # Добавляем новую строку с данными
-            from datetime import datetime
-            current_date = datetime.now().strftime("%d.%m.%Y %H:%M")
-            sheet.append_row([city, name, phone, username or "Не указан", user_id, current_date])
-            
-            logging.info(f"Данные сохранены в Google Таблицы: {city}, {name}, {phone}")
-            return True
+        metadata = await sheets_api.get_metadata(
+            "spreadsheetId,spreadsheetUrl,properties.title,sheets.properties"
+        )
+        
+        info = {
+            'title': metadata['properties']['title'],
+            'id': metadata['spreadsheetId'],
+            'url': metadata['spreadsheetUrl'],
+            'sheets': [],
+            'client': {**sheets_client.stats(), **sheets_api.stats()}
+        }
+        
+        # Получаем информацию о всех листах
+        for index, sheet in enumerate(metadata.get('sheets', [])):
+            properties = sheet['properties']
+            grid = properties.get('gridProperties', {})
+            info['sheets'].append({
+                'title': properties['title'],
+                'id': properties['sheetId'],
+                'rows': grid.get('rowCount', 0),
+                'cols': grid.get('columnCount', 0),
+                'is_active': index == 0
+            })
+        
+        return info
+        
     except Exception as e:
-        logging.error(f"Ошибка сохранения в Google Sheets: {e}")
+        logging.error(f"Ошибка получения информации о таблице: {e}")
+        sheets_api.reset()
+        return None
+
+class SheetLayout:
+    """Запомненный результат проверки заголовков листа с заявками"""
+
+    def __init__(self):
+        self.verified = False
+        self.sheet_id = None
+        self.title = None
+        self.checked_at = None
+
+    def remember(self, sheet: dict):
+        self.verified = True
+        self.sheet_id = sheet['sheetId']
+        self.title = sheet['title']
+        self.checked_at = datetime.now()
+
+    def invalidate(self):
+        self.verified = False
+
+sheet_layout = SheetLayout()
+
+async def ensure_sheet_headers(force: bool = False):
+    """Проверка заголовков листа с заявками и их создание при необходимости
+    
+    Проверка выполняется один раз (при запуске или по /setup_sheet) и читает
+    только первую строку. Возвращает текущие заголовки (до исправления)
+    или None, если первая строка была пустой.
+    """
+    if sheet_layout.verified and not force:
+        return SHEET_HEADERS
+    
+    if force:
+        sheets_api.reset()
+    sheet = await sheets_api.get_first_sheet()
+    header_range = quote_sheet_range(sheet['title'], HEADER_RANGE)
+    first_row = await sheets_api.get_values(header_range)
+    current_headers = first_row[0] if first_row else None
+    
+    # Если первая строка пустая или не содержит заголовки
+    if current_headers != SHEET_HEADERS:
+        logging.info("Создание заголовков в Google Таблице...")
+        
+        # Если в первой строке есть данные - вставляем заголовки перед ними
+        if current_headers:
+            await sheets_api.insert_row(sheet, SHEET_HEADERS, 1)
+        else:
+            # Если первая строка пустая - просто записываем заголовки в нее
+            await sheets_api.update_values(header_range, [SHEET_HEADERS])
+        
+        # Форматируем заголовки (делаем жирными)
+        try:
+            await sheets_api.format_row(sheet, 1, len(SHEET_HEADERS), HEADER_FORMAT)
+        except Exception as format_error:
+            logging.warning(f"Не удалось отформатировать заголовки: {format_error}")
+    
+    sheet_layout.remember(sheet)
+    return current_headers
+
+async def check_sheet_layout():
+    """Дешевая проверка, что структура листа не изменилась: метаданные и первая строка"""
+    sheets_api.reset()
+    sheet = await sheets_api.get_first_sheet()
+    changed = sheet['sheetId'] != sheet_layout.sheet_id or sheet['title'] != sheet_layout.title
+    
+    if not changed:
+        header_range = quote_sheet_range(sheet['title'], HEADER_RANGE)
+        first_row = await sheets_api.get_values(header_range)
+        changed = not first_row or first_row[0] != SHEET_HEADERS
+    
+    if changed:
+        logging.warning("Структура листа с заявками изменилась, заголовки будут проверены заново")
+        await ensure_sheet_headers(force=True)
+    else:
+        sheet_layout.checked_at = datetime.now()
+    return changed
+
+async def run_sheet_layout_check_loop():
+    """Фоновая проверка структуры листа с заявками"""
+    while True:
+        await asyncio.sleep(SHEET_LAYOUT_CHECK_INTERVAL)
+        try:
+            await check_sheet_layout()
+        except Exception as e:
+            logging.error(f"Ошибка проверки структуры листа: {e}")
+
+async def write_rows_to_google_sheets(rows: list):
+    """Запись пачки строк в Google Таблицу одним запросом"""
+    try:
+        # Заголовки проверяются один раз; при записи таблица не читается
+        if not sheet_layout.verified:
+            await ensure_sheet_headers()
+        
+        sheet = await sheets_api.get_first_sheet()
+        result = await sheets_api.append_rows(quote_sheet_range(sheet['title'], 'A1'), rows)
+        logging.info(f"Записано строк в Google Таблицы: {len(rows)}")
+        return result
+    except Exception:
+        # Лист могли переименовать или удалить - при следующей попытке проверим заново
+        sheets_api.reset()
+        sheet_layout.invalidate()
+        raise
+
+def sheet_row_key(row: list) -> tuple:
+    """Строка таблицы для сравнения с прочитанной из листа (там все значения - строки)"""
+    return tuple(str(value) for value in row[:6])
+
+async def read_sheet_tail():
+    """Строки листа после последней отмеченной в базе: (лист, {строка: номер строки листа})"""
+    sheet = await sheets_api.get_first_sheet()
+    last_row = submission_store.last_sheet_row
+    start_row = last_row + 1 if last_row else 2
+    tail = await sheets_api.get_values(quote_sheet_range(sheet['title'], f'A{start_row}:F'))
+    return sheet, {sheet_row_key(row): start_row + offset for offset, row in enumerate(tail)}
+
+async def find_rows_in_sheet(rows: list):
+    """Проверка после таймаута записи: если все строки пачки уже в листе - ответ как у append, иначе None"""
+    sheet, written = await read_sheet_tail()
+    found = [written.get(sheet_row_key(row)) for row in rows]
+    if not found or None in found:
+        return None
+    return {'updates': {'updatedRange': quote_sheet_range(sheet['title'], f'A{min(found)}:F{max(found)}')}}
+
+# Очередь записи: заявки копятся в памяти и уходят в таблицу пачками в пределах квоты
+sheets_writer = SheetsWriter(
+    write_rows_to_google_sheets,
+    TokenBucket(rate=SHEETS_WRITE_QUOTA_PER_MINUTE / 60, capacity=5),
+    batch_size=SHEETS_BATCH_SIZE,
+    max_delay=SHEETS_BATCH_MAX_DELAY,
+    find_written=find_rows_in_sheet
+)
+
+# Основное хранилище заявок; Google Таблица - его копия, которая дописывается в фоне
+submission_store = create_submission_store(
+    SUBMISSION_STORE,
+    SUBMISSIONS_DB_PATH,
+    origin=WORKER_ID or 0,
+    commit_delay=SUBMISSIONS_COMMIT_DELAY
+)
+
+# Телефоны и пользователи всех заявок - для поиска повторной регистрации без запроса к базе
+registration_index = RegistrationIndex()
+registration_index_lock = asyncio.Lock()
+
+# Заявок за один запрос при загрузке индекса
+REGISTRATION_INDEX_CHUNK = 50000
+
+def record_to_row(record: dict) -> list:
+    """Строка таблицы для заявки из хранилища"""
+    return [
+        record['city'],
+        record['name'],
+        record['phone'],
+        record['username'] or "Не указан",
+        record['user_id'],
+        record['date']
+    ]
+
+def row_written_callback(submission_id: int):
+    """Обработка успешной записи строки в таблицу: отметка в хранилище"""
+    def on_written(result):
+        submission_store.mark_replicated(submission_id, updated_last_row(result))
+    return on_written
+
+def row_rejected_callback(submission_id: int):
+    """Строку отклонил API таблицы: отметка в хранилище, чтобы не отправлять ее после перезапуска"""
+    def on_rejected(error):
+        logging.error(f"Заявка {submission_id} отклонена Google Таблицей и не будет записана в нее: {error}")
+        submission_store.mark_rejected(submission_id)
+    return on_rejected
+
+async def save_to_google_sheets(name: str, phone: str, username: str, user_id: int, city: str,
+                                key: str = None, date: str = None):
+    """Сохранение заявки в хранилище и постановка в очередь на запись в Google Таблицы
+    
+    key - ключ заявки: повторный вызов с тем же ключом (после таймаута) не создает вторую заявку.
+    """
+    record = {
+        'city': city,
+        'name': name,
+        'phone': phone,
+        'username': username,
+        'user_id': user_id,
+        'date': date or datetime.now().strftime("%d.%m.%Y %H:%M"),
+        'key': key
+    }
+    
+    # Сначала сохраняем заявку в базу - после этого она не потеряется
+    try:
+        record = await submission_store.add(record)
+    except Exception as e:
+        logging.error(f"Ошибка сохранения заявки в хранилище: {e}; заявка: {record}")
         return False
+    registration_index.add(record['id'], phone, user_id)
+    
+    try:
+        sheets_writer.submit(
+            record_to_row(record),
+            on_written=row_written_callback(record['id']),
+            on_rejected=row_rejected_callback(record['id'])
+        )
+        
+        logging.info(f"Данные поставлены в очередь Google Таблиц: {city}, {name}, {phone}")
+    except Exception as e:
+        # Заявка уже в базе и будет записана в таблицу после перезапуска
+        logging.error(f"Ошибка постановки заявки в очередь Google Таблиц: {e}")
+    return True
+
+async def import_submissions():
+    """Однократный перенос заявок из таблицы и журнала прежних версий в хранилище"""
+    # Таблица читается целиком, поэтому после переноса ее не читаем при каждом запуске
+    if not await submission_store.is_imported("sheet"):
+        sheet = await sheets_api.get_first_sheet()
+        rows = await sheets_api.get_values(quote_sheet_range(sheet['title'], 'A2:F'))
+        records = [row_to_record(row) for row in rows if row and str(row[0]).strip()]
+        # Пустые строки внутри листа тоже занимают место: последняя строка - по числу прочитанных
+        imported = await submission_store.import_records(
+            "sheet", records, replicated=True, last_sheet_row=len(rows) + 1 if rows else None
+        )
+        if imported:
+            logging.info(f"Заявки из Google Таблицы перенесены в хранилище: {imported}")
+
+    if os.path.exists(JOURNAL_PATH) and not await submission_store.is_imported(f"journal:{JOURNAL_PATH}"):
+        journal = SubmissionJournal(JOURNAL_PATH)
+        journal.open()
+        pending = journal.unacked_records()
+        await journal.stop()
+        imported = await submission_store.import_records(f"journal:{JOURNAL_PATH}", pending, replicated=False)
+        if imported:
+            logging.info(f"Незаписанные заявки из журнала перенесены в хранилище: {imported}")
+
+async def check_sheet_edits():
+    """Проверка правок таблицы вне бота: строки, добавленные вручную, переносятся в базу"""
+    # Читаем только столбец с городом - этого достаточно, чтобы посчитать строки
+    sheet = await sheets_api.get_first_sheet()
+    column = await sheets_api.get_values(quote_sheet_range(sheet['title'], 'A2:A'))
+    sheet_rows = sum(1 for row in column if row and str(row[0]).strip())
+    replicated = await submission_store.replicated_count()
+    if sheet_rows == replicated:
+        return 0
+    
+    rows = await sheets_api.get_values(quote_sheet_range(sheet['title'], 'A2:F'))
+    records = [row_to_record(row) for row in rows if row and str(row[0]).strip()]
+    imported = await submission_store.merge_sheet_records(records, last_sheet_row=len(rows) + 1 if rows else None)
+    if imported:
+        await sync_registration_index()
+        logging.info(f"Таблица изменена вне бота: перенесено в базу заявок {imported}")
+    elif sheet_rows < replicated:
+        # База - основной источник: удаленные из таблицы заявки остаются в базе и статистике
+        logging.warning(
+            f"В таблице {sheet_rows} строк с заявками, а в базе записанных {replicated}: "
+            "строки удалены вне бота"
+        )
+    return imported
+
+async def run_stats_check_loop():
+    """Фоновая проверка правок таблицы вне бота"""
+    while True:
+        await asyncio.sleep(STATS_CHECK_INTERVAL)
+        try:
+            # При нескольких процессах таблицу читает только один
+            if shared_state and not await shared_state.try_lock("stats_check", STATS_CHECK_INTERVAL / 2):
+                continue
+            await check_sheet_edits()
+        except Exception as e:
+            logging.error(f"Ошибка проверки правок таблицы: {e}")
+
+async def sync_registration_index(in_thread: bool = False):
+    """Загрузка в индекс регистраций заявок, появившихся в базе после прошлой загрузки
+    
+    in_thread - загрузка в отдельном потоке (только при запуске, пока обработчики
+    не пополняют индекс), чтобы не задерживать цикл событий.
+    """
+    async with registration_index_lock:
+        while True:
+            rows = await submission_store.registrations(registration_index.last_id, REGISTRATION_INDEX_CHUNK)
+            if not rows:
+                return
+            if in_thread:
+                await asyncio.to_thread(registration_index.load, rows)
+            else:
+                registration_index.load(rows)
+
+async def import_and_index_submissions():
+    """Перенос заявок прежних версий, затем загрузка индекса регистраций"""
+    try:
+        await import_submissions()
+    finally:
+        await sync_registration_index(in_thread=True)
+        stats = registration_index.stats()
+        logging.info(
+            f"Индекс регистраций: телефонов {stats['phones']}, пользователей {stats['users']}, "
+            f"память {stats['memory_bytes'] / 1024 / 1024:.1f} МБ"
+        )
+
+async def find_registration(phone: str, user_id: int):
+    """Прежняя заявка с этим телефоном; None - регистрация новая
+    
+    Повтор определяется по телефону: пользователь, указавший новый номер,
+    оставляет новую заявку (считается в bot_new_phone_registrations_total).
+    """
+    if not REGISTRATION_DEDUP:
+        return None
+    if shared_state and not registration_index.has_phone(phone):
+        # Заявку мог принять другой процесс - дочитываем новые заявки из общей базы
+        await sync_registration_index()
+    found = registration_index.find(phone, user_id)
+    if found is None:
+        if registration_index.has_user(user_id):
+            metrics.new_phone_registrations_total.inc()
+            logging.info(f"Пользователь {user_id} уже оставлял заявку, новый телефон - новая заявка")
+        return None
+    submission_id, match = found
+    record = await submission_store.get(submission_id)
+    if record is not None:
+        metrics.duplicate_registrations_total.inc(match=match)
+        logging.info(f"Повторная регистрация пользователя {user_id} (совпадение по {match}, заявка {submission_id})")
+    return record
+
+async def replicate_backlog():
+    """Запись в таблицу заявок, которые не попали в нее до перезапуска"""
+    records = await submission_store.unreplicated()
+    if not records:
+        return
+    
+    logging.info(f"Заявок для записи в Google Таблицу после перезапуска: {len(records)}")
+    
+    # Заявки могли попасть в таблицу, но не успеть получить отметку.
+    # Читаем только строки после последней отмеченной, чтобы не создать дубликаты
+    _, already_written = await read_sheet_tail()
+    
+    for record in records:
+        row = record_to_row(record)
+        if sheet_row_key(row) in already_written:
+            submission_store.mark_replicated(record['id'], already_written[sheet_row_key(row)])
+            continue
+        sheets_writer.submit(
+            row,
+            on_written=row_written_callback(record['id']),
+            on_rejected=row_rejected_callback(record['id'])
+        )
 
 # =====================================================
 # УТИЛИТЫ ДЛЯ РАБОТЫ С АДМИНАМИ
@@ -282,8 +859,26 @@ async def notify_admins(text: str):
 # ОБРАБОТЧИКИ КОМАНД И СООБЩЕНИЙ
 # =====================================================
 
-# Словарь для отслеживания пользователей, которые уже получили приветствие
-welcomed_users = set()
+# Пользователи, которые уже получили приветствие: компактное множество
+# с лимитом памяти, сохраняется на диск и переживает перезапуск
+welcomed_users = SeenUsers(SEEN_USERS_PATH, max_bytes=SEEN_USERS_MAX_MB * 1024 * 1024)
+welcomed_users.load()
+
+async def save_welcomed_users():
+    """Сохранение списка пользователей на диск, если он изменился"""
+    if welcomed_users.dirty:
+        # Номер изменения берется вместе со снимком: сохраненным он считается только после записи
+        version = welcomed_users.version
+        await asyncio.to_thread(welcomed_users.write_snapshot, welcomed_users.snapshot(), version)
+
+async def run_welcomed_users_snapshot_loop():
+    """Периодическое сохранение списка пользователей"""
+    while True:
+        await asyncio.sleep(SEEN_USERS_SNAPSHOT_INTERVAL)
+        try:
+            await save_welcomed_users()
+        except Exception as e:
+            logging.error(f"Ошибка сохранения списка пользователей: {e}")
 
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message, state: FSMContext):
@@ -298,10 +893,11 @@ async def cmd_start(message: types.Message, state: FSMContext):
 📍 <b>Для начала выберите ваш город:</b>"""
     )
     
-    # Получаем список городов
-    cities_list, cities_dict = get_cities_and_addresses()
+    # Список городов берем из кэша; если он пуст - пробуем загрузить заново
+    if not city_catalog:
+        await city_catalog.refresh()
     
-    if not cities_list:
+    if not city_catalog:
         await message.answer(
             "❌ <b>Ошибка загрузки списка городов.</b>\n"
             "Пожалуйста, попробуйте позже или обратитесь к администратору.",
@@ -309,41 +905,47 @@ async def cmd_start(message: types.Message, state: FSMContext):
         )
         return
     
-    # Создаем инлайн клавиатуру с городами (по одной кнопке в ряду)
-    keyboard_buttons = []
-    for city in cities_list:
-        keyboard_buttons.append([InlineKeyboardButton(text=city, callback_data=f"city:{city}")])
-    
-    city_keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
-    
-    await message.answer(welcome_text, reply_markup=city_keyboard, parse_mode="HTML")
+    # Клавиатура с городами построена заранее для текущей версии списка
+    await message.answer(
+        welcome_text + city_search_hint(), reply_markup=city_catalog.keyboards.page(0), parse_mode="HTML"
+    )
     await state.set_state(RegistrationForm.waiting_for_city)
 
 # =====================================================
 # ОБРАБОТЧИК ВЫБОРА ГОРОДА
 # =====================================================
 
-@dp.callback_query(F.data.startswith("city:"), StateFilter(RegistrationForm.waiting_for_city))
+def city_search_hint() -> str:
+    """Подсказка о поиске города, если список не помещается на одну страницу"""
+    if city_catalog.keyboards.page_count > 1:
+        return "\n\n🔎 Не нашли свой город? Напишите первые буквы названия."
+    return ""
+
+@dp.callback_query(F.data.startswith(f"{CITY_PREFIX}:") | F.data.startswith("city:"),
+                   StateFilter(RegistrationForm.waiting_for_city))
 async def process_city_callback(callback: types.CallbackQuery, state: FSMContext):
     """Обработка выбора города через инлайн кнопку"""
     await callback.answer()
     
-    # Извлекаем название города из callback_data
-    selected_city = callback.data.split(":", 1)[1]
-    
-    # Получаем актуальный список городов и адресов
-    cities_list, cities_dict = get_cities_and_addresses()
+    # Город по короткому ID из callback_data; "city:{название}" - кнопки прежних версий бота
+    if callback.data.startswith("city:"):
+        selected_city = callback.data.split(":", 1)[1]
+    else:
+        selected_city = city_catalog.keyboards.lookup(callback.data)
     
-    # Проверяем, что город есть в списке
-    if selected_city not in cities_dict:
+    # Проверяем, что город есть в списке (поиск по кэшу, без обращения к сети)
+    address = city_catalog.get_address(selected_city) if selected_city else None
+    if address is None:
+        # Город убрали из списка, пока открыта старая клавиатура - показываем актуальную
         await callback.message.answer(
-            "❌ <b>Ошибка выбора города. Попробуйте снова.</b>",
+            "❌ <b>Этого города больше нет в списке. Выберите город снова:</b>" + city_search_hint(),
+            reply_markup=city_catalog.keyboards.page(0),
             parse_mode="HTML"
         )
         return
     
     # Сохраняем город и адрес в состоянии
-    await state.update_data(city=selected_city, address=cities_dict[selected_city])
+    await state.update_data(city=selected_city, address=address)
     
     # Редактируем сообщение и переходим к запросу имени
     await callback.message.edit_text(
@@ -354,6 +956,35 @@ async def process_city_callback(callback: types.CallbackQuery, state: FSMContext
     
     await state.set_state(RegistrationForm.waiting_for_name)
 
+@dp.callback_query(F.data.startswith(f"{PAGE_PREFIX}:"), StateFilter(RegistrationForm.waiting_for_city))
+async def process_city_page(callback: types.CallbackQuery):
+    """Переход по страницам клавиатуры городов"""
+    await callback.answer()
+    markup = city_catalog.keyboards.page(city_catalog.keyboards.parse_page(callback.data))
+    try:
+        await callback.message.edit_reply_markup(reply_markup=markup)
+    except TelegramBadRequest:
+        # Нажата кнопка с номером текущей страницы - клавиатура не изменилась
+        pass
+
+@dp.message(StateFilter(RegistrationForm.waiting_for_city), F.text, ~F.text.startswith("/"))
+async def process_city_search(message: types.Message):
+    """Поиск города по первым буквам названия"""
+    found = city_catalog.keyboards.search(message.text)
+    if not found:
+        await message.answer(
+            "❌ <b>Город не найден.</b>\n"
+            "Напишите первые буквы названия или выберите город из списка:",
+            reply_markup=city_catalog.keyboards.page(0),
+            parse_mode="HTML"
+        )
+        return
+    await message.answer(
+        "📍 <b>Выберите ваш город:</b>",
+        reply_markup=city_catalog.keyboards.search_keyboard(found),
+        parse_mode="HTML"
+    )
+
 # =====================================================
 # ОБРАБОТЧИК ВВОДА ИМЕНИ
 # =====================================================
@@ -422,6 +1053,61 @@ async def process_phone_text(message: types.Message, state: FSMContext):
     
     await process_phone_data(message, state, phone)
 
+# =====================================================
+# КОНВЕЙЕР ЗАВЕРШЕНИЯ РЕГИСТРАЦИИ
+# =====================================================
+
+# Политика для каждого этапа: таймаут (сек), число повторов, пауза между повторами (сек).
+# Для канала админов таймаута и повторов нет: сообщение ждет очереди в OutboundLimiter
+# (20 сообщений в минуту), а RetryAfter повторяет RateLimitMiddleware. Таймаут этапа
+# отсчитывался бы и во время ожидания очереди, а повтор после таймаута во время
+# отправки мог бы опубликовать заявку дважды. Саму отправку ограничивает таймаут сессии бота
+COMPLETION_STAGES = {
+    'congratulations': {'timeout': 15, 'retries': 0, 'retry_delay': 0},
+    'persistence': {'timeout': 10, 'retries': 2, 'retry_delay': 0.5},
+    'admin_channel': {'timeout': None, 'retries': 0, 'retry_delay': 0},
+}
+
+# Фоновые задачи (ссылки хранятся, чтобы задачи не были удалены сборщиком мусора)
+background_tasks = set()
+
+def spawn_background(coro):
+    """Запуск корутины в фоне"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def run_stage(name: str, make_call):
+    """Выполнение этапа с таймаутом, повторами и изоляцией ошибок
+    
+    make_call - функция без аргументов, возвращающая корутину. Результат False
+    считается ошибкой. Ошибка этапа не влияет на остальные этапы.
+    """
+    policy = COMPLETION_STAGES[name]
+    started = time.monotonic()
+    
+    for attempt in range(policy['retries'] + 1):
+        try:
+            result = await asyncio.wait_for(make_call(), policy['timeout'])
+            if result is not False:
+                logging.info(f"Этап '{name}' выполнен за {(time.monotonic() - started) * 1000:.0f} мс (попытка {attempt + 1})")
+                metrics.stage_seconds.observe(time.monotonic() - started, stage=name, result="ok")
+                return True
+            error = "этап вернул ошибку"
+        except asyncio.TimeoutError:
+            error = f"таймаут {policy['timeout']} с"
+        except Exception as e:
+            error = str(e)
+        
+        logging.warning(f"Этап '{name}', попытка {attempt + 1}: {error}")
+        if attempt < policy['retries']:
+            await asyncio.sleep(policy['retry_delay'] * (2 ** attempt))
+    
+    logging.error(f"Этап '{name}' не выполнен за {(time.monotonic() - started) * 1000:.0f} мс")
+    metrics.stage_seconds.observe(time.monotonic() - started, stage=name, result="failed")
+    return False
+
 async def process_phone_data(message: types.Message, state: FSMContext, phone: str):
     """Обработка полученного номера телефона"""
     # Получаем сохраненные данные
@@ -429,86 +1115,198 @@ async def process_phone_data(message: types.Message, state: FSMContext, phone: s
     name = data.get('name')
     city = data.get('city', 'Не указан')
     address = data.get('address', 'Не указан')
+    user = message.from_user
     
     # Очищаем состояние
     await state.clear()
     
-    # Убираем клавиатуру
-    await message.answer(
-        "⏳ <b>Обрабатываем ваши данные...</b>",
-        reply_markup=ReplyKeyboardRemove(),
-        parse_mode="HTML"
-    )
-    
-    # Отправляем заявку в канал админов
-    await send_to_admin_channel(message.from_user, name, phone, city)
+    # Повторная регистрация: отвечаем прежним результатом, новую заявку не создаем
+    try:
+        existing = await find_registration(phone, user.id)
+    except Exception as e:
+        logging.error(f"Ошибка проверки повторной регистрации: {e}")
+        existing = None
+    if existing is not None:
+        existing_address = city_catalog.get_address(existing['city']) or address
+        await run_stage('congratulations', lambda: send_congratulations(
+            message, existing['name'], existing_address, existing['city'], repeat=True
+        ))
+        return
     
-    # Сохраняем в Google Таблицы
-    await save_to_google_sheets(
+    # Заявка сохраняется в локальную базу до поздравления: пользователь не получит
+    # подтверждение заявки, которая не сохранилась. Запись в Google Таблицу при этом
+    # идет в фоне через очередь, уведомление админов - фоновой задачей.
+    # Ключ и дата заявки задаются до первой попытки: если попытка сохранения прервана
+    # таймаутом уже после записи в базу, повтор вернет ту же заявку, а не создаст вторую
+    submission_key = uuid.uuid4().hex
+    submitted_at = datetime.now().strftime("%d.%m.%Y %H:%M")
+    saved = await run_stage('persistence', lambda: save_to_google_sheets(
         name=name,
         phone=phone,
-        username=message.from_user.username,
-        user_id=message.from_user.id,
-        city=city
-    )
+        username=user.username,
+        user_id=user.id,
+        city=city,
+        key=submission_key,
+        date=submitted_at
+    ))
+    if not saved:
+        # Данные заявки - в журнале, чтобы ее можно было восстановить вручную
+        logging.error(
+            f"Заявка не сохранена: город {city}, имя {name}, телефон {phone}, "
+            f"username {user.username}, user_id {user.id}, дата {submitted_at}, ключ {submission_key}"
+        )
+        # Возвращаем анкету к вводу телефона, чтобы пользователь мог отправить его еще раз
+        await state.set_state(RegistrationForm.waiting_for_phone)
+        await state.set_data(data)
+        await message.answer(
+            "❌ <b>Не удалось сохранить заявку.</b>\n\n"
+            "Пожалуйста, отправьте номер телефона еще раз через минуту.",
+            parse_mode="HTML"
+        )
+        return
+    spawn_background(run_stage('admin_channel', lambda: send_to_admin_channel(user, name, phone, city)))
     
-    # Отправляем поздравительное сообщение с изображением
-    await send_congratulations(message, name, address)
+    # Отправляем поздравительное сообщение с изображением (и убираем клавиатуру)
+    await run_stage('congratulations', lambda: send_congratulations(message, name, address, city))
+
+async def post_to_admin_channel(text: str):
+    """Публикация сообщения в канале админов"""
+    await bot.send_message(
+        chat_id=ADMIN_CHANNEL_ID,
+        text=text,
+        parse_mode="HTML",
+        disable_web_page_preview=True
+    )
+
+# При всплеске заявок они публикуются в канал админов общими дайджестами
+admin_digest = AdminDigest(
+    post_to_admin_channel,
+    interval=ADMIN_DIGEST_INTERVAL,
+    max_leads=ADMIN_DIGEST_MAX_LEADS,
+    rate_threshold=ADMIN_DIGEST_RATE_THRESHOLD,
+    quiet_threshold=ADMIN_DIGEST_QUIET_THRESHOLD,
+    mode=ADMIN_DIGEST_MODE
+)
 
 async def send_to_admin_channel(user: types.User, name: str, phone: str, city: str):
     """Отправка заявки в канал админов"""
     try:
+        # Во время всплеска заявка уходит в дайджест, а не отдельным сообщением
+        if admin_digest.offer({
+            'city': city,
+            'name': name,
+            'phone': phone,
+            'username': user.username,
+            'user_id': user.id,
+            'time': datetime.now().strftime('%H:%M')
+        }):
+            logging.info(f"Заявка добавлена в дайджест канала админов: {name}, {phone}, {city}")
+            return True
+        
         admin_message = (
             "🆕 <b>НОВАЯ ЗАЯВКА</b>\n\n"
-            f"📍 <b>Город:</b> {city}\n"
-            f"👤 <b>Имя:</b> {name}\n"
-            f"📞 <b>Телефон:</b> {phone}\n"
+            f"📍 <b>Город:</b> {html.escape(city)}\n"
+            f"👤 <b>Имя:</b> {html.escape(name)}\n"
+            f"📞 <b>Телефон:</b> {html.escape(phone)}\n"
             f"🆔 <b>User ID:</b> <code>{user.id}</code>\n"
-            f"📱 <b>Username:</b> @{user.username or 'Не указан'}\n"
+            f"📱 <b>Username:</b> @{html.escape(user.username or 'Не указан')}\n"
             f"🔗 <b>Ссылка:</b> <a href='tg://user?id={user.id}'>Профиль</a>\n\n"
-            f"📅 <b>Дата:</b> {__import__('datetime').datetime.now().strftime('%d.%m.%Y %H:%M')}"
+            f"📅 <b>Дата:</b> {datetime.now().strftime('%d.%m.%Y %H:%M')}"
         )
         
-        await bot.send_message(
-            chat_id=ADMIN_CHANNEL_ID,
-            text=admin_message,
-            parse_mode="HTML",
-            disable_web_page_preview=True
-        )
+        await post_to_admin_channel(admin_message)
         
         logging.info(f"Заявка отправлена в админ канал: {name}, {phone}, {city}")
+        return True
         
     except Exception as e:
         logging.error(f"Ошибка отправки в админ канал: {e}")
+        return False
+
+# Изображения загружаются в Telegram один раз, дальше отправляются по file_id
+photo_cache = PhotoCache(PHOTO_CACHE_PATH)
+photo_cache.load()
+
+def get_congratulations_image_path(city: str = None) -> str:
+    """Путь к изображению для поздравления (с учетом города)"""
+    return CITY_IMAGES.get(city, CONGRATULATIONS_IMAGE_PATH)
+
+async def answer_photo_cached(message: types.Message, image_path: str, caption: str, reply_markup=None):
+    """Отправка изображения по file_id, с загрузкой файла только при первой отправке"""
+    digest = photo_cache.digest(image_path)
+    
+    file_id = photo_cache.get(digest)
+    if file_id:
+        try:
+            return await message.answer_photo(
+                photo=file_id, caption=caption, reply_markup=reply_markup, parse_mode="HTML"
+            )
+        except TelegramBadRequest as e:
+            # file_id стал недействительным - загрузим файл заново
+            logging.warning(f"Сохраненный file_id не принят Telegram: {e}")
+            photo_cache.forget(digest)
+    
+    with open(image_path, 'rb') as file:
+        photo = BufferedInputFile(file.read(), filename="congratulations.jpg")
+    sent = await message.answer_photo(photo=photo, caption=caption, reply_markup=reply_markup, parse_mode="HTML")
+    photo_cache.remember(digest, sent.photo[-1].file_id)
+    logging.info(f"Изображение {image_path} загружено в Telegram, file_id сохранен")
+    return sent
 
-async def send_congratulations(message: types.Message, name: str, address: str):
-    """Отправка поздравительного сообщения с изображением"""
+async def prepare_congratulation_images():
+    """Проверка изображений поздравления при запуске и подсчет их хэшей
+    
+    Файлы, для которых еще нет file_id, загружаются в Telegram при первой
+    отправке пользователю (answer_photo_cached) - без служебных сообщений
+    в канал админов, сколько бы процессов ни запускалось.
+    """
+    missing = 0
+    for image_path in {CONGRATULATIONS_IMAGE_PATH, *CITY_IMAGES.values()}:
+        if not os.path.exists(image_path):
+            logging.warning(f"Изображение для поздравления не найдено: {image_path}")
+            continue
+        digest = await asyncio.to_thread(photo_cache.digest, image_path)
+        if digest not in photo_cache:
+            missing += 1
+    if missing:
+        logging.info(f"Изображений без file_id: {missing}, они будут загружены при первой отправке")
+
+async def send_congratulations(message: types.Message, name: str, address: str, city: str = None,
+                               repeat: bool = False):
+    """Отправка поздравительного сообщения с изображением (repeat - пользователь уже зарегистрирован)"""
     try:
+        if repeat:
+            greeting = (
+                f"🎉 <b>{name}, Вы уже участник программы лояльности Levi's!</b>\n\n"
+                "Повторная регистрация не нужна: скидки и привилегии держателя карты уже доступны Вам."
+            )
+        else:
+            greeting = (
+                f"🎉 <b>Поздравляем, {name}!</b>\n\n"
+                "Вы стали участником программы лояльности Levi's. "
+                "Теперь Вам доступны скидки и привилегии как держателю карты. "
+            )
         congratulations_text = (
-            f"""🎉 <b>Поздравляем, {name}!</b>
-
-Вы стали участником программы лояльности Levi's. Теперь Вам доступны скидки и привилегии как держателю карты. 
+            f"""{greeting}
 
 🛍️ <b>Ждём вас за покупками!</b>
 📍 <b>{address}</b>"""
         )
         
         # Путь к изображению
-        image_path = "image.png"
+        image_path = get_congratulations_image_path(city)
+        
+        # Вместе с поздравлением убираем клавиатуру запроса телефона
+        keyboard_remove = ReplyKeyboardRemove()
         
         try:
             # Отправляем изображение с подписью
-            with open(image_path, 'rb') as file:
-                photo = BufferedInputFile(file.read(), filename="congratulations.jpg")
-                await message.answer_photo(
-                    photo=photo,
-                    caption=congratulations_text,
-                    parse_mode="HTML"
-                )
+            await answer_photo_cached(message, image_path, congratulations_text, keyboard_remove)
         except FileNotFoundError:
             # Если изображение не найдено, отправляем только текст
             await message.answer(
                 congratulations_text,
+                reply_markup=keyboard_remove,
                 parse_mode="HTML"
             )
             logging.warning("Изображение для поздравления не найдено")
@@ -518,6 +1316,7 @@ async def send_congratulations(message: types.Message, name: str, address: str):
         await message.answer(
             "✅ <b>Регистрация завершена!</b>\n"
             "Спасибо за участие!",
+            reply_markup=ReplyKeyboardRemove(),
             parse_mode="HTML"
         )
 
@@ -535,10 +1334,16 @@ async def cmd_admin(message: types.Message):
     admin_text = (
         "👨‍💼 <b>АДМИН ПАНЕЛЬ</b>\n\n"
         "📊 <b>Доступные команды:</b>\n"
-        "• /stats - Статистика заявок\n"
+        "• /stats - Статистика заявок (/stats rebuild - пересчитать)\n"
         "• /setup_sheet - Настройка Google Таблицы\n"
         "• /table_info - Полная информация о таблице\n"
-        "• /broadcast - Рассылка пользователям\n\n"
+        "• /refresh_cities - Обновить список городов\n"
+        "• /queue - Очереди записи в таблицу и отправки сообщений\n"
+        "• /digest - Режим дайджеста в канале админов\n"
+        "• /broadcast - Рассылка пользователям\n"
+        "• /export - Выгрузка заявок в CSV или XLSX\n"
+        "• /perf - Метрики производительности\n"
+        "• /profile, /memprofile, /tasks - Профилирование работающего бота\n\n"
         f"🆔 <b>Ваш ID:</b> <code>{message.from_user.id}</code>\n"
         f"📅 <b>Дата:</b> {__import__('datetime').datetime.now().strftime('%d.%m.%Y %H:%M')}"
     )
@@ -552,34 +1357,47 @@ async def cmd_stats(message: types.Message):
         await message.answer("❌ <b>У вас нет прав администратора.</b>", parse_mode="HTML")
         return
     
+    # /stats rebuild - перенести правки таблицы и пересчитать счетчики по всем заявкам
+    args = message.text.split()[1:] if message.text else []
+    if args == ["rebuild"]:
+        try:
+            imported = await check_sheet_edits()
+            await submission_store.rebuild_counts()
+        except Exception as e:
+            logging.error(f"Ошибка пересчета статистики: {e}")
+            await message.answer(f"❌ <b>Ошибка пересчета статистики:</b> {str(e)}", parse_mode="HTML")
+            return
+        await message.answer(
+            f"✅ <b>Статистика пересчитана</b>\n\nПеренесено из таблицы заявок: {imported}", parse_mode="HTML"
+        )
+    
+    # Счетчики ведутся в базе при каждой заявке - без обращения к таблице и обхода заявок
     try:
-        sheet = init_google_sheets()
-        if sheet:
-            total_records = len(sheet.get_all_records())
-            today = __import__('datetime').datetime.now().strftime('%d.%m.%Y')
-            
-            # Подсчет заявок за сегодня (упрощенный вариант)
-            today_count = 0
-            try:
-                all_data = sheet.get_all_values()
-                for row in all_data[1:]:  # Пропускаем заголовок
-                    if len(row) >= 5 and today in row[4]:  # Проверяем дату
-                        today_count += 1
-            except:
-                today_count = "н/д"
-            
-            stats_text = (
-                "📊 <b>СТАТИСТИКА ЗАЯВОК</b>\n\n"
-                f"📈 <b>Всего заявок:</b> {total_records}\n"
-                f"📅 <b>За сегодня:</b> {today_count}\n"
-                f"🕐 <b>Обновлено:</b> {__import__('datetime').datetime.now().strftime('%H:%M')}"
-            )
-        else:
-            stats_text = "❌ <b>Ошибка подключения к Google Таблицам</b>"
-            
+        summary = await submission_store.summary(days=7, cities=10, hours=3)
     except Exception as e:
-        stats_text = f"❌ <b>Ошибка получения статистики:</b> {str(e)}"
         logging.error(f"Ошибка получения статистики: {e}")
+        await message.answer(f"❌ <b>Ошибка получения статистики:</b> {str(e)}", parse_mode="HTML")
+        return
+    
+    days_text = "\n".join(f"• {day}: {count}" for day, count in summary['last_days'])
+    cities_text = "\n".join(f"• {city}: {count}" for city, count in summary['top_cities']) or "• нет данных"
+    hours_text = ", ".join(f"{hour:02d}:00 ({count})" for hour, count in summary['peak_hours']) or "нет данных"
+    seen_stats = welcomed_users.stats()
+    
+    stats_text = (
+        "📊 <b>СТАТИСТИКА ЗАЯВОК</b>\n\n"
+        f"📈 <b>Всего заявок:</b> {summary['total']}\n"
+        f"📅 <b>За сегодня:</b> {summary['today']}\n"
+        f"👥 <b>Уникальных пользователей:</b> {summary['users']}\n\n"
+        f"🗓 <b>Последние 7 дней:</b>\n{days_text}\n\n"
+        f"📍 <b>По городам:</b>\n{cities_text}\n\n"
+        f"⏰ <b>Пиковые часы:</b> {hours_text}\n\n"
+        f"👋 <b>Получили приветствие:</b> {seen_stats['users']} польз., "
+        f"в памяти {seen_stats['memory_bytes'] / 1024 / 1024:.1f} МБ "
+        f"(обычный set занял бы ~{seen_stats['set_bytes'] / 1024 / 1024:.1f} МБ)\n\n"
+        f"📝 <b>Еще не в таблице:</b> {summary['unreplicated']}, отклонено таблицей: {summary['rejected']}\n"
+        f"⚡️ <b>Запрос к базе:</b> {summary['query_ms']} мс"
+    )
     
     await message.answer(stats_text, parse_mode="HTML")
 
@@ -594,8 +1412,12 @@ async def cmd_setup_sheet(message: types.Message):
     
     try:
         # Получаем информацию о таблице
-        sheet = init_google_sheets()
-        if not sheet:
+        try:
+            sheets_api.reset()
+            sheet_layout.invalidate()
+            sheet = await sheets_api.get_first_sheet()
+        except Exception as e:
+            logging.error(f"Ошибка подключения к Google Таблице: {e}")
             await message.answer(
                 "❌ <b>Ошибка подключения к Google Таблице</b>\n\n"
                 "Проверьте:\n"
@@ -607,45 +1429,44 @@ async def cmd_setup_sheet(message: types.Message):
             return
         
         # Получаем информацию о листе
+        grid = sheet.get('gridProperties', {})
         sheet_info = (
             f"📋 <b>Информация о листе:</b>\n"
-            f"• Название: <code>{sheet.title}</code>\n"
-            f"• ID: <code>{sheet.id}</code>\n"
-            f"• Размер: {sheet.row_count} строк x {sheet.col_count} столбцов\n\n"
+            f"• Название: <code>{sheet['title']}</code>\n"
+            f"• ID: <code>{sheet['sheetId']}</code>\n"
+            f"• Размер: {grid.get('rowCount', 0)} строк x {grid.get('columnCount', 0)} столбцов\n\n"
         )
         
-        # Проверяем заголовки
-        all_values = sheet.get_all_values()
-        headers = ['Город', 'Имя', 'Телефон', 'Username', 'User ID', 'Дата']
-        
-        if not all_values:
-            headers_info = "📄 <b>Таблица пустая</b> - заголовки будут созданы"
-        else:
-            current_headers = all_values[0]
-            if current_headers == headers:
-                headers_info = "✅ <b>Заголовки корректны:</b>\n" + "\n".join([f"• {h}" for h in current_headers])
-            else:
-                headers_info = (
-                    f"⚠️ <b>Заголовки не соответствуют:</b>\n"
-                    f"Текущие: <code>{current_headers}</code>\n"
-                    f"Ожидаемые: <code>{headers}</code>\n\n"
-                    f"Будут созданы правильные заголовки"
-                )
-        
-        # Настраиваем заголовки
-        if setup_google_sheet_headers():
+        # Проверяем и настраиваем заголовки
+        try:
+            current_headers = await ensure_sheet_headers(force=True)
+        except Exception as e:
+            logging.error(f"Ошибка настройки заголовков: {e}")
             await message.answer(
                 f"{sheet_info}"
-                f"{headers_info}\n\n"
-                f"✅ <b>Google Таблица настроена!</b>",
+                f"❌ <b>Ошибка настройки заголовков</b>",
                 parse_mode="HTML"
             )
+            return
+        
+        if current_headers is None:
+            headers_info = "📄 <b>Таблица была пустой</b> - заголовки созданы"
+        elif current_headers == SHEET_HEADERS:
+            headers_info = "✅ <b>Заголовки корректны:</b>\n" + "\n".join([f"• {h}" for h in current_headers])
         else:
-            await message.answer(
-                f"{sheet_info}"
-                f"❌ <b>Ошибка настройки заголовков</b>",
-                parse_mode="HTML"
+            headers_info = (
+                f"⚠️ <b>Заголовки не соответствовали:</b>\n"
+                f"Текущие: <code>{current_headers}</code>\n"
+                f"Ожидаемые: <code>{SHEET_HEADERS}</code>\n\n"
+                f"Созданы правильные заголовки"
             )
+        
+        await message.answer(
+            f"{sheet_info}"
+            f"{headers_info}\n\n"
+            f"✅ <b>Google Таблица настроена!</b>",
+            parse_mode="HTML"
+        )
             
     except Exception as e:
         await message.answer(f"❌ <b>Ошибка:</b> {str(e)}", parse_mode="HTML")
@@ -661,7 +1482,7 @@ async def cmd_table_info(message: types.Message):
     await message.answer("📊 <b>Получение информации о Google Таблице...</b>", parse_mode="HTML")
     
     try:
-        info = get_spreadsheet_info()
+        info = await fetch_spreadsheet_info()
         if not info:
             await message.answer(
                 "❌ <b>Ошибка получения информации о таблице</b>\n\n"
@@ -688,12 +1509,628 @@ async def cmd_table_info(message: types.Message):
                 f"   • Размер: {sheet['rows']} x {sheet['cols']}\n\n"
             )
         
+        # Счетчики общего клиента (должны оставаться небольшими)
+        client_stats = info['client']
+        table_info += (
+            f"🔌 <b>Подключение:</b>\n"
+            f"• Обновлений токена: {client_stats['token_refreshes']}\n"
+            f"• Открыто сессий: {client_stats['sessions_opened']}\n"
+            f"• Запросов к API: {client_stats['requests_total']} (ошибок: {client_stats['errors_total']})\n"
+        )
+        
         await message.answer(table_info, parse_mode="HTML", disable_web_page_preview=True)
         
     except Exception as e:
         await message.answer(f"❌ <b>Ошибка:</b> {str(e)}", parse_mode="HTML")
         logging.error(f"Ошибка получения информации о таблице: {e}")
 
+@dp.message(Command("refresh_cities"))
+async def cmd_refresh_cities(message: types.Message):
+    """Принудительное обновление списка городов"""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ <b>У вас нет прав администратора.</b>", parse_mode="HTML")
+        return
+    
+    if shared_state:
+        # Снимок других процессов тоже устарел - загружаем список из таблицы заново
+        try:
+            await shared_state.invalidate_catalog()
+        except Exception as e:
+            logging.error(f"Ошибка сброса общего списка городов: {e}")
+    
+    if await city_catalog.refresh():
+        await message.answer(
+            "✅ <b>Список городов обновлен</b>\n\n"
+            f"🏙 <b>Городов:</b> {len(city_catalog.cities)}\n"
+            f"🔢 <b>Версия:</b> {city_catalog.version}\n"
+            f"🕐 <b>Загружен:</b> {city_catalog.loaded_at.strftime('%H:%M:%S')}",
+            parse_mode="HTML"
+        )
+    else:
+        await message.answer(
+            "❌ <b>Не удалось обновить список городов</b>\n"
+            "Используется предыдущая версия списка.",
+            parse_mode="HTML"
+        )
+
+@dp.message(Command("queue"))
+async def cmd_queue(message: types.Message):
+    """Состояние очереди записи в Google Таблицу"""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ <b>У вас нет прав администратора.</b>", parse_mode="HTML")
+        return
+    
+    stats = sheets_writer.stats()
+    bucket = stats['bucket']
+    breaker = sheets_breaker.stats()
+    store_stats = submission_store.stats()
+    index_stats = registration_index.stats()
+    outbound_stats = outbound_limiter.stats()
+    await message.answer(
+        "📥 <b>ОЧЕРЕДЬ ЗАПИСИ В ТАБЛИЦУ</b>\n\n"
+        f"⏳ <b>В очереди:</b> {stats['depth']}\n"
+        f"✅ <b>Записано строк:</b> {stats['rows_written']} ({stats['batches_written']} пачек)\n"
+        f"⚠️ <b>Неудачных попыток:</b> {stats['failed_attempts']}, "
+        f"уже записано при таймауте: {stats['recovered_after_timeout']}\n"
+        f"🚫 <b>Отклонено API:</b> {stats['dead_rows_total']} строк "
+        f"(остаются в базе, в таблицу не повторяются)\n\n"
+        f"📦 <b>Размер пачки:</b> последняя {stats['last_batch_size']}, "
+        f"средняя {stats['avg_batch_size']}, максимум {stats['max_batch_size']}\n"
+        f"⏱ <b>Задержка записи:</b> последняя {stats['last_flush_latency']} с, "
+        f"максимум {stats['max_flush_latency']} с\n"
+        f"🌐 <b>Запрос к API:</b> {stats['last_write_duration']} с\n\n"
+        f"💾 <b>База заявок:</b> записано {store_stats['records_written']} "
+        f"(в среднем {store_stats['avg_commit_size']} за транзакцию), "
+        f"ждут записи {store_stats['pending']}, "
+        f"последняя строка таблицы {store_stats['last_sheet_row']}\n"
+        f"🔁 <b>Повторные регистрации:</b> {index_stats['duplicates']} из {index_stats['lookups']} проверок, "
+        f"новый телефон у прежнего пользователя: {index_stats['new_phone_users']}; "
+        f"в индексе телефонов {index_stats['phones']}, пользователей {index_stats['users']} "
+        f"({index_stats['memory_bytes'] / 1024 / 1024:.1f} МБ)\n"
+        f"📤 <b>Очередь отправки в Telegram:</b> пользователям {outbound_stats['queued'][0]}, "
+        f"админам {outbound_stats['queued'][1]}, рассылка {outbound_stats['queued'][2]}; "
+        f"RetryAfter: {outbound_stats['retry_after_total']}, "
+        f"макс. ожидание {outbound_stats['max_wait']} с\n"
+        f"🪣 <b>Квота:</b> {bucket['rate'] * 60:.0f}/{bucket['max_rate'] * 60:.0f} запросов в минуту, "
+        f"ответов 429: {bucket['throttled_total']}\n"
+        f"{format_breaker_status(breaker)}"
+        f"{await format_workers_status()}",
+        parse_mode="HTML"
+    )
+
+BREAKER_STATUS_TEXT = {
+    STATE_CLOSED: "✅ доступны",
+    STATE_HALF_OPEN: "🔄 пробный запрос",
+    STATE_OPEN: "🔌 недоступны"
+}
+
+def format_breaker_status(breaker: dict) -> str:
+    """Состояние предохранителя Google Таблиц для /queue"""
+    text = (
+        f"🔌 <b>Google Таблицы:</b> {BREAKER_STATUS_TEXT[breaker['state']]}, "
+        f"отключений {breaker['trips_total']}, отклонено запросов {breaker['rejected_total']}"
+    )
+    if breaker['state'] != STATE_CLOSED:
+        text += f"\n⏳ <b>Пробный запрос через:</b> {breaker['retry_after']} с (пауза {breaker['timeout']:.0f} с)"
+    if breaker['last_error'] and breaker['state'] != STATE_CLOSED:
+        text += f"\n⚠️ <b>Ошибка:</b> {html.escape(breaker['last_error'])}"
+    catalog_age = (datetime.now() - city_catalog.loaded_at).total_seconds() if city_catalog.loaded_at else None
+    if catalog_age is not None:
+        text += f"\n🏙 <b>Список городов:</b> версия {city_catalog.version}, загружен {format_duration(catalog_age)} назад"
+    return text
+
+async def format_workers_status() -> str:
+    """Состояние процессов-обработчиков для /queue (пусто при запуске в одном процессе)"""
+    if not shared_state:
+        return ""
+    try:
+        workers = await shared_state.workers()
+    except Exception as e:
+        return f"\n\n⚠️ <b>Процессы:</b> нет данных ({e})"
+    lines = [f"\n\n🧩 <b>Процессы ({WORKERS}):</b>"]
+    for worker_id, info in sorted(workers.items(), key=lambda item: int(item[0])):
+        age = time.time() - info['at']
+        status = "✅" if age < 30 else "⚠️"
+        lines.append(
+            f"{status} #{worker_id}: заявок {info['registrations']}, очередь {info['queue']}, "
+            f"записано {info['rows_written']}, обновлено {age:.0f} с назад"
+        )
+    return "\n".join(lines)
+
+@dp.message(Command("digest"))
+async def cmd_digest(message: types.Message):
+    """Режим дайджеста заявок в канале админов: /digest [on|off|auto]"""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ <b>У вас нет прав администратора.</b>", parse_mode="HTML")
+        return
+    
+    args = message.text.split()[1:] if message.text else []
+    if args:
+        if args[0] not in (MODE_AUTO, MODE_ON, MODE_OFF):
+            await message.answer("❌ <b>Используйте:</b> /digest on, /digest off или /digest auto", parse_mode="HTML")
+            return
+        admin_digest.set_mode(args[0])
+        # При выключении сразу публикуем накопленные заявки
+        if args[0] == MODE_OFF:
+            await admin_digest.flush()
+    
+    stats = admin_digest.stats()
+    await message.answer(
+        "🗂 <b>ДАЙДЖЕСТ КАНАЛА АДМИНОВ</b>\n\n"
+        f"⚙️ <b>Режим:</b> {stats['mode']}\n"
+        f"📌 <b>Сейчас:</b> {'дайджест' if stats['active'] else 'отдельные сообщения'}\n"
+        f"📈 <b>Заявок за минуту:</b> {stats['rate']} (порог {ADMIN_DIGEST_RATE_THRESHOLD})\n"
+        f"⏳ <b>В буфере:</b> {stats['buffered']}\n"
+        f"📨 <b>Отправлено дайджестов:</b> {stats['digests_sent']} ({stats['leads_in_digests']} заявок)",
+        parse_mode="HTML"
+    )
+
+# =====================================================
+# МЕТРИКИ
+# =====================================================
+
+loop_lag_monitor = metrics.LoopLagMonitor()
+
+@metrics.registry.collector
+def collect_queue_metrics():
+    """Глубина очередей и число анкет по состояниям - читаются в момент запроса метрик"""
+    queued = outbound_limiter.queued()
+    metrics.queue_depth.set(sheets_writer.depth, queue="sheets_writer")
+    metrics.queue_depth.set(queued[PRIORITY_USER], queue="telegram_user")
+    metrics.queue_depth.set(queued[PRIORITY_ADMIN], queue="telegram_admin")
+    metrics.queue_depth.set(queued[PRIORITY_BULK], queue="telegram_bulk")
+    metrics.queue_depth.set(submission_store.stats()['pending'], queue="submission_store")
+    metrics.queue_depth.set(len(background_tasks), queue="background_tasks")
+    # Число анкет по состояниям знает только хранилище SQLite (в Redis пришлось бы перебирать ключи)
+    if hasattr(storage, "states_count"):
+        metrics.fsm_states.clear()
+        for state, count in storage.states_count().items():
+            metrics.fsm_states.set(count, state=state)
+
+# Значение метрики для каждого состояния предохранителя
+BREAKER_STATE_VALUES = {STATE_CLOSED: 0, STATE_HALF_OPEN: 1, STATE_OPEN: 2}
+
+@metrics.registry.collector
+def collect_breaker_metrics():
+    metrics.sheets_circuit_state.set(BREAKER_STATE_VALUES[sheets_breaker.state])
+    metrics.sheets_rejected_total.set(sheets_breaker.rejected_total)
+
+@metrics.registry.collector
+def collect_startup_metrics():
+    stats = startup_report.stats()
+    for phase, seconds in stats['phases'].items():
+        metrics.startup_seconds.set(seconds, phase=phase)
+    for phase in ('ready', 'first_update'):
+        if stats[f'{phase}_seconds'] is not None:
+            metrics.startup_seconds.set(stats[f'{phase}_seconds'], phase=phase)
+
+def format_latency(histogram, **labels) -> str:
+    """p50/p95 гистограммы в миллисекундах"""
+    p50 = histogram.quantile(0.5, **labels)
+    p95 = histogram.quantile(0.95, **labels)
+    if p50 is None:
+        return "нет данных"
+    return f"p50 {p50 * 1000:.0f} мс, p95 {p95 * 1000:.0f} мс"
+
+def count_errors(counter, label: str) -> dict:
+    """Сумма ошибок по значению одной метки"""
+    index = counter.label_names.index(label)
+    result = {}
+    for key, value in counter.items():
+        result[key[index]] = result.get(key[index], 0) + value
+    return result
+
+def format_error_classes(counter) -> str:
+    errors = count_errors(counter, "error")
+    return ", ".join(f"{error} ({count:.0f})" for error, count in sorted(errors.items(), key=lambda item: -item[1]))
+
+@dp.message(Command("perf"))
+async def cmd_perf(message: types.Message):
+    """Сводка метрик производительности"""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ <b>У вас нет прав администратора.</b>", parse_mode="HTML")
+        return
+    
+    metrics.registry.collect()
+    handler_errors = count_errors(metrics.handler_errors_total, "handler")
+    handlers_text = "\n".join(
+        f"• {handler}: {count} вызовов, {format_latency(metrics.handler_seconds, handler=handler)}"
+        + (f", ошибок {handler_errors[handler]:.0f}" if handler in handler_errors else "")
+        for (handler,), (count, _) in sorted(metrics.handler_seconds.series().items(), key=lambda item: -item[1][0])
+    ) or "• нет данных"
+    stages_text = "\n".join(
+        f"• {stage} ({result}): {count}, {format_latency(metrics.stage_seconds, stage=stage, result=result)}"
+        for (stage, result), (count, _) in sorted(metrics.stage_seconds.series().items())
+    ) or "• нет данных"
+    sheets_errors = count_errors(metrics.sheets_errors_total, "operation")
+    sheets_text = "\n".join(
+        f"• {operation}: {count}, {format_latency(metrics.sheets_seconds, operation=operation)}"
+        + (f", ошибок {sheets_errors[operation]:.0f}" if operation in sheets_errors else "")
+        for (operation,), (count, _) in sorted(metrics.sheets_seconds.series().items())
+    ) or "• нет данных"
+    api_series = metrics.bot_api_seconds.series()
+    api_calls = sum(count for count, _ in api_series.values())
+    api_methods = sorted(api_series.items(), key=lambda item: -item[1][0])[:5]
+    api_text = "\n".join(
+        f"• {method}: {count}, {format_latency(metrics.bot_api_seconds, method=method)}"
+        for (method,), (count, _) in api_methods
+    ) or "• нет данных"
+    queues_text = ", ".join(
+        f"{queue} {value:.0f}" for (queue,), value in metrics.queue_depth.items()
+    )
+    states = storage.states_count() if hasattr(storage, "states_count") else None
+    states_text = (
+        ", ".join(f"{state.split(':')[-1]} {count}" for state, count in sorted(states.items())) or "нет"
+    ) if states is not None else "нет данных для этого хранилища"
+    lag_p99 = metrics.loop_lag_seconds.quantile(0.99)
+    startup = startup_report.stats()
+    startup_text = f"готов через {startup['ready_seconds']} с" if startup['ready_seconds'] is not None else "идет"
+    if startup['first_update_seconds'] is not None:
+        startup_text += f", первое обновление через {startup['first_update_seconds']} с"
+    slowest = sorted(startup['phases'].items(), key=lambda item: -item[1])[:3]
+    if slowest:
+        startup_text += " (дольше всего: " + ", ".join(f"{phase} {seconds} с" for phase, seconds in slowest) + ")"
+    
+    await message.answer(
+        "⚡️ <b>ПРОИЗВОДИТЕЛЬНОСТЬ</b>\n\n"
+        f"🧭 <b>Обработчики:</b>\n{handlers_text}\n\n"
+        f"🧩 <b>Этапы регистрации:</b>\n{stages_text}\n\n"
+        f"📊 <b>Google Таблицы:</b>\n{sheets_text}\n"
+        f"Ошибки: {format_error_classes(metrics.sheets_errors_total) or 'нет'}\n\n"
+        f"🤖 <b>Bot API:</b> {api_calls} запросов\n{api_text}\n"
+        f"Ошибки: {format_error_classes(metrics.bot_api_errors_total) or 'нет'}\n\n"
+        f"📥 <b>Очереди:</b> {queues_text}\n"
+        f"📝 <b>Анкеты по шагам:</b> {states_text}\n"
+        f"🔄 <b>Задержка цикла событий:</b> сейчас {loop_lag_monitor.last * 1000:.1f} мс, "
+        f"p99 {(lag_p99 or 0) * 1000:.1f} мс, "
+        f"макс. за минуту {metrics.loop_lag_max_seconds.value() * 1000:.1f} мс\n"
+        f"🚀 <b>Запуск:</b> {startup_text}",
+        parse_mode="HTML"
+    )
+
+# =====================================================
+# ПРОФИЛИРОВАНИЕ
+# =====================================================
+
+profiler = Profiler()
+
+# Длительность замера по умолчанию (сек)
+PROFILE_DEFAULT_SECONDS = 30
+
+def parse_profile_args(message: types.Message) -> tuple:
+    """Аргументы команды профилирования: (секунды, остальные аргументы)"""
+    args = message.text.split()[1:] if message.text else []
+    seconds = PROFILE_DEFAULT_SECONDS
+    if args and args[0].isdigit():
+        seconds = int(args.pop(0))
+    return seconds, args
+
+async def run_profile_job(chat_id: int, make_call):
+    """Замер в фоне: обработка остальных обновлений не ждет его окончания"""
+    try:
+        data, filename, caption = await make_call()
+        await bot.send_document(chat_id, BufferedInputFile(data, filename=filename), caption=caption, parse_mode="HTML")
+    except ProfilerBusy as e:
+        await bot.send_message(chat_id, f"❌ <b>{e}</b>", parse_mode="HTML")
+    except Exception as e:
+        logging.error(f"Ошибка профилирования: {e}")
+        await bot.send_message(chat_id, f"❌ <b>Ошибка профилирования:</b> {str(e)}", parse_mode="HTML")
+
+@dp.message(Command("profile"))
+async def cmd_profile(message: types.Message):
+    """Профиль CPU: /profile [секунды] [pstats]"""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ <b>У вас нет прав администратора.</b>", parse_mode="HTML")
+        return
+    
+    if profiler.busy:
+        await message.answer(f"❌ <b>Уже идет замер:</b> {profiler.busy}", parse_mode="HTML")
+        return
+    seconds, args = parse_profile_args(message)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    
+    if args == ["pstats"]:
+        # cProfile замедляет весь код главного потока - только для коротких замеров
+        async def make_call():
+            data = await profiler.profile_cpu(seconds)
+            return data, f"profile-{stamp}.pstats", "📄 Профиль cProfile (python -m pstats, snakeviz)"
+    else:
+        async def make_call():
+            collapsed, samples = await profiler.sample(seconds)
+            return (
+                collapsed.encode("utf-8"), f"profile-{stamp}.collapsed",
+                f"🔥 Стеки за {seconds} с, замеров {samples} "
+                "(flamegraph.pl, speedscope.app)"
+            )
+    
+    spawn_background(run_profile_job(message.chat.id, make_call))
+    await message.answer(f"⏱ <b>Профилирование запущено на {seconds} с</b>", parse_mode="HTML")
+
+@dp.message(Command("memprofile"))
+async def cmd_memprofile(message: types.Message):
+    """Рост памяти за N секунд: /memprofile [секунды]"""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ <b>У вас нет прав администратора.</b>", parse_mode="HTML")
+        return
+    
+    if profiler.busy:
+        await message.answer(f"❌ <b>Уже идет замер:</b> {profiler.busy}", parse_mode="HTML")
+        return
+    seconds, _ = parse_profile_args(message)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    
+    async def make_call():
+        report = await profiler.memory_diff(seconds)
+        return report.encode("utf-8"), f"memory-{stamp}.txt", f"🧠 Рост памяти за {seconds} с (tracemalloc)"
+    
+    spawn_background(run_profile_job(message.chat.id, make_call))
+    await message.answer(f"⏱ <b>Замер памяти запущен на {seconds} с</b>", parse_mode="HTML")
+
+@dp.message(Command("tasks"))
+async def cmd_tasks(message: types.Message):
+    """Стеки всех задач asyncio"""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ <b>У вас нет прав администратора.</b>", parse_mode="HTML")
+        return
+    
+    report = dump_tasks()
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    await message.answer_document(
+        BufferedInputFile(report.encode("utf-8"), filename=f"tasks-{stamp}.txt"),
+        caption=f"🧵 Задач asyncio: {len(asyncio.all_tasks())}"
+    )
+
+# =====================================================
+# ВЫГРУЗКА ЗАЯВОК
+# =====================================================
+
+# Сколько заявок читается из базы за один запрос при выгрузке
+EXPORT_CHUNK_SIZE = 5000
+
+# Одновременно идет одна выгрузка: файлы пишутся на диск и отправляются по частям
+export_lock = asyncio.Lock()
+
+def describe_export_filters(filters: dict) -> str:
+    """Фильтр выгрузки для людей"""
+    parts = []
+    if filters['day_from']:
+        first = datetime.strptime(filters['day_from'], "%Y-%m-%d").strftime("%d.%m.%Y")
+        last = datetime.strptime(filters['day_to'], "%Y-%m-%d").strftime("%d.%m.%Y")
+        parts.append(first if first == last else f"{first} - {last}")
+    if filters['city']:
+        parts.append(html.escape(filters['city']))
+    return ", ".join(parts) or "все заявки"
+
+async def run_export(chat_id: int, filters: dict):
+    """Выгрузка в фоне: заявки читаются порциями, файл пишется в потоке, готовые части сразу отправляются"""
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    started = time.monotonic()
+    description = describe_export_filters(filters)
+    async with export_lock:
+        try:
+            with tempfile.TemporaryDirectory(prefix="export-") as directory:
+                exporter = Exporter(
+                    directory, f"leads-{stamp}", filters['format'], SHEET_HEADERS,
+                    max_rows=EXPORT_MAX_ROWS_PER_FILE, max_bytes=EXPORT_MAX_FILE_MB * 1024 * 1024
+                )
+                
+                sent = 0
+                
+                async def send_parts(paths: list):
+                    nonlocal sent
+                    for path in paths:
+                        sent += 1
+                        await bot.send_document(
+                            chat_id, FSInputFile(path),
+                            caption=f"📄 Заявки ({description}), часть {sent}",
+                            parse_mode="HTML"
+                        )
+                
+                after_id = 0
+                while True:
+                    records = await submission_store.export_rows(
+                        after_id, EXPORT_CHUNK_SIZE,
+                        day_from=filters['day_from'], day_to=filters['day_to'], city=filters['city']
+                    )
+                    if not records:
+                        break
+                    after_id = records[-1]['id']
+                    rows = [record_to_row(record) for record in records]
+                    await send_parts(await asyncio.to_thread(exporter.write, rows))
+                await send_parts(await asyncio.to_thread(exporter.finish))
+        except Exception as e:
+            logging.error(f"Ошибка выгрузки заявок: {e}")
+            await bot.send_message(chat_id, f"❌ <b>Ошибка выгрузки:</b> {html.escape(str(e))}", parse_mode="HTML")
+            return
+    
+    if not exporter.rows_total:
+        await bot.send_message(chat_id, f"📭 <b>Заявок не найдено</b> ({description})", parse_mode="HTML")
+        return
+    await bot.send_message(
+        chat_id,
+        f"✅ <b>Выгрузка готова:</b> {exporter.rows_total} заявок ({description}), "
+        f"файлов {exporter.parts}, {format_duration(time.monotonic() - started)}",
+        parse_mode="HTML"
+    )
+
+@dp.message(Command("export"))
+async def cmd_export(message: types.Message):
+    """Выгрузка заявок: /export [csv|xlsx] [ДД.ММ.ГГГГ[-ДД.ММ.ГГГГ]] [город]"""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ <b>У вас нет прав администратора.</b>", parse_mode="HTML")
+        return
+    
+    try:
+        filters = parse_export_args(message.text.split()[1:] if message.text else [])
+    except ValueError as e:
+        await message.answer(f"❌ <b>{e}</b>", parse_mode="HTML")
+        return
+    if filters['city']:
+        # Город можно написать в любом регистре - берем название из списка городов
+        wanted = filters['city'].casefold()
+        filters['city'] = next((city for city in city_catalog.cities if city.casefold() == wanted), filters['city'])
+    
+    if export_lock.locked():
+        await message.answer("❌ <b>Уже идет другая выгрузка, дождитесь ее окончания.</b>", parse_mode="HTML")
+        return
+    
+    spawn_background(run_export(message.chat.id, filters))
+    await message.answer(
+        f"⏳ <b>Выгрузка запущена</b> ({describe_export_filters(filters)}, {filters['format'].upper()}).\n"
+        "Файлы придут по мере готовности.\n\n"
+        "Формат: /export [csv|xlsx] [ДД.ММ.ГГГГ[-ДД.ММ.ГГГГ]] [город]",
+        parse_mode="HTML"
+    )
+
+# =====================================================
+# РАССЫЛКА
+# =====================================================
+
+# Сколько заявок читается из базы за один запрос при выборке получателей
+BROADCAST_PAGE_SIZE = 1000
+
+async def iter_broadcast_recipients(start: int):
+    """Получатели рассылки: ID пользователей из базы заявок, страницами по BROADCAST_PAGE_SIZE"""
+    # Позиция - номер заявки в базе
+    position = max(start, 1)
+    while True:
+        page = await submission_store.user_ids_from(position, BROADCAST_PAGE_SIZE)
+        for submission_id, user_id in page:
+            yield submission_id, user_id
+        if len(page) < BROADCAST_PAGE_SIZE:
+            return
+        position = page[-1][0] + 1
+
+async def send_broadcast_message(user_id: int, content: dict):
+    """Отправка сообщения рассылки: копия сообщения админа или текст"""
+    if 'message_id' in content:
+        await bot.copy_message(user_id, content['from_chat_id'], content['message_id'])
+    else:
+        await bot.send_message(user_id, content['text'])
+
+def format_duration(seconds: float) -> str:
+    """Длительность для людей: 1 ч 5 мин, 3 мин, 40 с"""
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600} ч {seconds % 3600 // 60} мин"
+    if seconds >= 60:
+        return f"{seconds // 60} мин"
+    return f"{seconds} с"
+
+BROADCAST_STATUS_TEXT = {
+    'running': "идет",
+    'paused': "на паузе",
+    'done': "завершена",
+    'cancelled': "отменена"
+}
+
+def format_broadcast_progress(job: dict, progress: dict) -> str:
+    """Текст с прогрессом рассылки"""
+    total = max(progress['total'], 1)
+    percent = min(100, progress['position'] * 100 // total)
+    eta = format_duration(progress['eta']) if progress['eta'] is not None else "—"
+    return (
+        f"📣 <b>РАССЫЛКА {job['id']}</b>: {BROADCAST_STATUS_TEXT.get(progress['status'], progress['status'])}\n\n"
+        f"📍 <b>Пройдено:</b> {progress['position']} из ~{progress['total']} строк ({percent}%)\n"
+        f"✅ <b>Отправлено:</b> {progress['sent']}\n"
+        f"❌ <b>Ошибок:</b> {progress['failed']}\n"
+        f"🚫 <b>Заблокировали бота:</b> {progress['blocked']}\n"
+        f"⏭ <b>Пропущено (повторы и заблокировавшие):</b> {progress['skipped']}\n"
+        f"⚡️ <b>Скорость:</b> {progress['speed']} строк/с\n"
+        f"⏳ <b>Осталось:</b> {eta}\n\n"
+        f"🕐 <b>Запущена:</b> {job['started_at']}"
+        + (f"\n🏁 <b>Закончена:</b> {job['finished_at']}" if job.get('finished_at') else "")
+    )
+
+async def show_broadcast_progress(job: dict, progress: dict):
+    """Обновление сообщения с прогрессом у админа, запустившего рассылку"""
+    meta = job.get('meta', {})
+    if not meta.get('chat_id'):
+        return
+    try:
+        await bot.edit_message_text(
+            format_broadcast_progress(job, progress),
+            chat_id=meta['chat_id'],
+            message_id=meta['message_id'],
+            parse_mode="HTML"
+        )
+    except TelegramBadRequest as e:
+        if "not modified" not in str(e):
+            raise
+
+# Пользователи, заблокировавшие бота: пропускаются во всех рассылках
+blocked_users = SeenUsers(BLOCKED_USERS_PATH)
+blocked_users.load()
+
+broadcaster = Broadcast(
+    iter_broadcast_recipients,
+    send_broadcast_message,
+    BROADCAST_STATE_PATH,
+    blocked_users,
+    rate=BROADCAST_RATE,
+    concurrency=BROADCAST_CONCURRENCY,
+    on_progress=show_broadcast_progress
+)
+
+@dp.message(Command("broadcast"))
+async def cmd_broadcast(message: types.Message):
+    """Рассылка: /broadcast текст, ответ командой на сообщение, /broadcast status|pause|resume|cancel"""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ <b>У вас нет прав администратора.</b>", parse_mode="HTML")
+        return
+    
+    parts = message.text.split(maxsplit=1) if message.text else []
+    argument = parts[1].strip() if len(parts) > 1 else ""
+    action = argument.lower()
+    
+    try:
+        if action == "pause":
+            await broadcaster.pause()
+            await message.answer("⏸ <b>Рассылка приостановлена.</b> Продолжить: /broadcast resume", parse_mode="HTML")
+            return
+        if action == "resume":
+            broadcaster.resume()
+            await message.answer("▶️ <b>Рассылка продолжена</b>", parse_mode="HTML")
+            return
+        if action == "cancel":
+            await broadcaster.cancel()
+            await message.answer("🛑 <b>Рассылка отменена</b>", parse_mode="HTML")
+            return
+    except BroadcastError as e:
+        await message.answer(f"❌ <b>{e}</b>", parse_mode="HTML")
+        return
+    
+    if message.reply_to_message:
+        # Рассылается копия сообщения, на которое ответил админ (с фото, форматированием и т.д.)
+        content = {'from_chat_id': message.chat.id, 'message_id': message.reply_to_message.message_id}
+    elif argument and action != "status":
+        content = {'text': argument}
+    else:
+        if broadcaster.job:
+            await message.answer(format_broadcast_progress(broadcaster.job, broadcaster.progress()), parse_mode="HTML")
+        await message.answer(
+            "📣 <b>Рассылка</b>\n\n"
+            "• /broadcast текст - разослать текст\n"
+            "• ответ командой /broadcast на сообщение - разослать его копию\n"
+            "• /broadcast status - прогресс\n"
+            "• /broadcast pause, /broadcast resume, /broadcast cancel",
+            parse_mode="HTML"
+        )
+        return
+    
+    if broadcaster.running:
+        await message.answer("❌ <b>Рассылка уже идет.</b> Дождитесь окончания или используйте /broadcast cancel", parse_mode="HTML")
+        return
+    
+    progress_message = await message.answer("📣 <b>Рассылка запускается...</b>", parse_mode="HTML")
+    # Номер последней заявки - граница позиции рассылки для прогресса
+    broadcaster.start(
+        content,
+        total=await submission_store.last_id(),
+        meta={'chat_id': progress_message.chat.id, 'message_id': progress_message.message_id}
+    )
+    logging.info(f"Админ {message.from_user.id} запустил рассылку {broadcaster.job['id']}")
+
 # =====================================================
 # ОБРАБОТЧИК НЕИЗВЕСТНЫХ КОМАНД
 # =====================================================
@@ -744,10 +2181,11 @@ async def callback_start_registration(callback: types.CallbackQuery, state: FSMC
 📍 <b>Для начала выберите ваш город:</b>"""
     )
     
-    # Получаем список городов
-    cities_list, cities_dict = get_cities_and_addresses()
+    # Список городов берем из кэша; если он пуст - пробуем загрузить заново
+    if not city_catalog:
+        await city_catalog.refresh()
     
-    if not cities_list:
+    if not city_catalog:
         await callback.message.edit_text(
             "❌ <b>Ошибка загрузки списка городов.</b>\n"
             "Пожалуйста, попробуйте позже или обратитесь к администратору.",
@@ -755,30 +2193,189 @@ async def callback_start_registration(callback: types.CallbackQuery, state: FSMC
         )
         return
     
-    # Создаем инлайн клавиатуру с городами (по одной кнопке в ряду)
-    keyboard_buttons = []
-    for city in cities_list:
-        keyboard_buttons.append([InlineKeyboardButton(text=city, callback_data=f"city:{city}")])
-    
-    city_keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
-    
-    # Редактируем сообщение с инлайн клавиатурой
-    await callback.message.edit_text(welcome_text, reply_markup=city_keyboard, parse_mode="HTML")
+    # Редактируем сообщение с готовой клавиатурой городов
+    await callback.message.edit_text(
+        welcome_text + city_search_hint(), reply_markup=city_catalog.keyboards.page(0), parse_mode="HTML"
+    )
     await state.set_state(RegistrationForm.waiting_for_city)
 
 # =====================================================
 # ЗАПУСК БОТА
 # =====================================================
 
+def stop_event() -> asyncio.Event:
+    """Событие остановки процесса по SIGTERM/SIGINT"""
+    event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, event.set)
+        except NotImplementedError:
+            pass
+    return event
+
+async def run_webhook():
+    """Прием обновлений через webhook на встроенном HTTP-сервере"""
+    if WORKER_ID is not None:
+        # Процесс-обработчик: обновления присылает супервизор, webhook в Telegram не регистрируем
+        server = WebhookServer(
+            dp, bot, os.environ['BOT_WORKER_PATH'],
+            secret=os.environ['BOT_WORKER_SECRET'], workers=WEBHOOK_WORKERS
+        )
+        host, port = "127.0.0.1", int(os.environ['BOT_WORKER_PORT'])
+    else:
+        server = WebhookServer(dp, bot, WEBHOOK_PATH, secret=WEBHOOK_SECRET, workers=WEBHOOK_WORKERS)
+        host, port = WEBHOOK_HOST, WEBHOOK_PORT
+    metrics.registry.collector(lambda: metrics.queue_depth.set(server.stats()['queued'], queue="webhook"))
+    
+    await dp.emit_startup(bot=bot)
+    await server.start(host, port)
+    try:
+        if WORKER_ID is None:
+            await bot.set_webhook(
+                WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=dp.resolve_used_update_types(),
+                max_connections=min(WEBHOOK_WORKERS, 100)
+            )
+            logging.info(f"Webhook установлен: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+        # Работаем до остановки процесса
+        await stop_event().wait()
+    finally:
+        await server.stop()
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+
+async def run_supervisor():
+    """Запуск WORKERS процессов-обработчиков и раздача им обновлений по user_id"""
+    logging.info(f"Запуск бота в {WORKERS} процессах...")
+    supervisor = Supervisor([sys.executable, os.path.abspath(__file__)], WORKERS, WORKER_BASE_PORT)
+    supervisor.start()
+    router = UpdateRouter(supervisor.worker_urls, supervisor.secret)
+    router.start()
+    
+    allowed_updates = dp.resolve_used_update_types()
+    runner = None
+    try:
+        if RUN_MODE == "webhook":
+            runner = web.AppRunner(router.create_app(WEBHOOK_PATH, WEBHOOK_SECRET), access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+            await bot.set_webhook(
+                WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=allowed_updates,
+                max_connections=100
+            )
+            await stop_event().wait()
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            polling = asyncio.create_task(
+                router.poll(bot.session.api.api_url(bot.token, "getUpdates"), allowed_updates)
+            )
+            await stop_event().wait()
+            polling.cancel()
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+        await router.stop()
+        await supervisor.stop()
+        await bot.session.close()
+
+async def warm_up(polling: bool = False):
+    """Подготовка к приему обновлений
+    
+    Независимые этапы прогрева идут одновременно, поэтому запуск длится
+    как самый долгий из них, а не как их сумма.
+    """
+    # Сохраненный список городов нужен, если таблица сейчас недоступна;
+    # база заявок локальная, без нее бот не запускается
+    city_catalog.load_snapshot()
+    await submission_store.open()
+    startup_report.mark("local_state")
+    
+    await asyncio.gather(
+        startup_report.measure("sheets_auth", sheets_api.warm_up()),
+        startup_report.measure("cities", city_catalog.refresh()),
+        startup_report.measure("sheet_headers", ensure_sheet_headers()),
+        startup_report.measure("submissions", import_and_index_submissions()),
+        startup_report.measure("images", prepare_congratulation_images()),
+        # В режиме polling webhook нужно снять, иначе getUpdates не заработает
+        startup_report.measure("telegram", bot.delete_webhook(drop_pending_updates=True), required=True)
+        if polling else startup_report.measure("telegram", bot.get_me())
+    )
+    startup_report.mark("warm_up")
+    
+    # Запускаем фоновую запись заявок в Google Таблицы и дописываем заявки,
+    # не записанные до перезапуска
+    sheets_writer.start()
+    await startup_report.measure("backlog", replicate_backlog())
+
 async def main():
     """Основная функция запуска бота"""
-    logging.info("Запуск бота...")
+    if WORKERS > 1 and WORKER_ID is None:
+        await run_supervisor()
+        return
+    
+    logging.info("Запуск бота..." if WORKER_ID is None else f"Запуск процесса-обработчика {WORKER_ID}...")
+    startup_report.mark("init")
+    polling = WORKER_ID is None and RUN_MODE != "webhook"
+    
+    # Метрики Prometheus на локальном порту
+    metrics_server = metrics.MetricsServer()
+    if METRICS_PORT:
+        try:
+            await metrics_server.start(METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            logging.error(f"Не удалось запустить сервер метрик: {e}")
+    lag_task = asyncio.create_task(loop_lag_monitor.run())
+    
+    await warm_up(polling)
+    refresh_task = asyncio.create_task(city_catalog.run_refresh_loop())
+    layout_task = asyncio.create_task(run_sheet_layout_check_loop())
+    stats_task = asyncio.create_task(run_stats_check_loop())
     
-    # Удаляем webhook если есть
-    await bot.delete_webhook(drop_pending_updates=True)
+    seen_users_task = asyncio.create_task(run_welcomed_users_snapshot_loop())
     
-    # Запускаем polling
-    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    # Продолжаем рассылку, прерванную перезапуском
+    if broadcaster.load():
+        broadcaster.resume()
+    if shared_state:
+        sync_task = asyncio.create_task(shared_state.run_sync_loop(
+            lambda: {'queue': sheets_writer.depth, 'rows_written': sheets_writer.rows_written,
+                     'registrations': submission_store.stats()['records_written']}
+        ))
+    
+    startup_report.ready()
+    try:
+        if not polling:
+            await run_webhook()
+        else:
+            # Запускаем polling (webhook снят при прогреве)
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        refresh_task.cancel()
+        layout_task.cancel()
+        stats_task.cancel()
+        lag_task.cancel()
+        seen_users_task.cancel()
+        await broadcaster.stop()
+        if shared_state:
+            sync_task.cancel()
+        # Даем фоновым этапам регистрации завершиться
+        if background_tasks:
+            await asyncio.wait(background_tasks, timeout=10)
+        await admin_digest.flush()
+        try:
+            await save_welcomed_users()
+        except Exception as e:
+            logging.error(f"Ошибка сохранения списка пользователей: {e}")
+        await sheets_writer.stop()
+        await submission_store.close()
+        await sheets_api.close()
+        await metrics_server.stop()
+        if shared_state:
+            await shared_state.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
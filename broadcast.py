@@ -0,0 +1,309 @@
+"""
+Массовая рассылка сообщений пользователям.
+
+Получатели читаются из хранилища заявок порциями (recipients - асинхронный
+генератор пар "позиция, user_id"), поэтому рассылка не держит весь список
+в памяти. Отправка идет несколькими задачами с общим ограничением
+скорости и с приоритетом PRIORITY_BULK: ответы регистрирующимся
+пользователям всегда отправляются раньше рассылки.
+
+Прогресс сохраняется на диск (позиция, счетчики, множество уже
+получивших сообщение), поэтому после перезапуска рассылка продолжается
+с места остановки. Пользователи, заблокировавшие бота, запоминаются и
+пропускаются в следующих рассылках.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import datetime
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+
+from ratelimit import TokenBucket
+from seen_users import SeenUsers
+from telegram_sender import PRIORITY_BULK, sending_priority
+
+# Статусы рассылки
+STATUS_RUNNING = "running"
+STATUS_PAUSED = "paused"
+STATUS_DONE = "done"
+STATUS_CANCELLED = "cancelled"
+
+# Ошибки Bad Request, после которых писать пользователю бесполезно
+UNREACHABLE_ERRORS = ("chat not found", "user is deactivated", "bot was blocked", "peer_id_invalid")
+
+
+class BroadcastError(Exception):
+    """Недопустимая операция с рассылкой (например, вторая рассылка одновременно)"""
+
+
+class Broadcast:
+    """Рассылка с ограничением скорости, сохранением прогресса и продолжением после перезапуска"""
+
+    def __init__(self, recipients, send, state_path: str, blocked: SeenUsers,
+                 rate: float = 20, concurrency: int = 8,
+                 checkpoint_interval: float = 5, progress_interval: float = 5, on_progress=None):
+        self._recipients = recipients    # recipients(start) -> асинхронный итератор (позиция, user_id)
+        self._send = send                # корутина send(user_id, content)
+        self.state_path = state_path
+        self.blocked = blocked
+        self.rate = rate
+        self.concurrency = concurrency
+        self.checkpoint_interval = checkpoint_interval
+        self.progress_interval = progress_interval
+        self.on_progress = on_progress   # корутина on_progress(job, progress)
+
+        self.job = None
+        self._done = None       # Получатели, уже обработанные в этой рассылке
+        self._queued = set()    # Получатели в очереди и в процессе отправки
+        self._pending = {}      # {позиция: число неотправленных получателей}
+        self._read_position = 0
+        self._task = None
+        self._run_started = None
+        self._run_start_position = 0
+
+    @property
+    def done_path(self) -> str:
+        return self.state_path + ".done"
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    # ---------------- Управление ----------------
+
+    def start(self, content: dict, total: int, meta: dict = None):
+        """Запуск новой рассылки; content передается в send как есть"""
+        if self.running:
+            raise BroadcastError("Рассылка уже идет")
+        self.job = {
+            'id': uuid.uuid4().hex[:8],
+            'content': content,
+            'meta': meta or {},
+            'status': STATUS_RUNNING,
+            'total': total,
+            'position': 0,
+            'sent': 0,
+            'failed': 0,
+            'blocked': 0,
+            'skipped': 0,
+            'started_at': datetime.now().strftime("%d.%m.%Y %H:%M"),
+            'finished_at': None
+        }
+        # Множество обработанных от прошлой рассылки больше не нужно
+        if os.path.exists(self.done_path):
+            os.remove(self.done_path)
+        self._done = SeenUsers(self.done_path)
+        self._save_state()
+        self._launch()
+
+    def load(self) -> bool:
+        """Загрузка сохраненной рассылки; True - ее нужно продолжить"""
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                self.job = json.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logging.error(f"Ошибка чтения состояния рассылки: {e}")
+            return False
+        return self.job['status'] == STATUS_RUNNING
+
+    def resume(self):
+        """Продолжение рассылки с сохраненной позиции"""
+        if self.running:
+            raise BroadcastError("Рассылка уже идет")
+        if self.job is None or self.job['status'] not in (STATUS_RUNNING, STATUS_PAUSED):
+            raise BroadcastError("Нет рассылки, которую можно продолжить")
+        self.job['status'] = STATUS_RUNNING
+        self._done = SeenUsers(self.done_path)
+        self._done.load()
+        self._launch()
+
+    async def pause(self):
+        """Остановка рассылки с сохранением прогресса"""
+        if not self.running:
+            raise BroadcastError("Рассылка не идет")
+        self.job['status'] = STATUS_PAUSED
+        await self._stop_task()
+
+    async def cancel(self):
+        """Отмена рассылки"""
+        if self.job is None or self.job['status'] not in (STATUS_RUNNING, STATUS_PAUSED):
+            raise BroadcastError("Нет активной рассылки")
+        self.job['status'] = STATUS_CANCELLED
+        self.job['finished_at'] = datetime.now().strftime("%d.%m.%Y %H:%M")
+        if self.running:
+            await self._stop_task()
+        else:
+            self._save_state()
+
+    async def stop(self):
+        """Остановка при выключении бота: рассылка продолжится после запуска"""
+        if self.running:
+            await self._stop_task()
+
+    async def _stop_task(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    def _launch(self):
+        self._queued = set()
+        self._pending = {}
+        self._read_position = self.job['position']
+        self._run_start_position = self.job['position']
+        self._run_started = time.monotonic()
+        self._task = asyncio.create_task(self._run())
+
+    # ---------------- Отправка ----------------
+
+    async def _run(self):
+        queue = asyncio.Queue(maxsize=self.concurrency * 4)
+        bucket = TokenBucket(self.rate, capacity=self.rate)
+        reader = asyncio.create_task(self._read(queue))
+        senders = [asyncio.create_task(self._send_loop(queue, bucket)) for _ in range(self.concurrency)]
+        ticker = asyncio.create_task(self._tick())
+        logging.info(f"Рассылка {self.job['id']} запущена с позиции {self.job['position']}")
+        try:
+            await reader
+            for _ in senders:
+                await queue.put(None)
+            await asyncio.gather(*senders)
+            self.job['status'] = STATUS_DONE
+            self.job['finished_at'] = datetime.now().strftime("%d.%m.%Y %H:%M")
+            logging.info(f"Рассылка {self.job['id']} завершена: {self.progress()}")
+        except Exception as e:
+            # Ошибка чтения получателей: рассылка остановится и будет продолжена вручную
+            logging.error(f"Рассылка {self.job['id']} остановлена из-за ошибки: {e}")
+            self.job['status'] = STATUS_PAUSED
+        finally:
+            for task in [reader, ticker, *senders]:
+                task.cancel()
+            await self._checkpoint()
+            await self._report()
+
+    async def _read(self, queue: asyncio.Queue):
+        async for position, user_id in self._recipients(self.job['position']):
+            self._read_position = position + 1
+            if user_id in self._done or user_id in self._queued or user_id in self.blocked:
+                self.job['skipped'] += 1
+                continue
+            self._queued.add(user_id)
+            self._pending[position] = self._pending.get(position, 0) + 1
+            await queue.put((position, user_id))
+
+    async def _send_loop(self, queue: asyncio.Queue, bucket: TokenBucket):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            position, user_id = item
+            await bucket.acquire()
+            try:
+                with sending_priority(PRIORITY_BULK):
+                    await self._send(user_id, self.job['content'])
+                self.job['sent'] += 1
+            except TelegramForbiddenError:
+                self.blocked.add(user_id)
+                self.job['blocked'] += 1
+            except TelegramBadRequest as e:
+                if any(error in str(e).lower() for error in UNREACHABLE_ERRORS):
+                    self.blocked.add(user_id)
+                    self.job['blocked'] += 1
+                else:
+                    self.job['failed'] += 1
+            except Exception as e:
+                logging.warning(f"Ошибка отправки рассылки пользователю {user_id}: {e}")
+                self.job['failed'] += 1
+
+            self._done.add(user_id)
+            self._queued.discard(user_id)
+            self._pending[position] -= 1
+            if not self._pending[position]:
+                del self._pending[position]
+
+    # ---------------- Прогресс ----------------
+
+    async def _tick(self):
+        last_checkpoint = last_progress = time.monotonic()
+        while True:
+            await asyncio.sleep(1)
+            now = time.monotonic()
+            if now - last_checkpoint >= self.checkpoint_interval:
+                last_checkpoint = now
+                await self._checkpoint()
+            if now - last_progress >= self.progress_interval:
+                last_progress = now
+                await self._report()
+
+    def _position(self) -> int:
+        """Позиция, до которой все получатели обработаны"""
+        return min(self._pending) if self._pending else self._read_position
+
+    async def _checkpoint(self):
+        if self._task is not None:
+            self.job['position'] = self._position()
+        try:
+            # Множество обработанных сохраняется вместе с позицией,
+            # чтобы после перезапуска не отправить сообщение повторно
+            done = (self._done.snapshot(), self._done.version) if self._done is not None and self._done.dirty else None
+            blocked = (self.blocked.snapshot(), self.blocked.version) if self.blocked.dirty else None
+            await asyncio.to_thread(self._write_checkpoint, dict(self.job), done, blocked)
+        except Exception as e:
+            logging.error(f"Ошибка сохранения прогресса рассылки: {e}")
+
+    def _write_checkpoint(self, job: dict, done: tuple, blocked: tuple):
+        """Запись прогресса; done и blocked - (снимок, номер изменения) или None"""
+        if done is not None:
+            self._done.write_snapshot(*done)
+        if blocked is not None:
+            self.blocked.write_snapshot(*blocked)
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(tmp_path, self.state_path)
+
+    def _save_state(self):
+        self._write_checkpoint(dict(self.job), None, None)
+
+    async def _report(self):
+        if self.on_progress is None:
+            return
+        try:
+            await self.on_progress(self.job, self.progress())
+        except Exception as e:
+            logging.warning(f"Ошибка отображения прогресса рассылки: {e}")
+
+    def progress(self) -> dict:
+        """Счетчики рассылки, скорость и оценка оставшегося времени"""
+        if self.job is None:
+            return {}
+        position = self._position() if self.running else self.job['position']
+        processed = self.job['sent'] + self.job['failed'] + self.job['blocked']
+        eta = None
+        speed = 0.0
+        if self.running and self._run_started is not None:
+            elapsed = time.monotonic() - self._run_started
+            advanced = position - self._run_start_position
+            if elapsed > 0 and advanced > 0:
+                speed = advanced / elapsed
+                eta = max(0, self.job['total'] - position) / speed
+        return {
+            'status': self.job['status'],
+            'position': position,
+            'total': self.job['total'],
+            'processed': processed,
+            'sent': self.job['sent'],
+            'failed': self.job['failed'],
+            'blocked': self.job['blocked'],
+            'skipped': self.job['skipped'],
+            'speed': round(speed, 1),
+            'eta': round(eta) if eta is not None else None
+        }
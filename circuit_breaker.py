@@ -0,0 +1,118 @@
+"""
+Предохранитель (circuit breaker) для внешнего API.
+
+Пока API отвечает, предохранитель замкнут и запросы проходят как обычно.
+После failure_threshold сбоев подряд он размыкается: запросы сразу
+получают CircuitOpenError, не дожидаясь таймаута. Через reset_timeout
+секунд пропускается один пробный запрос (полуоткрытое состояние):
+успех замыкает предохранитель, сбой снова размыкает его на вдвое больший
+срок (не больше max_timeout).
+"""
+
+import logging
+import time
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Запрос не выполнялся: предохранитель разомкнут"""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} недоступен, повтор через {retry_after:.0f} с")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Предохранитель с экспоненциальной паузой и пробными запросами"""
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 5.0,
+                 max_timeout: float = 300.0, on_state_change=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_timeout = max_timeout
+        self.on_state_change = on_state_change  # on_state_change(breaker, старое состояние)
+
+        self.state = STATE_CLOSED
+        self.failures = 0               # Сбоев подряд
+        self.timeout = reset_timeout    # Текущий срок размыкания
+        self.opened_at = None
+        self.last_error = None
+        self._probe_started = None
+
+        self.trips_total = 0
+        self.rejected_total = 0
+
+    def _set_state(self, state: str):
+        if state == self.state:
+            return
+        previous, self.state = self.state, state
+        logging.warning(f"Предохранитель {self.name}: {previous} -> {state}")
+        if self.on_state_change is not None:
+            try:
+                self.on_state_change(self, previous)
+            except Exception as e:
+                logging.error(f"Ошибка обработчика смены состояния предохранителя: {e}")
+
+    def retry_after(self) -> float:
+        """Сколько секунд до следующего пробного запроса"""
+        if self.state != STATE_OPEN:
+            return 0.0
+        return max(0.0, self.opened_at + self.timeout - time.monotonic())
+
+    def before_call(self):
+        """Проверка перед запросом; CircuitOpenError - запрос выполнять не нужно"""
+        if self.state == STATE_CLOSED:
+            return
+        now = time.monotonic()
+        if self.state == STATE_OPEN and now >= self.opened_at + self.timeout:
+            self._set_state(STATE_HALF_OPEN)
+            self._probe_started = now
+            return
+        # Пробный запрос уже идет; если он завис дольше срока или отменен - разрешаем еще один
+        if self.state == STATE_HALF_OPEN and (
+                self._probe_started is None or now - self._probe_started >= self.timeout):
+            self._probe_started = now
+            return
+        self.rejected_total += 1
+        raise CircuitOpenError(self.name, self.retry_after() or self.timeout)
+
+    def record_success(self):
+        self.failures = 0
+        if self.state != STATE_CLOSED:
+            self.timeout = self.reset_timeout
+            self._set_state(STATE_CLOSED)
+
+    def release_probe(self):
+        """Запрос отменен без ответа: состояние не меняется, следующий запрос может стать пробным"""
+        if self.state == STATE_HALF_OPEN:
+            self._probe_started = None
+
+    def record_failure(self, error: BaseException):
+        self.failures += 1
+        self.last_error = f"{type(error).__name__}: {error}"[:200]
+        if self.state == STATE_HALF_OPEN:
+            # Пробный запрос не прошел - размыкаем на вдвое больший срок
+            self.timeout = min(self.timeout * 2, self.max_timeout)
+            self._open()
+        elif self.state == STATE_CLOSED and self.failures >= self.failure_threshold:
+            self._open()
+
+    def _open(self):
+        self.opened_at = time.monotonic()
+        self.trips_total += 1
+        self._set_state(STATE_OPEN)
+
+    def stats(self) -> dict:
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'timeout': self.timeout,
+            'retry_after': round(self.retry_after(), 1),
+            'trips_total': self.trips_total,
+            'rejected_total': self.rejected_total,
+            'last_error': self.last_error
+        }
@@ -0,0 +1,142 @@
+"""
+Клавиатуры выбора города.
+
+Клавиатуры строятся один раз для каждой версии списка городов и дальше
+отдаются готовыми. В callback_data кнопки лежит короткий ID города
+("c:{версия}:{id}"), а не название: длинные названия не упираются в лимит
+Telegram 64 байта, а город по нажатию находится в словаре за O(1).
+ID вычисляется из названия, поэтому не меняется между версиями списка,
+перезапусками и процессами.
+
+Большой список делится на страницы с кнопками "назад"/"вперед",
+а город можно найти по первым буквам названия (search).
+"""
+
+import hashlib
+from bisect import bisect_left
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+CITY_PREFIX = "c"
+PAGE_PREFIX = "cp"
+
+_ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def _base36(number: int) -> str:
+    digits = []
+    while True:
+        number, digit = divmod(number, 36)
+        digits.append(_ALPHABET[digit])
+        if not number:
+            return "".join(reversed(digits))
+
+
+def city_id(city: str, salt: int = 0) -> str:
+    """Короткий стабильный ID города (до 8 символов)"""
+    key = city if not salt else f"{city}\x00{salt}"
+    return _base36(int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=5).digest(), "big"))
+
+
+def normalize(text: str) -> str:
+    """Название для поиска: без регистра, "ё" как "е" """
+    return text.strip().casefold().replace("ё", "е")
+
+
+class CityKeyboards:
+    """Готовые клавиатуры выбора города для одной версии списка"""
+
+    def __init__(self, page_size: int = 20):
+        self.page_size = page_size
+        self.version = None
+        self._cities = {}     # {ID: город}
+        self._ids = {}        # {город: ID}
+        self._pages = []      # Готовые клавиатуры по страницам
+        self._search = []     # [(название для поиска, город)] по алфавиту
+
+    def build(self, cities: list, version: int):
+        """Построение клавиатур для новой версии списка городов"""
+        ids, by_id = {}, {}
+        for city in cities:
+            salt = 0
+            identifier = city_id(city)
+            # Совпадение ID разных городов почти невозможно, но обрабатываем его
+            while identifier in by_id:
+                salt += 1
+                identifier = city_id(city, salt)
+            ids[city] = identifier
+            by_id[identifier] = city
+
+        pages = []
+        count = max(1, -(-len(cities) // self.page_size))
+        for page in range(count):
+            chunk = cities[page * self.page_size:(page + 1) * self.page_size]
+            rows = [[self._button(city, ids[city], version)] for city in chunk]
+            if count > 1:
+                rows.append(self._navigation(page, count, version))
+            pages.append(InlineKeyboardMarkup(inline_keyboard=rows))
+
+        self._ids, self._cities, self._pages = ids, by_id, pages
+        self._search = sorted((normalize(city), city) for city in cities)
+        self.version = version
+
+    @staticmethod
+    def _button(city: str, identifier: str, version: int) -> InlineKeyboardButton:
+        return InlineKeyboardButton(text=city, callback_data=f"{CITY_PREFIX}:{version}:{identifier}")
+
+    @staticmethod
+    def _navigation(page: int, count: int, version: int) -> list:
+        row = []
+        if page > 0:
+            row.append(InlineKeyboardButton(text="◀️", callback_data=f"{PAGE_PREFIX}:{version}:{page - 1}"))
+        row.append(InlineKeyboardButton(text=f"{page + 1}/{count}", callback_data=f"{PAGE_PREFIX}:{version}:{page}"))
+        if page < count - 1:
+            row.append(InlineKeyboardButton(text="▶️", callback_data=f"{PAGE_PREFIX}:{version}:{page + 1}"))
+        return row
+
+    @property
+    def page_count(self) -> int:
+        return len(self._pages)
+
+    def page(self, number: int = 0) -> InlineKeyboardMarkup:
+        """Готовая клавиатура страницы (номер вне диапазона - ближайшая страница)"""
+        return self._pages[max(0, min(number, len(self._pages) - 1))]
+
+    def lookup(self, callback_data: str):
+        """Город по callback_data кнопки или None
+
+        Кнопка из прошлой версии списка тоже подходит, если город остался:
+        ID от версии не зависят.
+        """
+        try:
+            _, _, identifier = callback_data.split(":", 2)
+        except ValueError:
+            return None
+        return self._cities.get(identifier)
+
+    def parse_page(self, callback_data: str) -> int:
+        """Номер страницы из callback_data кнопки навигации (0 - для кнопок прошлых версий)"""
+        try:
+            _, version, page = callback_data.split(":", 2)
+            return int(page) if int(version) == self.version else 0
+        except ValueError:
+            return 0
+
+    def search(self, text: str, limit: int = None) -> list:
+        """Города, название которых начинается с text"""
+        prefix = normalize(text)
+        if not prefix:
+            return []
+        limit = limit or self.page_size
+        found = []
+        index = bisect_left(self._search, (prefix,))
+        while index < len(self._search) and self._search[index][0].startswith(prefix) and len(found) < limit:
+            found.append(self._search[index][1])
+            index += 1
+        return found
+
+    def search_keyboard(self, cities: list) -> InlineKeyboardMarkup:
+        """Клавиатура из найденных городов"""
+        return InlineKeyboardMarkup(inline_keyboard=[
+            [self._button(city, self._ids[city], self.version)] for city in cities
+        ])
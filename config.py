@@ -33,3 +33,159 @@ DEFAULT_ADMINS = [7533811917]
 
 # Путь к изображению для поздравления
 CONGRATULATIONS_IMAGE_PATH = "image.png"
+
+# Интервал фонового обновления списка городов (в секундах)
+CITIES_REFRESH_INTERVAL = 300
+
+# Последний загруженный список городов сохраняется на диск: если Google Таблица
+# недоступна при запуске, бот работает с этой копией
+CITIES_SNAPSHOT_PATH = "cities_snapshot.json"
+
+# Городов на одной странице клавиатуры выбора города. Если городов больше,
+# клавиатура делится на страницы, а город можно найти по первым буквам названия
+CITY_KEYBOARD_PAGE_SIZE = 20
+
+# Адрес Google Sheets API (можно заменить на локальный сервер для проверки)
+SHEETS_API_URL = "https://sheets.googleapis.com/v4/spreadsheets"
+
+# Максимум одновременных запросов к Google Таблицам
+SHEETS_MAX_CONCURRENCY = 4
+
+# Таймаут одного запроса к Google Таблицам (в секундах)
+SHEETS_TIMEOUT = 15
+
+# Предохранитель: после SHEETS_BREAKER_FAILURES сбоев подряд (таймауты, ошибки 5xx)
+# запросы к таблице отклоняются сразу. Через SHEETS_BREAKER_RESET_TIMEOUT секунд
+# выполняется пробный запрос; при новом сбое пауза удваивается до SHEETS_BREAKER_MAX_TIMEOUT
+SHEETS_BREAKER_FAILURES = 5
+SHEETS_BREAKER_RESET_TIMEOUT = 5
+SHEETS_BREAKER_MAX_TIMEOUT = 300
+
+# Квота на запись в Google Таблицы (запросов в минуту, лимит Google - 60)
+SHEETS_WRITE_QUOTA_PER_MINUTE = 50
+
+# Заявки пишутся пачками: не больше SHEETS_BATCH_SIZE строк за запрос
+# и не позже чем через SHEETS_BATCH_MAX_DELAY секунд после поступления
+SHEETS_BATCH_SIZE = 50
+SHEETS_BATCH_MAX_DELAY = 2.0
+
+# Основное хранилище заявок: все заявки сначала сохраняются в локальную базу,
+# Google Таблица дописывается из нее в фоне. Сейчас доступно только "sqlite"
+SUBMISSION_STORE = "sqlite"
+
+# Файл базы заявок (общий для всех процессов при WORKERS > 1)
+SUBMISSIONS_DB_PATH = "submissions.sqlite3"
+
+# Окно группировки заявок в одну транзакцию базы (в секундах)
+SUBMISSIONS_COMMIT_DELAY = 0.02
+
+# Повторная регистрация с тем же телефоном (после нормализации) не создает
+# новую заявку: пользователь получает прежний результат. Пользователь Telegram,
+# указавший новый телефон, оставляет новую заявку
+REGISTRATION_DEDUP = True
+
+# Выгрузка заявок (/export): большая выгрузка делится на файлы не больше
+# EXPORT_MAX_ROWS_PER_FILE строк и EXPORT_MAX_FILE_MB МБ (лимит Telegram
+# на отправку файла ботом - 50 МБ)
+EXPORT_MAX_ROWS_PER_FILE = 100000
+EXPORT_MAX_FILE_MB = 45
+
+# Журнал заявок прежних версий бота: незаписанные заявки из него
+# один раз переносятся в базу при запуске
+JOURNAL_PATH = "submissions.journal"
+
+# Интервал фоновой проверки структуры листа с заявками (в секундах)
+SHEET_LAYOUT_CHECK_INTERVAL = 600
+
+# Интервал проверки правок таблицы вне бота: добавленные вручную заявки
+# переносятся в базу и попадают в статистику (в секундах)
+STATS_CHECK_INTERVAL = 900
+
+# Отдельные изображения для поздравления по городам (необязательно)
+# Пример: CITY_IMAGES = {"Тула": "images/tula.png"}
+CITY_IMAGES = {}
+
+# Файл для хранения file_id загруженных в Telegram изображений
+PHOTO_CACHE_PATH = "photo_cache.json"
+
+# Ограничения частоты отправки сообщений (лимиты Telegram)
+TELEGRAM_GLOBAL_RATE = 30  # сообщений в секунду для всего бота
+TELEGRAM_PRIVATE_CHAT_RATE = 1  # сообщений в секунду в один личный чат
+TELEGRAM_GROUP_CHAT_RATE_PER_MINUTE = 20  # сообщений в минуту в одну группу или канал
+
+# Дайджест заявок в канале админов при всплеске заявок
+# auto - включается сам при ADMIN_DIGEST_RATE_THRESHOLD заявок в минуту
+# и выключается, когда их становится не больше ADMIN_DIGEST_QUIET_THRESHOLD;
+# on - всегда дайджест; off - всегда отдельные сообщения
+ADMIN_DIGEST_MODE = "auto"
+ADMIN_DIGEST_RATE_THRESHOLD = 10
+ADMIN_DIGEST_QUIET_THRESHOLD = 3
+
+# Дайджест публикуется раз в ADMIN_DIGEST_INTERVAL секунд
+# или сразу при наборе ADMIN_DIGEST_MAX_LEADS заявок
+ADMIN_DIGEST_INTERVAL = 60
+ADMIN_DIGEST_MAX_LEADS = 30
+
+# Хранилище незавершенных анкет (состояний FSM):
+# memory - в памяти (теряются при перезапуске),
+# sqlite - файл FSM_SQLITE_PATH (один процесс),
+# redis - сервер FSM_REDIS_URL (несколько процессов)
+FSM_STORAGE = "sqlite"
+FSM_SQLITE_PATH = "fsm.sqlite3"
+FSM_REDIS_URL = "redis://localhost:6379/0"
+
+# Брошенные анкеты удаляются через FSM_DRAFT_TTL секунд после последнего действия
+FSM_DRAFT_TTL = 86400
+
+# Способ получения обновлений от Telegram:
+# polling - бот сам запрашивает обновления (по умолчанию),
+# webhook - Telegram присылает обновления на встроенный HTTP-сервер
+RUN_MODE = "polling"
+
+# Настройки webhook: публичный адрес (https), путь и секретный токен,
+# которым Telegram подписывает запросы
+WEBHOOK_URL = ""
+WEBHOOK_PATH = "/telegram/webhook"
+WEBHOOK_SECRET = ""
+
+# Адрес и порт встроенного HTTP-сервера; проверка работоспособности - GET /healthz
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8080
+
+# Сколько обновлений обрабатывается одновременно
+# (обновления одного пользователя всегда обрабатываются по порядку)
+WEBHOOK_WORKERS = 32
+
+# Число процессов-обработчиков. При WORKERS > 1 bot.py запускает супервизор:
+# он получает обновления от Telegram и раздает их процессам по user_id
+# (все сообщения одного пользователя обрабатывает один процесс).
+# Процессы принимают обновления на портах WORKER_BASE_PORT, WORKER_BASE_PORT + 1, ...
+# Список городов и статистика общие через Redis (SHARED_REDIS_URL).
+WORKERS = 1
+WORKER_BASE_PORT = 8100
+SHARED_REDIS_URL = "redis://localhost:6379/0"
+
+# Пользователи, которые уже получили приветствие, хранятся в компактном
+# множестве (около 12 МБ на миллион пользователей против ~60 МБ у set),
+# сохраняются в SEEN_USERS_PATH каждые SEEN_USERS_SNAPSHOT_INTERVAL секунд
+# и загружаются при запуске. При превышении SEEN_USERS_MAX_MB самые давние
+# записи забываются - эти пользователи получат приветствие повторно
+SEEN_USERS_PATH = "seen_users.bin"
+SEEN_USERS_MAX_MB = 64
+SEEN_USERS_SNAPSHOT_INTERVAL = 60
+
+# Рассылка (/broadcast): прогресс сохраняется в BROADCAST_STATE_PATH, и после
+# перезапуска рассылка продолжается; пользователи, заблокировавшие бота,
+# запоминаются в BLOCKED_USERS_PATH и пропускаются.
+# Рассылка идет не быстрее BROADCAST_RATE сообщений в секунду и всегда
+# уступает очередь ответам регистрирующимся пользователям
+BROADCAST_STATE_PATH = "broadcast.json"
+BLOCKED_USERS_PATH = "blocked_users.bin"
+BROADCAST_RATE = 20
+BROADCAST_CONCURRENCY = 8
+
+# HTTP-сервер с метриками в формате Prometheus: http://METRICS_HOST:METRICS_PORT/metrics
+# (0 - не запускать). Процессы-обработчики при WORKERS > 1 используют
+# следующие порты: METRICS_PORT + 1, METRICS_PORT + 2, ...
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464
@@ -0,0 +1,224 @@
+"""
+Выгрузка заявок в CSV и XLSX.
+
+Заявки читаются из базы порциями и дописываются в файл на диске, поэтому
+память не зависит от числа строк. XLSX собирается без сторонних библиотек:
+это zip-архив из нескольких XML-файлов, и лист пишется потоком прямо в
+архив (текст - inline-строками, без общей таблицы строк). Когда файл
+набирает max_rows строк или max_bytes байт, он закрывается и начинается
+следующая часть.
+
+Методы Exporter синхронные и вызываются в отдельном потоке.
+"""
+
+import csv
+import os
+import re
+import zipfile
+from datetime import datetime
+from xml.sax.saxutils import escape
+
+FORMATS = ("csv", "xlsx")
+
+_DATE_RANGE_RE = re.compile(r"^(\d{2}\.\d{2}\.\d{4})(?:-(\d{2}\.\d{2}\.\d{4}))?$")
+# Управляющие символы, недопустимые в XML
+_INVALID_XML_RE = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+# Начало ячейки, с которого Excel читает формулу
+_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+# Телефон или число: формулой не является, оставляется как есть (+79161234567)
+_PHONE_RE = re.compile(r"^\+?\d[\d\s()-]*$")
+
+
+def csv_safe(value):
+    """Значение ячейки CSV, которое Excel не выполнит как формулу (имя из анкеты - ввод пользователя)"""
+    if isinstance(value, str) and value.startswith(_FORMULA_PREFIXES) and not _PHONE_RE.match(value):
+        return "'" + value
+    return value
+
+
+def parse_export_args(args: list) -> dict:
+    """Аргументы /export: [csv|xlsx] [ДД.ММ.ГГГГ[-ДД.ММ.ГГГГ]] [город]
+
+    Возвращает {'format', 'day_from', 'day_to', 'city'}; дни - в формате базы (ГГГГ-ММ-ДД).
+    ValueError - с текстом для админа.
+    """
+    args = list(args)
+    result = {'format': "xlsx", 'day_from': None, 'day_to': None, 'city': None}
+    if args and args[0].lower() in FORMATS:
+        result['format'] = args.pop(0).lower()
+    if args:
+        match = _DATE_RANGE_RE.match(args[0])
+        if match:
+            args.pop(0)
+            try:
+                first = datetime.strptime(match.group(1), "%d.%m.%Y")
+                last = datetime.strptime(match.group(2) or match.group(1), "%d.%m.%Y")
+            except ValueError:
+                raise ValueError("Неверная дата, нужен формат ДД.ММ.ГГГГ")
+            if last < first:
+                raise ValueError("Конец периода раньше начала")
+            result['day_from'] = first.strftime("%Y-%m-%d")
+            result['day_to'] = last.strftime("%Y-%m-%d")
+    if args:
+        result['city'] = " ".join(args)
+    return result
+
+
+class CSVWriter:
+    """CSV для Excel: UTF-8 с BOM, разделитель ";" """
+
+    extension = "csv"
+
+    def __init__(self, path: str, headers: list):
+        self._file = open(path, "w", encoding="utf-8-sig", newline="")
+        self._writer = csv.writer(self._file, delimiter=";")
+        self._writer.writerow(headers)
+
+    def write_rows(self, rows: list):
+        self._writer.writerows([csv_safe(value) for value in row] for row in rows)
+
+    @property
+    def size(self) -> int:
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+
+_CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>
+<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>
+</Types>"""
+
+_ROOT_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>"""
+
+_WORKBOOK = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets><sheet name="Заявки" sheetId="1" r:id="rId1"/></sheets>
+</workbook>"""
+
+_WORKBOOK_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>
+<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>
+</Relationships>"""
+
+# Стиль 1 - жирный шрифт для строки заголовков
+_STYLES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font><font><b/><sz val="11"/><name val="Calibri"/></font></fonts>
+<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>
+<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>
+<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>
+<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/><xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/></cellXfs>
+</styleSheet>"""
+
+_SHEET_START = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<sheetViews><sheetView workbookViewId="0"><pane ySplit="1" topLeftCell="A2" state="frozen"/></sheetView></sheetViews>'
+    '<sheetData>'
+)
+_SHEET_END = "</sheetData></worksheet>"
+
+
+def _cell(value, style: str = "") -> str:
+    if isinstance(value, int) and not isinstance(value, bool):
+        return f"<c{style}><v>{value}</v></c>"
+    text = escape(_INVALID_XML_RE.sub("", "" if value is None else str(value)))
+    return f'<c t="inlineStr"{style}><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+class XLSXWriter:
+    """Книга XLSX с одним листом, который пишется в архив потоком"""
+
+    extension = "xlsx"
+
+    def __init__(self, path: str, headers: list):
+        self._file = open(path, "wb")
+        self._zip = zipfile.ZipFile(self._file, "w", compression=zipfile.ZIP_DEFLATED)
+        # Пока лист открыт на запись, другие файлы в архив добавлять нельзя - пишем их сразу
+        self._zip.writestr("[Content_Types].xml", _CONTENT_TYPES)
+        self._zip.writestr("_rels/.rels", _ROOT_RELS)
+        self._zip.writestr("xl/workbook.xml", _WORKBOOK)
+        self._zip.writestr("xl/_rels/workbook.xml.rels", _WORKBOOK_RELS)
+        self._zip.writestr("xl/styles.xml", _STYLES)
+        self._sheet = self._zip.open("xl/worksheets/sheet1.xml", "w", force_zip64=True)
+        self._sheet.write(_SHEET_START.encode("utf-8"))
+        self._sheet.write(("<row>" + "".join(_cell(header, ' s="1"') for header in headers) + "</row>").encode("utf-8"))
+
+    def write_rows(self, rows: list):
+        self._sheet.write("".join(
+            "<row>" + "".join(_cell(value) for value in row) + "</row>" for row in rows
+        ).encode("utf-8"))
+
+    @property
+    def size(self) -> int:
+        # Сжатые данные, уже записанные в файл (без буфера архиватора)
+        return self._file.tell()
+
+    def close(self):
+        self._sheet.write(_SHEET_END.encode("utf-8"))
+        self._sheet.close()
+        self._zip.close()
+        self._file.close()
+
+
+WRITERS = {writer.extension: writer for writer in (CSVWriter, XLSXWriter)}
+
+
+class Exporter:
+    """Выгрузка в один или несколько файлов в папке directory"""
+
+    def __init__(self, directory: str, basename: str, file_format: str, headers: list,
+                 max_rows: int = 100000, max_bytes: int = 45 * 1024 * 1024):
+        self.directory = directory
+        self.basename = basename
+        self.writer_class = WRITERS[file_format]
+        self.headers = headers
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+
+        self.parts = 0
+        self.rows_total = 0
+        self._writer = None
+        self._path = None
+        self._rows = 0
+
+    def _open(self):
+        self.parts += 1
+        suffix = f"-{self.parts}" if self.parts > 1 else ""
+        self._path = os.path.join(self.directory, f"{self.basename}{suffix}.{self.writer_class.extension}")
+        self._writer = self.writer_class(self._path, self.headers)
+        self._rows = 0
+
+    def _close(self) -> str:
+        self._writer.close()
+        self._writer = None
+        return self._path
+
+    def write(self, rows: list) -> list:
+        """Запись порции строк; возвращает пути частей, закрытых при этой записи"""
+        finished = []
+        while rows:
+            if self._writer is None:
+                self._open()
+            take = rows[:self.max_rows - self._rows]
+            self._writer.write_rows(take)
+            self._rows += len(take)
+            self.rows_total += len(take)
+            rows = rows[len(take):]
+            if self._rows >= self.max_rows or self._writer.size >= self.max_bytes:
+                finished.append(self._close())
+        return finished
+
+    def finish(self) -> list:
+        """Закрытие последней части; возвращает ее путь (пустой список, если она не начата)"""
+        return [self._close()] if self._writer is not None else []
@@ -0,0 +1,400 @@
+"""
+Постоянные хранилища состояний FSM для aiogram.
+
+SQLiteStorage - для одного процесса: состояния держатся в памяти,
+изменения пачками записываются в файл SQLite и загружаются при запуске.
+RedisStorage - для нескольких процессов: состояния хранятся в Redis
+(или любом сервере с протоколом Redis), запись идет пачками (pipeline).
+
+В обоих хранилищах состояние и данные пользователя лежат под одним
+коротким ключем "chat_id:user_id", а брошенные анкеты удаляются через ttl
+секунд после последнего изменения.
+"""
+
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from urllib.parse import urlparse
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import DEFAULT_DESTINY, BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage
+
+
+def compact_key(key) -> str:
+    """Короткий ключ записи: chat_id:user_id (плюс поток и destiny, если они заданы)"""
+    parts = [str(key.chat_id), str(key.user_id)]
+    if key.thread_id:
+        parts.append(f"t{key.thread_id}")
+    if key.business_connection_id:
+        parts.append(f"b{key.business_connection_id}")
+    if key.destiny != DEFAULT_DESTINY:
+        parts.append(key.destiny)
+    return ":".join(parts)
+
+
+def state_name(state):
+    return state.state if isinstance(state, State) else state
+
+
+# =====================================================
+# SQLITE
+# =====================================================
+
+class SQLiteStorage(BaseStorage):
+    """Хранилище FSM в памяти с пакетной записью в SQLite"""
+
+    def __init__(self, path: str, ttl: float = 86400, flush_interval: float = 0.5):
+        self.path = path
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+
+        self._records = {}  # {ключ: [состояние, данные, время изменения]}
+        self._dirty = set()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS fsm ("
+            "k TEXT PRIMARY KEY, s TEXT, d TEXT, t REAL) WITHOUT ROWID"
+        )
+        self._db.commit()
+        self._load()
+        self._task = None
+        self._stopping = asyncio.Event()
+
+        self.flushes = 0
+        self.rows_flushed = 0
+
+    def _load(self):
+        cutoff = time.time() - self.ttl
+        self._db.execute("DELETE FROM fsm WHERE t < ?", (cutoff,))
+        self._db.commit()
+        for k, s, d, t in self._db.execute("SELECT k, s, d, t FROM fsm"):
+            self._records[k] = [s, json.loads(d) if d else {}, t]
+        logging.info(f"Загружено незавершенных анкет из {self.path}: {len(self._records)}")
+
+    def _touch(self, k: str) -> list:
+        record = self._get(k)
+        if record is None:
+            record = self._records[k] = [None, {}, 0]
+        record[2] = time.time()
+        self._dirty.add(k)
+        self._ensure_flusher()
+        return record
+
+    def _get(self, k: str):
+        record = self._records.get(k)
+        if record is not None and record[2] < time.time() - self.ttl:
+            # Анкета брошена слишком давно - считаем, что ее нет
+            del self._records[k]
+            self._dirty.add(k)
+            return None
+        return record
+
+    def _ensure_flusher(self):
+        if (self._task is None or self._task.done()) and not self._stopping.is_set():
+            self._task = asyncio.create_task(self._run())
+
+    async def set_state(self, key, state=None) -> None:
+        self._touch(compact_key(key))[0] = state_name(state)
+
+    async def get_state(self, key):
+        record = self._get(compact_key(key))
+        return record[0] if record else None
+
+    async def set_data(self, key, data) -> None:
+        self._touch(compact_key(key))[1] = dict(data)
+
+    async def get_data(self, key):
+        record = self._get(compact_key(key))
+        return dict(record[1]) if record else {}
+
+    async def _run(self):
+        # Цикл не отменяется, а останавливается по _stopping: отмена прервала бы
+        # ожидание записи, а поток с транзакцией продолжил бы работать с базой
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+            self._purge_expired()
+
+    def _purge_expired(self):
+        cutoff = time.time() - self.ttl
+        for k in [k for k, record in self._records.items() if record[2] < cutoff]:
+            del self._records[k]
+            self._dirty.add(k)
+
+    async def flush(self):
+        """Запись накопленных изменений одной транзакцией"""
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        upserts = []
+        deletes = []
+        for k in dirty:
+            record = self._records.get(k)
+            if record is None or (record[0] is None and not record[1]):
+                # Пустые записи (после state.clear()) не храним
+                self._records.pop(k, None)
+                deletes.append((k,))
+            else:
+                upserts.append((k, record[0], json.dumps(record[1], ensure_ascii=False), record[2]))
+        try:
+            await asyncio.to_thread(self._write, upserts, deletes)
+        except Exception as e:
+            logging.error(f"Ошибка записи состояний FSM в SQLite: {e}")
+            self._dirty |= dirty
+            return
+        self.flushes += 1
+        self.rows_flushed += len(upserts) + len(deletes)
+
+    def _write(self, upserts: list, deletes: list):
+        with self._db:
+            if upserts:
+                self._db.executemany(
+                    "INSERT INTO fsm (k, s, d, t) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(k) DO UPDATE SET s = excluded.s, d = excluded.d, t = excluded.t",
+                    upserts
+                )
+            if deletes:
+                self._db.executemany("DELETE FROM fsm WHERE k = ?", deletes)
+
+    def states_count(self) -> dict:
+        """Число пользователей в каждом состоянии"""
+        counts = {}
+        for state, _, _ in self._records.values():
+            if state:
+                counts[state] = counts.get(state, 0) + 1
+        return counts
+
+    async def close(self) -> None:
+        self._stopping.set()
+        if self._task is not None:
+            # Дожидаемся текущей записи - база закрывается только после нее
+            await self._task
+        await self.flush()
+        await asyncio.to_thread(self._db.close)
+
+
+# =====================================================
+# REDIS
+# =====================================================
+
+class RedisError(Exception):
+    """Ошибка, которую вернул сервер Redis"""
+
+
+class RedisConnection:
+    """Минимальный клиент протокола Redis (RESP) поверх asyncio"""
+
+    def __init__(self, url: str):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            await self._roundtrip([["AUTH", self.password]])
+        if self.db:
+            await self._roundtrip([["SELECT", str(self.db)]])
+
+    @staticmethod
+    def _encode(command: list) -> bytes:
+        out = [f"*{len(command)}\r\n".encode()]
+        for arg in command:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            out.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+        return b"".join(out)
+
+    async def _read_reply(self):
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("Соединение с Redis закрыто")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            raise RedisError(payload.decode())
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length == -1:
+                return None
+            data = await self._reader.readexactly(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            count = int(payload)
+            if count == -1:
+                return None
+            return [await self._read_reply() for _ in range(count)]
+        raise RedisError(f"Неизвестный ответ Redis: {line!r}")
+
+    async def _roundtrip(self, commands: list) -> list:
+        self._writer.write(b"".join(self._encode(command) for command in commands))
+        await self._writer.drain()
+        replies = []
+        for _ in commands:
+            try:
+                replies.append(await self._read_reply())
+            except RedisError as e:
+                replies.append(e)
+        return replies
+
+    async def pipeline(self, commands: list) -> list:
+        """Отправка нескольких команд одним пакетом; при обрыве - одно переподключение"""
+        async with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._writer is None:
+                        await self._connect()
+                    return await self._roundtrip(commands)
+                except (ConnectionError, OSError, asyncio.IncompleteReadError):
+                    self._writer = None
+                    if attempt:
+                        raise
+
+    async def execute(self, *command):
+        reply = (await self.pipeline([list(command)]))[0]
+        if isinstance(reply, RedisError):
+            raise reply
+        return reply
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+class RedisStorage(BaseStorage):
+    """Хранилище FSM в Redis для нескольких процессов с пакетной записью"""
+
+    def __init__(self, url: str, ttl: float = 86400, prefix: str = "f:", flush_interval: float = 0.005,
+                 max_retry_delay: float = 30.0):
+        self.redis = RedisConnection(url)
+        self.ttl = int(ttl)
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self.max_retry_delay = max_retry_delay
+        self._retry_delay = 0.0
+
+        self._pending = {}   # {ключ: [состояние, данные]} - изменения, ждущие отправки
+        self._inflight = {}  # изменения, которые отправляются прямо сейчас
+        self._batch = None   # future текущей пачки изменений
+
+        self.flushes = 0
+        self.keys_flushed = 0
+
+    async def _load(self, k: str) -> list:
+        # Сначала смотрим еще не записанные изменения, чтобы читать свои же записи
+        record = self._pending.get(k) or self._inflight.get(k)
+        if record is not None:
+            return record
+        raw = await self.redis.execute("GET", self.prefix + k)
+        if raw is None:
+            return [None, {}]
+        value = json.loads(raw)
+        return [value.get("s"), value.get("d", {})]
+
+    async def _update(self, k: str, index: int, value):
+        record = list(await self._load(k))
+        record[index] = value
+        self._pending[k] = record
+
+        # Изменения за flush_interval уходят в Redis одним пакетом;
+        # обработчик продолжает работу, когда его пачка записана
+        if self._batch is None:
+            self._schedule_flush(self.flush_interval)
+        await asyncio.shield(self._batch)
+
+    def _schedule_flush(self, delay: float):
+        batch = self._batch = asyncio.get_running_loop().create_future()
+        # Ошибку пачки может никто не ждать (обработчик уже отменен) - забираем ее сами
+        batch.add_done_callback(lambda future: future.cancelled() or future.exception())
+        asyncio.create_task(self._delayed_flush(batch, delay))
+
+    async def _delayed_flush(self, batch, delay: float):
+        await asyncio.sleep(delay)
+        # Изменения, пришедшие во время записи, попадут в следующую пачку
+        self._batch = None
+        try:
+            await self.flush()
+        except Exception as e:
+            batch.set_exception(e)
+            # Изменения вернулись в _pending - повторяем запись с растущей паузой,
+            # не дожидаясь следующего изменения
+            self._retry_delay = min(max(self._retry_delay * 2, self.flush_interval, 0.5), self.max_retry_delay)
+            logging.error(f"Ошибка записи состояний FSM в Redis: {e}, повтор через {self._retry_delay:.1f} с")
+            if self._pending and self._batch is None:
+                self._schedule_flush(self._retry_delay)
+            return
+        self._retry_delay = 0.0
+        batch.set_result(None)
+
+    async def flush(self):
+        """Запись накопленных изменений одним pipeline"""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        self._inflight.update(pending)
+        commands = []
+        for k, (state, data) in pending.items():
+            if state is None and not data:
+                commands.append(["DEL", self.prefix + k])
+            else:
+                value = json.dumps({"s": state, "d": data}, ensure_ascii=False, separators=(",", ":"))
+                commands.append(["SET", self.prefix + k, value, "EX", self.ttl])
+        try:
+            replies = await self.redis.pipeline(commands)
+            for reply in replies:
+                if isinstance(reply, RedisError):
+                    raise reply
+        except Exception:
+            # Возвращаем изменения, чтобы не потерять их (более новые значения важнее)
+            for k, record in pending.items():
+                self._pending.setdefault(k, record)
+            raise
+        finally:
+            for k, record in pending.items():
+                if self._inflight.get(k) is record:
+                    del self._inflight[k]
+        self.flushes += 1
+        self.keys_flushed += len(commands)
+
+    async def set_state(self, key, state=None) -> None:
+        await self._update(compact_key(key), 0, state_name(state))
+
+    async def get_state(self, key):
+        return (await self._load(compact_key(key)))[0]
+
+    async def set_data(self, key, data) -> None:
+        await self._update(compact_key(key), 1, dict(data))
+
+    async def get_data(self, key):
+        return dict((await self._load(compact_key(key)))[1])
+
+    async def close(self) -> None:
+        try:
+            await self.flush()
+        finally:
+            await self.redis.close()
+
+
+def create_storage(kind: str, sqlite_path: str = "fsm.sqlite3", redis_url: str = None, ttl: float = 86400):
+    """Создание хранилища FSM по названию из настроек: memory, sqlite или redis"""
+    if kind == "sqlite":
+        return SQLiteStorage(sqlite_path, ttl=ttl)
+    if kind == "redis":
+        return RedisStorage(redis_url, ttl=ttl)
+    return MemoryStorage()
@@ -0,0 +1,201 @@
+"""
+Локальный журнал заявок.
+
+Каждая заявка сначала дописывается в файл (одна JSON-строка на заявку)
+и только потом отправляется в Google Таблицу. Запись на диск группируется:
+несколько заявок, пришедших почти одновременно, сбрасываются одним fsync.
+Номер последней заявки, подтвержденной таблицей, хранится в отдельном
+файле, поэтому после перезапуска повторно отправляются только
+неподтвержденные заявки.
+
+Заявки теперь хранятся в базе (см. submissions.py); журнал читается
+только при переносе незаписанных заявок из прежних версий бота.
+"""
+
+import asyncio
+import json
+import logging
+import os
+
+
+class SubmissionJournal:
+    """Журнал заявок только на дозапись с пакетным fsync"""
+
+    def __init__(self, path: str, fsync_delay: float = 0.02, fsync_batch: int = 256):
+        self.path = path
+        self.ack_path = path + ".ack"
+        self.fsync_delay = fsync_delay
+        self.fsync_batch = fsync_batch
+
+        self.last_seq = 0      # Номер последней записанной заявки
+        self.acked_seq = 0     # Номер последней заявки, записанной в таблицу
+        self.last_row = None   # Номер строки таблицы, куда попала эта заявка
+
+        self._file = None
+        self._pending = []
+        self._ack_dirty = False
+        self._wakeup = None
+        self._task = None
+
+        self.fsyncs = 0
+        self.records_synced = 0
+
+    # -------------------------------------------------
+    # Открытие и чтение
+    # -------------------------------------------------
+
+    def open(self):
+        """Открытие журнала и восстановление состояния после перезапуска"""
+        try:
+            with open(self.ack_path, "r", encoding="utf-8") as f:
+                ack = json.load(f)
+            self.acked_seq = ack.get("acked_seq", 0)
+            self.last_row = ack.get("last_row")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.error(f"Ошибка чтения подтверждений журнала: {e}")
+
+        valid_size = 0
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Недописанная строка после аварийной остановки
+                        logging.warning("В журнале найдена поврежденная строка, она будет отброшена")
+                        break
+                    self.last_seq = record["seq"]
+                    valid_size += len(line)
+            os.truncate(self.path, valid_size)
+
+        self._file = open(self.path, "ab")
+        logging.info(
+            f"Журнал заявок открыт: записей {self.last_seq}, "
+            f"не подтверждено таблицей {self.last_seq - self.acked_seq}"
+        )
+
+    def iter_records(self, after_seq: int = 0):
+        """Чтение заявок из журнала (потоково, без загрузки файла целиком)"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if record["seq"] > after_seq:
+                    yield record
+
+    def unacked_records(self) -> list:
+        """Заявки, которые еще не подтверждены таблицей"""
+        return list(self.iter_records(self.acked_seq))
+
+    # -------------------------------------------------
+    # Запись
+    # -------------------------------------------------
+
+    def start(self):
+        """Запуск фоновой задачи сброса на диск"""
+        if self._file is None:
+            self.open()
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def append(self, record: dict) -> dict:
+        """Запись заявки в журнал; возвращает управление после fsync"""
+        self.start()
+        self.last_seq += 1
+        record = {"seq": self.last_seq, **record}
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((line, future))
+        self._wakeup.set()
+        await future
+        return record
+
+    def ack(self, seq: int, last_row: int = None):
+        """Отметка, что заявки до seq включительно записаны в таблицу"""
+        if seq <= self.acked_seq:
+            return
+        self.acked_seq = seq
+        if last_row is not None:
+            self.last_row = last_row
+        self._ack_dirty = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def run(self):
+        """Групповая запись на диск: один fsync на несколько заявок"""
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            # Даем соседним заявкам попасть в ту же группу
+            if 0 < len(self._pending) < self.fsync_batch:
+                await asyncio.sleep(self.fsync_delay)
+
+            pending, self._pending = self._pending, []
+            ack_state = None
+            if self._ack_dirty:
+                self._ack_dirty = False
+                ack_state = {"acked_seq": self.acked_seq, "last_row": self.last_row}
+
+            try:
+                await asyncio.to_thread(self._sync, [line for line, _ in pending], ack_state)
+            except Exception as e:
+                logging.error(f"Ошибка записи журнала заявок: {e}")
+                for _, future in pending:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for _, future in pending:
+                if not future.done():
+                    future.set_result(None)
+
+    def _sync(self, lines: list, ack_state: dict):
+        if lines:
+            self._file.write(b"".join(lines))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.fsyncs += 1
+            self.records_synced += len(lines)
+
+        if ack_state is not None:
+            tmp_path = self.ack_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(ack_state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.ack_path)
+
+    async def stop(self):
+        """Сброс оставшихся данных и остановка"""
+        if self._task is not None:
+            self._task.cancel()
+        pending, self._pending = self._pending, []
+        ack_state = {"acked_seq": self.acked_seq, "last_row": self.last_row} if self._ack_dirty else None
+        self._sync([line for line, _ in pending], ack_state)
+        for _, future in pending:
+            if not future.done():
+                future.set_result(None)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def stats(self) -> dict:
+        """Состояние журнала"""
+        return {
+            'last_seq': self.last_seq,
+            'acked_seq': self.acked_seq,
+            'unacked': self.last_seq - self.acked_seq,
+            'fsyncs': self.fsyncs,
+            'avg_fsync_batch': round(self.records_synced / self.fsyncs, 1) if self.fsyncs else 0
+        }
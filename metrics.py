@@ -0,0 +1,331 @@
+"""
+Метрики бота в текстовом формате Prometheus.
+
+Счетчики, показатели и гистограммы хранятся в памяти процесса и отдаются
+по HTTP на /metrics. Показатели, которые дешевле прочитать в момент
+запроса (глубина очередей, число анкет в каждом состоянии), собираются
+функциями-сборщиками при каждом запросе.
+
+Замеры подключаются без правки обработчиков:
+- HandlerMetricsMiddleware - middleware диспетчера для обработчиков;
+- BotAPIMetricsMiddleware - middleware сессии бота для запросов к Bot API;
+- запросы к Google Таблицам замеряет AsyncSheets через on_request.
+"""
+
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiohttp import web
+
+# Границы корзин гистограмм задержек (сек)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Метрика с набором меток; значения хранятся по кортежу значений меток"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self._values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def clear(self):
+        self._values.clear()
+
+    def items(self) -> list:
+        """[(значения меток, значение)]"""
+        return list(self._values.items())
+
+    def samples(self):
+        """[(суффикс имени, значения меток, доп. метка, значение)]"""
+        return [("", key, "", value) for key, value in self._values.items()]
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.label_names, key, extra)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._values.get(key)
+        if series is None:
+            # Счетчики по корзинам (последняя - +Inf), сумма и число наблюдений
+            series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def samples(self):
+        result = []
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                result.append(("_bucket", key, f'le="{_format_value(float(bound))}"', cumulative))
+            result.append(("_sum", key, "", total))
+            result.append(("_count", key, "", count))
+        return result
+
+    def series(self) -> dict:
+        """{значения меток: (число наблюдений, сумма)}"""
+        return {key: (count, total) for key, (_, total, count) in self._values.items()}
+
+    def quantile(self, q: float, **labels):
+        """Оценка квантиля по корзинам (линейная интерполяция внутри корзины)"""
+        series = self._values.get(self._key(labels))
+        if series is None or not series[2]:
+            return None
+        counts, _, count = series
+        rank = q * count
+        cumulative = 0
+        lower = 0.0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                if bound == float("inf"):
+                    return lower
+                return lower + (bound - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+            lower = bound
+        return lower
+
+
+class Registry:
+    """Набор метрик процесса и функции, обновляющие показатели перед выдачей"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def _add(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: tuple = ()) -> Counter:
+        return self._add(Counter(name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, labels: tuple = ()) -> Gauge:
+        return self._add(Gauge(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help_text, labels, buckets))
+
+    def collector(self, collect):
+        """Функция без аргументов, которая вызывается перед каждой выдачей метрик"""
+        self._collectors.append(collect)
+        return collect
+
+    def collect(self):
+        for collect in self._collectors:
+            try:
+                collect()
+            except Exception as e:
+                logging.warning(f"Ошибка сбора метрик: {e}")
+
+    def render(self) -> str:
+        self.collect()
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# =====================================================
+# МЕТРИКИ БОТА
+# =====================================================
+
+registry = Registry()
+
+updates_total = registry.counter("bot_updates_total", "Обновления от Telegram", ("type",))
+handler_seconds = registry.histogram("bot_handler_seconds", "Время работы обработчика", ("handler",))
+handler_errors_total = registry.counter("bot_handler_errors_total", "Ошибки обработчиков", ("handler", "error"))
+stage_seconds = registry.histogram(
+    "bot_registration_stage_seconds", "Время фонового этапа регистрации", ("stage", "result")
+)
+bot_api_seconds = registry.histogram("bot_api_request_seconds", "Время запроса к Bot API", ("method",))
+bot_api_errors_total = registry.counter("bot_api_errors_total", "Ошибки запросов к Bot API", ("method", "error"))
+sheets_seconds = registry.histogram("sheets_request_seconds", "Время запроса к Google Таблицам", ("operation",))
+sheets_errors_total = registry.counter(
+    "sheets_errors_total", "Ошибки запросов к Google Таблицам", ("operation", "error")
+)
+sheets_circuit_state = registry.gauge(
+    "sheets_circuit_state", "Предохранитель Google Таблиц: 0 - замкнут, 1 - пробный запрос, 2 - разомкнут"
+)
+sheets_rejected_total = registry.gauge(
+    "sheets_circuit_rejected_total", "Запросы к Google Таблицам, отклоненные предохранителем"
+)
+duplicate_registrations_total = registry.counter(
+    "bot_duplicate_registrations_total", "Повторные регистрации (новая заявка не создана)", ("match",)
+)
+new_phone_registrations_total = registry.counter(
+    "bot_new_phone_registrations_total", "Заявки пользователей, уже регистрировавшихся с другим телефоном"
+)
+fsm_states = registry.gauge("bot_fsm_states", "Пользователей в каждом состоянии анкеты", ("state",))
+queue_depth = registry.gauge("bot_queue_depth", "Глубина очередей", ("queue",))
+loop_lag_seconds = registry.histogram(
+    "bot_event_loop_lag_seconds", "Задержка цикла событий",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+)
+loop_lag_max_seconds = registry.gauge("bot_event_loop_lag_max_seconds", "Максимальная задержка цикла событий за минуту")
+startup_seconds = registry.gauge("bot_startup_seconds", "Время этапов запуска процесса", ("phase",))
+
+
+def error_class(error: BaseException) -> str:
+    """Класс ошибки для метки: имя типа, для ошибок API с кодом - и код"""
+    status = getattr(error, "status", None)
+    return f"{type(error).__name__}:{status}" if status else type(error).__name__
+
+
+def observe_sheets_request(operation: str, seconds: float, error: BaseException = None):
+    """Замер запроса к Google Таблицам (передается в AsyncSheets как on_request)"""
+    sheets_seconds.observe(seconds, operation=operation)
+    if error is not None:
+        sheets_errors_total.inc(operation=operation, error=error_class(error))
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время и ошибки обработчиков; подключается как inner middleware событий"""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            handler_errors_total.inc(handler=name, error=error_class(e))
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, handler=name)
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Счетчик обновлений по типу; подключается как outer middleware dp.update"""
+
+    async def __call__(self, handler, event, data):
+        updates_total.inc(type=getattr(event, "event_type", "unknown"))
+        return await handler(event, data)
+
+
+class BotAPIMetricsMiddleware(BaseRequestMiddleware):
+    """Время и ошибки запросов к Bot API (без ожидания в очереди отправки)"""
+
+    async def __call__(self, make_request, bot, method):
+        name = getattr(method, "__api_method__", type(method).__name__)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            bot_api_errors_total.inc(method=name, error=error_class(e))
+            raise
+        finally:
+            bot_api_seconds.observe(time.perf_counter() - started, method=name)
+
+
+class LoopLagMonitor:
+    """Задержка цикла событий: насколько позже запланированного просыпается задача"""
+
+    def __init__(self, interval: float = 0.1, window: float = 60):
+        self.interval = interval
+        self.window = window
+        self.last = 0.0
+        self._max = 0.0
+        self._window_started = 0.0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._window_started = loop.time()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            now = loop.time()
+            self.last = max(0.0, now - expected)
+            loop_lag_seconds.observe(self.last)
+            if now - self._window_started >= self.window:
+                self._window_started = now
+                self._max = 0.0
+            self._max = max(self._max, self.last)
+            loop_lag_max_seconds.set(self._max)
+
+
+class MetricsServer:
+    """HTTP-сервер с /metrics в формате Prometheus"""
+
+    def __init__(self, metrics: Registry = registry):
+        self.registry = metrics
+        self._runner = None
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.registry.render().encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+
+    async def start(self, host: str, port: int):
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logging.info(f"Метрики доступны на http://{host}:{port}/metrics")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
@@ -0,0 +1,124 @@
+"""
+Кэш file_id загруженных в Telegram изображений.
+
+Изображение загружается в Telegram один раз, дальше отправляется по
+file_id. Ключ кэша - SHA-256 содержимого файла, поэтому при замене файла
+на диске он будет загружен заново. Кэш сохраняется в JSON между
+перезапусками.
+
+Файл кэша общий для процессов-обработчиков: при сохранении процесс под
+блокировкой файла перечитывает кэш и дописывает в него только свое
+изменение, поэтому изменения других процессов не теряются.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: блокировки нет, процесс-обработчик там один
+    fcntl = None
+
+
+class PhotoCache:
+    """Соответствие "хэш содержимого файла -> file_id в Telegram" """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file_ids = {}
+        self._digests = {}  # {путь: ((mtime, размер), хэш)} - чтобы не хэшировать файл при каждой отправке
+
+        self.hits = 0
+        self.uploads = 0
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logging.error(f"Ошибка чтения кэша изображений: {e}")
+            return {}
+
+    def load(self):
+        """Загрузка кэша с диска"""
+        self._file_ids = self._read()
+
+    @contextmanager
+    def _locked(self):
+        if fcntl is None:
+            yield
+            return
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _save(self, digest: str, file_id: str = None, forgotten: str = None):
+        """Запись одного изменения: file_id для digest или удаление недействительного forgotten"""
+        with self._locked():
+            file_ids = self._read()
+            if file_id is not None:
+                file_ids[digest] = file_id
+            elif file_ids.get(digest) == forgotten:
+                # Другой процесс мог уже загрузить изображение заново - его file_id не трогаем
+                del file_ids[digest]
+            # Временный файл у каждого процесса свой
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(file_ids, f, indent=2)
+            os.replace(tmp_path, self.path)
+        # Заодно подхватываем file_id, сохраненные другими процессами
+        self._file_ids = file_ids
+
+    def digest(self, image_path: str) -> str:
+        """Хэш содержимого файла; пересчитывается только если файл изменился"""
+        stat = os.stat(image_path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+
+        cached = self._digests.get(image_path)
+        if cached and cached[0] == signature:
+            return cached[1]
+
+        sha = hashlib.sha256()
+        with open(image_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        self._digests[image_path] = (signature, digest)
+        return digest
+
+    def __contains__(self, digest: str) -> bool:
+        return digest in self._file_ids
+
+    def get(self, digest: str):
+        """file_id для содержимого с данным хэшем или None"""
+        file_id = self._file_ids.get(digest)
+        if file_id:
+            self.hits += 1
+        return file_id
+
+    def remember(self, digest: str, file_id: str):
+        """Сохранение file_id после загрузки"""
+        self.uploads += 1
+        self._file_ids[digest] = file_id
+        try:
+            self._save(digest, file_id=file_id)
+        except Exception as e:
+            logging.error(f"Ошибка сохранения кэша изображений: {e}")
+
+    def forget(self, digest: str):
+        """Удаление недействительного file_id"""
+        forgotten = self._file_ids.pop(digest, None)
+        if forgotten is not None:
+            try:
+                self._save(digest, forgotten=forgotten)
+            except Exception as e:
+                logging.error(f"Ошибка сохранения кэша изображений: {e}")
@@ -0,0 +1,172 @@
+"""
+Профилирование работающего бота по команде админа.
+
+- SamplingProfiler: раз в interval секунд процессорного времени снимает
+  стек главного потока (там работает цикл событий) и считает одинаковые
+  стеки. Результат - файл в формате collapsed stacks ("a;b;c 42" на
+  строку), который читают flamegraph.pl, speedscope и py-spy.
+- profile_cpu: детерминированный профиль cProfile главного потока в формате
+  pstats (python -m pstats файл, snakeviz).
+- memory_diff: разница двух снимков tracemalloc через N секунд.
+- dump_tasks: стеки всех задач asyncio.
+
+Пока профилирование не запущено, ничего не работает: таймер сэмплирования
+и tracemalloc включаются только на время замера.
+"""
+
+import asyncio
+import cProfile
+import io
+import marshal
+import os
+import signal
+import time
+import tracemalloc
+from collections import Counter
+
+# Ограничение длительности одного замера (сек)
+MAX_SECONDS = 300
+
+
+class ProfilerBusy(Exception):
+    """Уже идет другой замер"""
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Сэмплирующий профилировщик главного потока по таймеру процессорного времени
+
+    Таймер ITIMER_PROF присылает SIGPROF каждые interval секунд процессорного
+    времени, обработчик получает прерванный кадр и считает его стек. Поток-
+    сэмплер не подходит: из-за GIL он просыпается в основном, когда цикл
+    событий ждет в select, и показывает только ожидание.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self.sample_count = 0
+        self._previous_handler = None
+
+    def _handle(self, signum, frame):
+        stack = []
+        while frame is not None:
+            stack.append(_frame_name(frame))
+            frame = frame.f_back
+        self.samples[";".join(reversed(stack))] += 1
+        self.sample_count += 1
+
+    def start(self):
+        if not hasattr(signal, "setitimer"):
+            raise RuntimeError("Сэмплирование доступно только на Linux и macOS")
+        self._previous_handler = signal.signal(signal.SIGPROF, self._handle)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+
+    def collapsed(self) -> str:
+        """Стеки в формате collapsed stacks, самые частые первыми"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+class Profiler:
+    """Замеры по команде админа; одновременно идет не больше одного замера"""
+
+    def __init__(self, max_seconds: float = MAX_SECONDS):
+        self.max_seconds = max_seconds
+        self._busy = None   # Название текущего замера
+
+    @property
+    def busy(self):
+        return self._busy
+
+    def _begin(self, name: str, seconds: float) -> float:
+        if self._busy is not None:
+            raise ProfilerBusy(f"Уже идет замер: {self._busy}")
+        self._busy = name
+        return max(1.0, min(float(seconds), self.max_seconds))
+
+    async def sample(self, seconds: float, interval: float = 0.005) -> tuple:
+        """Сэмплирование стеков; (текст collapsed stacks, число замеров)
+
+        Вызывается из главного потока: обработчики сигналов работают только в нем.
+        """
+        seconds = self._begin("sampling", seconds)
+        profiler = SamplingProfiler(interval)
+        try:
+            profiler.start()
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.stop()
+            self._busy = None
+        return profiler.collapsed(), profiler.sample_count
+
+    async def profile_cpu(self, seconds: float) -> bytes:
+        """cProfile главного потока; содержимое файла pstats"""
+        seconds = self._begin("cprofile", seconds)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            await asyncio.sleep(seconds)
+        finally:
+            profile.disable()
+            self._busy = None
+        # Файл pstats - marshal словаря статистики, как в Profile.dump_stats
+        profile.create_stats()
+        return marshal.dumps(profile.stats)
+
+    async def memory_diff(self, seconds: float, limit: int = 50) -> str:
+        """Рост памяти за seconds секунд по строкам кода (tracemalloc)"""
+        seconds = self._begin("tracemalloc", seconds)
+        started_here = not tracemalloc.is_tracing()
+        try:
+            if started_here:
+                tracemalloc.start(10)
+            before = tracemalloc.take_snapshot()
+            await asyncio.sleep(seconds)
+            after = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            if started_here:
+                tracemalloc.stop()
+            self._busy = None
+
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        diff = after.filter_traces(filters).compare_to(before.filter_traces(filters), "lineno")
+        lines = [
+            f"Рост памяти за {seconds:.0f} с, память под наблюдением {current / 1024 / 1024:.1f} МБ "
+            f"(пик {peak / 1024 / 1024:.1f} МБ)",
+            ""
+        ]
+        for stat in diff[:limit]:
+            lines.append(str(stat))
+        # Для самых крупных - полный стек выделения
+        lines.append("")
+        for stat in diff[:5]:
+            lines.append(f"--- {stat.size_diff / 1024:+.1f} КБ, {stat.count_diff:+d} блоков")
+            lines.extend(stat.traceback.format())
+        return "\n".join(lines) + "\n"
+
+
+def dump_tasks(limit: int = 20) -> str:
+    """Стеки всех задач asyncio текущего цикла событий"""
+    tasks = sorted(asyncio.all_tasks(), key=lambda task: task.get_name())
+    out = io.StringIO()
+    out.write(f"Задач: {len(tasks)}, {time.strftime('%d.%m.%Y %H:%M:%S')}\n\n")
+    # Одинаковые стеки объединяются: тысячи ожидающих задач дают несколько групп
+    groups = {}
+    for task in tasks:
+        stack = io.StringIO()
+        task.print_stack(limit=limit, file=stack)
+        text = stack.getvalue().split("\n", 1)[1] if "\n" in stack.getvalue() else ""
+        groups.setdefault(text, []).append(task.get_name())
+    for text, names in sorted(groups.items(), key=lambda item: -len(item[1])):
+        shown = ", ".join(names[:10]) + (f" и еще {len(names) - 10}" if len(names) > 10 else "")
+        out.write(f"=== {len(names)} задач: {shown}\n{text or '(нет стека)'}\n")
+    return out.getvalue()
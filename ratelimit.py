@@ -0,0 +1,80 @@
+"""
+Ограничение частоты запросов к внешним API.
+"""
+
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Асинхронный token bucket с адаптацией под ответы retry-after
+
+    rate - сколько запросов в секунду разрешено в среднем,
+    capacity - сколько запросов можно сделать подряд без ожидания.
+    При ответе "слишком много запросов" скорость снижается вдвое,
+    а после успешных запросов постепенно возвращается к исходной.
+    """
+
+    def __init__(self, rate: float, capacity: float = None, min_rate: float = None):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate or rate / 16
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+        self.throttled_total = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, tokens: float = 1) -> float:
+        """Сколько секунд нужно подождать, чтобы получить tokens токенов"""
+        self._refill()
+        pause = max(0.0, self._paused_until - time.monotonic())
+        shortage = max(0.0, tokens - self.tokens)
+        return max(pause, shortage / self.rate)
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        """Взять токены без ожидания, если они есть"""
+        if self.delay(tokens) > 0:
+            return False
+        self.tokens -= tokens
+        return True
+
+    async def acquire(self, tokens: float = 1):
+        """Дождаться и взять токены"""
+        async with self._lock:
+            while True:
+                wait = self.delay(tokens)
+                if wait <= 0:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep(wait)
+
+    def penalize(self, retry_after: float = None):
+        """Реакция на ответ "слишком много запросов": пауза и снижение скорости"""
+        self.throttled_total += 1
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = 0
+        if retry_after:
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+    def reward(self):
+        """Постепенное восстановление скорости после успешного запроса"""
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def stats(self) -> dict:
+        """Текущее состояние"""
+        return {
+            'rate': round(self.rate, 3),
+            'max_rate': self.max_rate,
+            'tokens': round(self.tokens, 2),
+            'paused_for': round(max(0.0, self._paused_until - time.monotonic()), 1),
+            'throttled_total': self.throttled_total
+        }
@@ -0,0 +1,236 @@
+"""
+Индекс регистраций для поиска повторных заявок.
+
+Нормализованные телефоны (E.164, как число) и ID пользователей Telegram
+хранятся в хэш-таблицах с открытой адресацией поверх двух array('q'):
+ключ и номер заявки занимают 16 байт на слот, тогда как запись dict с
+объектами int - около 100 байт. Поиск - O(1) без обращения к базе и
+к таблице. Индекс загружается из базы заявок один раз при запуске и
+пополняется при каждой новой заявке.
+
+Повторной считается регистрация с уже известным телефоном: заявка - это
+лид по номеру. Пользователь Telegram с новым номером оставляет новую
+заявку; такие случаи считаются отдельно (new_phone_users).
+
+Расход памяти и скорость на N записях:
+    python registrations.py [N]
+"""
+
+import re
+from array import array
+
+# Пустой слот; телефоны и ID пользователей всегда больше нуля
+EMPTY = 0
+
+# Множитель Фибоначчи для перемешивания ключа: соседние ID попадают в разные слоты
+_MULTIPLIER = 0x9E3779B97F4A7C15
+_MASK64 = (1 << 64) - 1
+
+_NON_DIGITS = re.compile(r"\D")
+
+
+def normalize_phone(phone: str, country_code: str = "7"):
+    """Телефон в формате E.164 (+79161234567) или None, если это не номер телефона
+
+    Номера без "+" считаются российскими: 8XXXXXXXXXX и XXXXXXXXXX
+    приводятся к +7XXXXXXXXXX.
+    """
+    phone = (phone or "").strip()
+    international = phone.startswith("+")
+    digits = phone[1:] if international else phone
+    # Телефон из контакта Telegram - уже только цифры, регулярное выражение не нужно
+    if not digits.isdigit():
+        digits = _NON_DIGITS.sub("", digits)
+    if not international:
+        if len(digits) == 11 and digits[0] == "8":
+            digits = country_code + digits[1:]
+        elif len(digits) == 10:
+            digits = country_code + digits
+    # E.164: до 15 цифр, код страны не начинается с нуля
+    if not 8 <= len(digits) <= 15 or digits[0] == "0":
+        return None
+    return "+" + digits
+
+
+class IntMap:
+    """Хэш-таблица "целое > 0 -> целое" с линейным пробированием"""
+
+    def __init__(self, capacity: int = 1024):
+        self._allocate(capacity)
+
+    def _allocate(self, capacity: int):
+        # Таблица заполняется не больше чем на 2/3
+        bits = max(3, (capacity * 3 // 2).bit_length())
+        self._size = 1 << bits
+        self._mask = self._size - 1
+        self._shift = 64 - bits
+        self._keys = array("q", bytes(8 * self._size))
+        self._values = array("q", bytes(8 * self._size))
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _slot(self, key: int) -> int:
+        keys = self._keys
+        index = ((key * _MULTIPLIER) & _MASK64) >> self._shift
+        while True:
+            slot_key = keys[index]
+            if slot_key == key or slot_key == EMPTY:
+                return index
+            index = (index + 1) & self._mask
+
+    def get(self, key: int, default=None):
+        index = self._slot(key)
+        return self._values[index] if self._keys[index] == key else default
+
+    def setdefault(self, key: int, value: int) -> int:
+        """Значение по ключу; если ключа нет - сохраняет value"""
+        index = self._slot(key)
+        if self._keys[index] == key:
+            return self._values[index]
+        self._keys[index] = key
+        self._values[index] = value
+        self._count += 1
+        if self._count * 3 > self._size * 2:
+            self._grow(self._count * 2)
+        return value
+
+    def reserve(self, count: int):
+        """Заранее увеличить таблицу под count ключей (без промежуточных перестроений)"""
+        if count * 3 > self._size * 2:
+            self._grow(count)
+
+    def _grow(self, capacity: int):
+        keys, values = self._keys, self._values
+        self._allocate(capacity)
+        for key, value in zip(keys, values):
+            if key != EMPTY:
+                index = self._slot(key)
+                self._keys[index] = key
+                self._values[index] = value
+                self._count += 1
+
+    @property
+    def nbytes(self) -> int:
+        return self._keys.itemsize * len(self._keys) + self._values.itemsize * len(self._values)
+
+
+class RegistrationIndex:
+    """Номер первой заявки по телефону и по ID пользователя"""
+
+    def __init__(self):
+        self.phones = IntMap()
+        self.users = IntMap()
+        self.last_id = 0   # Последняя заявка, прочитанная из базы (load)
+
+        self.lookups = 0
+        self.duplicates = 0
+        self.new_phone_users = 0  # Известный пользователь с новым телефоном (новая заявка)
+
+    def __len__(self):
+        return max(len(self.phones), len(self.users))
+
+    def add(self, submission_id: int, phone: str, user_id) -> bool:
+        """Добавление заявки; False - телефон или пользователь уже были в индексе"""
+        new = True
+        e164 = normalize_phone(phone)
+        if e164 is not None:
+            new = self.phones.setdefault(int(e164), submission_id) == submission_id and new
+        try:
+            user_id = int(user_id) if user_id else 0
+        except (TypeError, ValueError):
+            user_id = 0
+        if user_id > 0:
+            new = self.users.setdefault(user_id, submission_id) == submission_id and new
+        return new
+
+    def load(self, rows: list) -> int:
+        """Загрузка заявок [(id, телефон, ID пользователя)] по возрастанию id"""
+        self.phones.reserve(len(self.phones) + len(rows))
+        self.users.reserve(len(self.users) + len(rows))
+        for submission_id, phone, user_id in rows:
+            self.add(submission_id, phone, user_id)
+            self.last_id = max(self.last_id, submission_id)
+        return len(rows)
+
+    def has_phone(self, phone: str) -> bool:
+        e164 = normalize_phone(phone)
+        return e164 is not None and self.phones.get(int(e164)) is not None
+
+    def has_user(self, user_id) -> bool:
+        return bool(user_id) and self.users.get(int(user_id)) is not None
+
+    def find(self, phone: str = None, user_id: int = None):
+        """(номер заявки, "phone") для повторной регистрации или None
+
+        Совпадение ищется только по нормализованному телефону. Если телефон новый,
+        а пользователь уже оставлял заявку, регистрация новая (учитывается в new_phone_users).
+        """
+        self.lookups += 1
+        e164 = normalize_phone(phone)
+        submission_id = self.phones.get(int(e164)) if e164 is not None else None
+        if submission_id is not None:
+            self.duplicates += 1
+            return submission_id, "phone"
+        if self.has_user(user_id):
+            self.new_phone_users += 1
+        return None
+
+    @property
+    def nbytes(self) -> int:
+        return self.phones.nbytes + self.users.nbytes
+
+    def stats(self) -> dict:
+        return {
+            'phones': len(self.phones),
+            'users': len(self.users),
+            'memory_bytes': self.nbytes,
+            'last_id': self.last_id,
+            'lookups': self.lookups,
+            'duplicates': self.duplicates,
+            'new_phone_users': self.new_phone_users
+        }
+
+
+if __name__ == "__main__":
+    # Сравнение с обычным dict
+    import random
+    import sys
+    import time
+    import tracemalloc
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    rows = [
+        (number + 1, f"+79{random.randrange(10 ** 9):09d}", random.randint(5_000_000_000, 8_000_000_000))
+        for number in range(count)
+    ]
+
+    tracemalloc.start()
+    plain_phones, plain_users = {}, {}
+    for submission_id, phone, user_id in rows:
+        plain_phones.setdefault(int(normalize_phone(phone)), submission_id + 1 - 1)
+        plain_users.setdefault(user_id + 1 - 1, submission_id + 1 - 1)
+    dict_memory = tracemalloc.get_traced_memory()[0]
+    del plain_phones, plain_users
+    tracemalloc.stop()
+
+    index = RegistrationIndex()
+    started = time.perf_counter()
+    index.load(rows)
+    load_time = time.perf_counter() - started
+
+    sample = random.sample(rows, min(count, 100000))
+    started = time.perf_counter()
+    for _, phone, user_id in sample:
+        assert index.find(phone, user_id) is not None
+    hit_time = (time.perf_counter() - started) / len(sample)
+    started = time.perf_counter()
+    for _, phone, _ in sample:
+        index.find(phone[:-1] + "x0", 1)
+    miss_time = (time.perf_counter() - started) / len(sample)
+
+    print(f"Заявок: {count}")
+    print(f"dict:              {dict_memory / 1024 / 1024:8.1f} МБ")
+    print(f"RegistrationIndex: {index.nbytes / 1024 / 1024:8.1f} МБ")
+    print(f"Загрузка: {load_time:.2f} с, поиск: найдено {hit_time * 1e6:.2f} мкс, не найдено {miss_time * 1e6:.2f} мкс")
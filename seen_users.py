@@ -0,0 +1,282 @@
+"""
+Компактное множество ID пользователей, которые уже получили приветствие.
+
+Устроено как roaring bitmap: ID делится на старшую часть (user_id >> 16)
+и младшие 16 бит. Для каждой старшей части хранится контейнер:
+- отсортированный массив младших частей (2 байта на пользователя),
+  пока в нем не больше 4096 значений;
+- битовая карта на 65536 значений (8 КБ), когда значений больше.
+
+Объем памяти ограничен max_bytes: при превышении удаляются контейнеры,
+которые дольше всех не пополнялись (эти пользователи получат приветствие
+еще раз). Множество периодически сохраняется на диск и загружается при
+запуске.
+
+Сравнение с обычным set на N пользователях:
+    python seen_users.py [N]
+"""
+
+import logging
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+
+# Контейнер-массив превращается в битовую карту, когда в нем больше значений
+ARRAY_MAX = 4096
+BITMAP_BYTES = 65536 // 8
+
+# Расход памяти на один контейнер помимо данных: запись в словаре и ключ
+CONTAINER_OVERHEAD = 220
+
+SNAPSHOT_MAGIC = b"SEEN1\n"
+_HEADER = struct.Struct("<QBI")  # старшая часть, тип контейнера, длина данных
+
+KIND_ARRAY = 0
+KIND_BITMAP = 1
+
+
+def _container_bytes(container) -> int:
+    return sys.getsizeof(container) + CONTAINER_OVERHEAD
+
+
+def estimate_set_bytes(count: int) -> int:
+    """Сколько памяти занял бы обычный set из count ID пользователей"""
+    # Таблица set заполняется не больше чем на 60%, слот - 16 байт;
+    # ID пользователей Telegram больше 2^30, каждый int - 32 байта
+    slots = 8
+    while slots * 3 <= count * 5:
+        slots *= 2
+    return 200 + slots * 16 + count * 32
+
+
+class SeenUsers:
+    """Множество ID пользователей с ограничением памяти и сохранением на диск"""
+
+    def __init__(self, path: str, max_bytes: int = 64 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._containers = {}  # {старшая часть: array('H') или bytearray}; порядок - по последнему пополнению
+        self._count = 0
+        self._bytes = 0
+        self._version = 0        # Номер изменения множества
+        self._saved_version = 0  # Номер изменения, сохраненного на диск
+
+        self.evicted = 0
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, user_id: int) -> bool:
+        container = self._containers.get(user_id >> 16)
+        if container is None:
+            return False
+        low = user_id & 0xFFFF
+        if isinstance(container, bytearray):
+            return bool(container[low >> 3] & (1 << (low & 7)))
+        index = bisect_left(container, low)
+        return index < len(container) and container[index] == low
+
+    def add(self, user_id: int) -> bool:
+        """Добавление пользователя; True - его еще не было"""
+        high = user_id >> 16
+        low = user_id & 0xFFFF
+
+        # Контейнер переставляется в конец словаря: в начале остаются давно не пополнявшиеся
+        container = self._containers.pop(high, None)
+        if container is None:
+            container = array("H")
+            self._bytes += CONTAINER_OVERHEAD
+        size_before = sys.getsizeof(container)
+
+        if isinstance(container, bytearray):
+            mask = 1 << (low & 7)
+            added = not container[low >> 3] & mask
+            container[low >> 3] |= mask
+        else:
+            index = bisect_left(container, low)
+            added = index == len(container) or container[index] != low
+            if added:
+                container.insert(index, low)
+                if len(container) > ARRAY_MAX:
+                    container = self._to_bitmap(container)
+
+        self._containers[high] = container
+        self._bytes += sys.getsizeof(container) - size_before
+        if added:
+            self._count += 1
+            self._version += 1
+            if self._bytes > self.max_bytes:
+                self._evict()
+        return added
+
+    @staticmethod
+    def _to_bitmap(values: array) -> bytearray:
+        bitmap = bytearray(BITMAP_BYTES)
+        for low in values:
+            bitmap[low >> 3] |= 1 << (low & 7)
+        return bitmap
+
+    @staticmethod
+    def _container_count(container) -> int:
+        if isinstance(container, bytearray):
+            return sum(bin(byte).count("1") for byte in container)
+        return len(container)
+
+    def _evict(self):
+        # Освобождаем с запасом, чтобы не вытеснять при каждом добавлении
+        target = self.max_bytes * 0.9
+        evicted = 0
+        while self._bytes > target and len(self._containers) > 1:
+            high = next(iter(self._containers))
+            container = self._containers.pop(high)
+            self._bytes -= _container_bytes(container)
+            count = self._container_count(container)
+            self._count -= count
+            evicted += count
+        self.evicted += evicted
+        logging.warning(f"Достигнут лимит памяти списка пользователей, забыто пользователей: {evicted}")
+
+    # ---------------- Сохранение на диск ----------------
+
+    def snapshot(self) -> bytes:
+        """Содержимое множества для записи на диск"""
+        parts = [SNAPSHOT_MAGIC]
+        for high, container in self._containers.items():
+            if isinstance(container, bytearray):
+                data = bytes(container)
+                kind = KIND_BITMAP
+            else:
+                values = array("H", container)
+                if sys.byteorder == "big":
+                    values.byteswap()
+                data = values.tobytes()
+                kind = KIND_ARRAY
+            parts.append(_HEADER.pack(high, kind, len(data)))
+            parts.append(data)
+        return b"".join(parts)
+
+    def write_snapshot(self, data: bytes, version: int = None):
+        """Атомарная запись снимка (вызывается в отдельном потоке)
+
+        version - значение version на момент snapshot(): после успешной записи
+        изменения до него считаются сохраненными. При ошибке записи множество
+        остается dirty и сохранится при следующей попытке.
+        """
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+        if version is not None:
+            self._saved_version = max(self._saved_version, version)
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    @property
+    def dirty(self) -> bool:
+        return self._version != self._saved_version
+
+    def load(self):
+        """Загрузка снимка с диска"""
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logging.error(f"Ошибка чтения списка пользователей: {e}")
+            return
+
+        if not data.startswith(SNAPSHOT_MAGIC):
+            logging.error(f"Неизвестный формат файла {self.path}, список пользователей не загружен")
+            return
+
+        containers = {}
+        count = 0
+        offset = len(SNAPSHOT_MAGIC)
+        try:
+            while offset < len(data):
+                high, kind, length = _HEADER.unpack_from(data, offset)
+                offset += _HEADER.size
+                chunk = data[offset:offset + length]
+                if len(chunk) != length:
+                    raise ValueError("файл обрезан")
+                offset += length
+                if kind == KIND_BITMAP:
+                    container = bytearray(chunk)
+                else:
+                    container = array("H")
+                    container.frombytes(chunk)
+                    if sys.byteorder == "big":
+                        container.byteswap()
+                containers[high] = container
+                count += self._container_count(container)
+        except (struct.error, ValueError) as e:
+            logging.error(f"Файл {self.path} поврежден ({e}), загружена только целая часть")
+
+        self._containers = containers
+        self._count = count
+        self._bytes = sum(_container_bytes(container) for container in containers.values())
+        self._saved_version = self._version
+        logging.info(f"Загружен список пользователей: {count}, память {self._bytes / 1024 / 1024:.1f} МБ")
+
+    def stats(self) -> dict:
+        bitmaps = sum(1 for container in self._containers.values() if isinstance(container, bytearray))
+        return {
+            'users': self._count,
+            'containers': len(self._containers),
+            'bitmaps': bitmaps,
+            'memory_bytes': self._bytes,
+            'set_bytes': estimate_set_bytes(self._count),
+            'max_bytes': self.max_bytes,
+            'evicted': self.evicted
+        }
+
+
+if __name__ == "__main__":
+    # Сравнение расхода памяти с обычным set
+    import random
+    import time
+    import tracemalloc
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    # ID пользователей Telegram: недавние аккаунты сосредоточены в диапазоне 5-8 млрд
+    user_ids = [random.randint(5_000_000_000, 8_000_000_000) for _ in range(count)]
+
+    # Новые объекты int, как при разборе обновлений от Telegram
+    tracemalloc.start()
+    plain = set()
+    for user_id in user_ids:
+        plain.add(user_id + 1 - 1)
+    set_memory = tracemalloc.get_traced_memory()[0]
+    del plain
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    seen = SeenUsers("/dev/null", max_bytes=1 << 40)
+    for user_id in user_ids:
+        seen.add(user_id + 1 - 1)
+    seen_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    seen = SeenUsers("/dev/null", max_bytes=1 << 40)
+    started = time.perf_counter()
+    for user_id in user_ids:
+        seen.add(user_id)
+    add_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for user_id in user_ids[:100000]:
+        assert user_id in seen
+    lookup_time = (time.perf_counter() - started) / min(count, 100000)
+
+    stats = seen.stats()
+    print(f"Пользователей: {count}")
+    print(f"set:        {set_memory / 1024 / 1024:8.1f} МБ (оценка в stats: {stats['set_bytes'] / 1024 / 1024:.1f} МБ)")
+    print(f"SeenUsers:  {seen_memory / 1024 / 1024:8.1f} МБ (оценка в stats: {stats['memory_bytes'] / 1024 / 1024:.1f} МБ), "
+          f"контейнеров {stats['containers']}, битовых карт {stats['bitmaps']}")
+    print(f"Снимок на диске: {len(seen.snapshot()) / 1024 / 1024:.1f} МБ")
+    print(f"Добавление: {add_time / count * 1e6:.2f} мкс, проверка: {lookup_time * 1e6:.2f} мкс")
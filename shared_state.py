@@ -0,0 +1,78 @@
+"""
+Общие данные процессов-обработчиков при запуске бота в нескольких процессах.
+
+Заявки процессы пишут в общую базу SQLite (см. submissions.py),
+поэтому статистика /stats одинакова во всех процессах.
+
+Данные хранятся в Redis:
+- снимок списка городов: обновляет из Google Таблицы один процесс,
+  остальные читают снимок и не обращаются к таблице;
+- состояние процессов для команды /queue.
+"""
+
+import asyncio
+import json
+import logging
+import time
+
+from fsm_storage import RedisConnection
+
+
+def _text(value) -> str:
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+class SharedState:
+    """Список городов и состояние процессов в Redis"""
+
+    def __init__(self, url: str, worker_id: int, prefix: str = "s:", sync_interval: float = 1.0):
+        self.redis = RedisConnection(url)
+        self.worker_id = worker_id
+        self.prefix = prefix
+        self.sync_interval = sync_interval
+
+    # ---------------- Список городов ----------------
+
+    async def load_catalog(self):
+        """Снимок списка городов: {'cities', 'addresses', 'at'} или None"""
+        raw = await self.redis.execute("GET", self.prefix + "catalog")
+        return json.loads(raw) if raw else None
+
+    async def publish_catalog(self, cities: list, addresses: dict):
+        value = json.dumps({'cities': cities, 'addresses': addresses, 'at': time.time()}, ensure_ascii=False)
+        await self.redis.execute("SET", self.prefix + "catalog", value)
+
+    async def invalidate_catalog(self):
+        """Удаление снимка: следующий процесс загрузит список из таблицы"""
+        await self.redis.execute("DEL", self.prefix + "catalog")
+
+    async def try_lock(self, name: str, ttl: float) -> bool:
+        """Блокировка на ttl секунд; True - получил этот процесс"""
+        reply = await self.redis.execute(
+            "SET", f"{self.prefix}lock:{name}", self.worker_id, "NX", "EX", max(1, int(ttl))
+        )
+        return reply == "OK"
+
+    # ---------------- Состояние процессов ----------------
+
+    async def publish_worker_stats(self, worker_stats: dict):
+        """Публикация состояния этого процесса для /queue"""
+        await self.redis.execute("HSET", self.prefix + "workers", self.worker_id,
+                                 json.dumps({**worker_stats, 'at': time.time()}))
+
+    async def run_sync_loop(self, get_worker_stats):
+        """Фоновая публикация состояния процесса"""
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.publish_worker_stats(get_worker_stats())
+            except Exception as e:
+                logging.error(f"Ошибка синхронизации с другими процессами: {e}")
+
+    async def workers(self) -> dict:
+        """Последнее известное состояние каждого процесса"""
+        reply = await self.redis.execute("HGETALL", self.prefix + "workers")
+        return {_text(k): json.loads(v) for k, v in zip(reply[::2], reply[1::2])}
+
+    async def close(self):
+        await self.redis.close()
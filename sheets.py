@@ -0,0 +1,705 @@
+"""
+Общее подключение к Google Таблицам.
+
+Один клиент на процесс: учетные данные читаются с диска один раз,
+HTTP-сессия с keep-alive переиспользуется, токен обновляется только
+перед истечением срока действия, а объекты таблицы и листов кэшируются.
+"""
+
+import asyncio
+import logging
+import re
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import quote
+
+import aiohttp
+
+# gspread и google-auth импортируются при первом обращении к таблице:
+# их загрузка - заметная часть времени запуска, а сам импорт уходит
+# в поток вместе с первым обновлением токена
+
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from ratelimit import TokenBucket
+
+# Область доступа сервисного аккаунта
+SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive"
+]
+
+# За сколько до истечения токена его нужно обновить
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
+
+_session_class = None
+
+
+def _client_session_class():
+    """Класс HTTP-сессии клиента (создается при первом обращении, вместе с импортом google-auth)"""
+    global _session_class
+    if _session_class is None:
+        from google.auth.transport.requests import AuthorizedSession
+
+        class _ClientSession(AuthorizedSession):
+            """HTTP-сессия, которая перед запросом проверяет срок действия токена через клиента"""
+
+            def __init__(self, client: "SheetsClient"):
+                super().__init__(client.credentials)
+                self._client = client
+
+            def request(self, method, url, *args, **kwargs):
+                self._client.ensure_token()
+                return super().request(method, url, *args, **kwargs)
+
+        _session_class = _ClientSession
+    return _session_class
+
+
+class SheetsClient:
+    """Долгоживущий клиент Google Таблиц, общий для всего процесса"""
+
+    def __init__(self, credentials_path: str, sheet_id: str, scopes=None):
+        self.credentials_path = credentials_path
+        self.sheet_id = sheet_id
+        self.scopes = scopes or SCOPES
+
+        self._lock = threading.RLock()
+        self._credentials = None
+        self._token_request = None
+        self._session = None
+        self._gspread = None
+        self._spreadsheet = None
+        self._worksheets = {}
+
+        # Счетчики для проверки, что накладные расходы не повторяются на каждый запрос
+        self.token_refreshes = 0
+        self.sessions_opened = 0
+
+    @property
+    def credentials(self):
+        """Учетные данные сервисного аккаунта (читаются с диска один раз)"""
+        with self._lock:
+            if self._credentials is None:
+                from google.oauth2.service_account import Credentials
+                self._credentials = Credentials.from_service_account_file(
+                    self.credentials_path, scopes=self.scopes
+                )
+            return self._credentials
+
+    def token_is_fresh(self) -> bool:
+        """Есть ли токен, который не нужно обновлять в ближайшее время"""
+        credentials = self._credentials
+        return (
+            credentials is not None and bool(credentials.token) and credentials.expiry is not None
+            and datetime.utcnow() < credentials.expiry - TOKEN_REFRESH_MARGIN
+        )
+
+    def ensure_token(self) -> str:
+        """Возвращает действующий токен, обновляя его только при приближении срока истечения"""
+        with self._lock:
+            credentials = self.credentials
+
+            if not self.token_is_fresh():
+                if self._token_request is None:
+                    import requests
+                    from google.auth.transport.requests import Request
+                    self._token_request = Request(session=requests.Session())
+                credentials.refresh(self._token_request)
+                self.token_refreshes += 1
+                logging.info(f"Токен Google обновлен (всего обновлений: {self.token_refreshes})")
+
+            return credentials.token
+
+    @property
+    def session(self):
+        """Авторизованная HTTP-сессия с keep-alive"""
+        with self._lock:
+            if self._session is None:
+                self._session = _client_session_class()(self)
+                self.sessions_opened += 1
+            return self._session
+
+    @property
+    def client(self):
+        """Клиент gspread поверх общей сессии"""
+        with self._lock:
+            if self._gspread is None:
+                import gspread
+                self._gspread = gspread.Client(auth=self.credentials, session=self.session)
+            return self._gspread
+
+    @property
+    def spreadsheet(self):
+        """Объект таблицы (открывается один раз)"""
+        with self._lock:
+            if self._spreadsheet is None:
+                self._spreadsheet = self.client.open_by_key(self.sheet_id)
+            return self._spreadsheet
+
+    @property
+    def sheet1(self):
+        """Первый лист таблицы (лист с заявками)"""
+        return self.get_worksheet_by_index(0)
+
+    def get_worksheet_by_index(self, index: int):
+        """Лист по порядковому номеру (с кэшированием)"""
+        key = ("index", index)
+        with self._lock:
+            if key not in self._worksheets:
+                self._worksheets[key] = self.spreadsheet.get_worksheet(index)
+            return self._worksheets[key]
+
+    def worksheet(self, title: str):
+        """Лист по названию (с кэшированием)"""
+        key = ("title", title)
+        with self._lock:
+            if key not in self._worksheets:
+                self._worksheets[key] = self.spreadsheet.worksheet(title)
+            return self._worksheets[key]
+
+    def reset(self):
+        """Сброс кэша таблицы и листов (например, после переименования листов)"""
+        with self._lock:
+            self._spreadsheet = None
+            self._worksheets = {}
+
+    def stats(self) -> dict:
+        """Счетчики клиента"""
+        return {
+            'token_refreshes': self.token_refreshes,
+            'sessions_opened': self.sessions_opened,
+            'cached_worksheets': len(self._worksheets)
+        }
+
+
+# =====================================================
+# АСИНХРОННЫЙ ДОСТУП К GOOGLE ТАБЛИЦАМ
+# =====================================================
+
+SHEETS_API_URL = "https://sheets.googleapis.com/v4/spreadsheets"
+
+
+class SheetsAPIError(Exception):
+    """Ошибка ответа Google Sheets API"""
+
+    def __init__(self, status: int, message: str, retry_after: float = None):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: str):
+    """Retry-After в секундах: число секунд или HTTP-дата; None - если заголовка нет или он не разобран"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        moment = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if moment is None:
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return max(0.0, (moment - datetime.now(timezone.utc)).total_seconds())
+
+
+def updated_last_row(result: dict):
+    """Номер последней строки, затронутой запросом append (из updates.updatedRange)"""
+    try:
+        updated_range = result["updates"]["updatedRange"]
+        return int(re.search(r"(\d+)$", updated_range).group(1))
+    except (KeyError, TypeError, AttributeError):
+        return None
+
+
+def is_outage_error(error: BaseException) -> bool:
+    """Ошибка говорит о недоступности API (а не о неверном запросе или квоте)"""
+    if isinstance(error, SheetsAPIError):
+        return error.status >= 500
+    outage_types = [asyncio.TimeoutError, aiohttp.ClientError, OSError]
+    # Ошибки requests и google-auth возможны, только если эти библиотеки уже загружены
+    if "requests" in sys.modules:
+        outage_types.append(sys.modules["requests"].RequestException)
+    if "google.auth.exceptions" in sys.modules:
+        outage_types.append(sys.modules["google.auth.exceptions"].TransportError)
+    return isinstance(error, tuple(outage_types))
+
+
+# Ответы 4xx, после которых повтор может пройти: токен истек, таймаут на стороне API, квота
+RETRYABLE_STATUSES = (401, 408, 429)
+
+
+def is_permanent_error(error: BaseException) -> bool:
+    """Запрос неверен (неправильный диапазон, строка и т.п.) - повтор того же запроса не поможет"""
+    return (
+        isinstance(error, SheetsAPIError) and 400 <= error.status < 500
+        and error.status not in RETRYABLE_STATUSES
+    )
+
+
+def operation_name(method: str, path: str) -> str:
+    """Короткое название запроса для метрик: values.get, values.append, batchUpdate и т.п."""
+    if path.startswith("/values/"):
+        # Диапазон в пути экранирован, поэтому двоеточие отделяет только действие (:append)
+        if ":" in path:
+            return "values." + path.rsplit(":", 1)[1]
+        return "values.get" if method == "GET" else "values.update"
+    if path.startswith(":"):
+        return path[1:]
+    return "metadata" if method == "GET" else method.lower()
+
+
+def quote_sheet_range(title: str, cells: str) -> str:
+    """Диапазон вида 'Лист'!A1:B2 в нотации A1"""
+    if not title:
+        return cells
+    return "'{}'!{}".format(title.replace("'", "''"), cells)
+
+
+class AsyncSheets:
+    """Неблокирующий доступ к Google Sheets API v4 поверх aiohttp
+
+    Все запросы идут через одну keep-alive сессию, число одновременных
+    запросов ограничено семафором, у каждого вызова есть таймаут.
+    Адрес API настраивается, поэтому слой можно проверить на локальном
+    фейковом HTTP-сервере.
+    """
+
+    def __init__(self, client: SheetsClient, base_url: str = SHEETS_API_URL,
+                 max_concurrency: int = 4, timeout: float = 15, on_request=None,
+                 breaker: CircuitBreaker = None):
+        self.client = client
+        self.on_request = on_request  # on_request(операция, секунды, ошибка или None) - для метрик
+        self.breaker = breaker        # Предохранитель на случай недоступности API
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self._semaphore = None
+        self._session = None
+        self._first_sheet = None
+
+        self.requests_total = 0
+        self.errors_total = 0
+
+    async def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60)
+            )
+            self.client.sessions_opened += 1
+        return self._session
+
+    async def warm_up(self):
+        """Получение токена и открытие сессии заранее, до первого запроса"""
+        await self._get_token()
+        await self._get_session()
+
+    async def _get_token(self) -> str:
+        # Обновление токена синхронное, но нужно редко - выполняем его в потоке
+        if self.client.token_is_fresh():
+            return self.client.credentials.token
+        return await asyncio.to_thread(self.client.ensure_token)
+
+    async def request(self, method: str, path: str, params: dict = None,
+                      json_data: dict = None, timeout: float = None) -> dict:
+        """Выполнение запроса к API с ограничением параллельности и таймаутом"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        # При недоступности API запрос отклоняется сразу, без ожидания таймаута
+        if self.breaker is not None:
+            self.breaker.before_call()
+
+        try:
+            async with self._semaphore:
+                self.requests_total += 1
+                started = time.perf_counter()
+                error = None
+                try:
+                    result = await self._send(method, path, params, json_data, timeout)
+                except Exception as e:
+                    self.errors_total += 1
+                    error = e
+                    # Ответ с ошибкой запроса (не сбой API) тоже означает, что API доступен
+                    if self.breaker is not None:
+                        if is_outage_error(e):
+                            self.breaker.record_failure(e)
+                        else:
+                            self.breaker.record_success()
+                    raise
+                finally:
+                    if self.on_request is not None:
+                        self.on_request(operation_name(method, path), time.perf_counter() - started, error)
+                if self.breaker is not None:
+                    self.breaker.record_success()
+                return result
+        except asyncio.CancelledError:
+            # Отмененный запрос ничего не говорит о доступности API: предохранитель
+            # не замыкается, а пробный запрос (если это был он) разрешается снова
+            if self.breaker is not None:
+                self.breaker.release_probe()
+            raise
+
+    async def _send(self, method: str, path: str, params: dict, json_data: dict, timeout: float) -> dict:
+        """HTTP-запрос к API"""
+        url = f"{self.base_url}/{self.client.sheet_id}{path}"
+        client_timeout = aiohttp.ClientTimeout(total=timeout or self.timeout)
+        token = await self._get_token()
+        session = await self._get_session()
+        async with session.request(
+            method, url, params=params, json=json_data,
+            headers={"Authorization": f"Bearer {token}"},
+            timeout=client_timeout
+        ) as response:
+            if response.status >= 400:
+                text = await response.text()
+                raise SheetsAPIError(
+                    response.status, text[:500],
+                    parse_retry_after(response.headers.get("Retry-After"))
+                )
+            return await response.json()
+
+    async def get_metadata(self, fields: str = None) -> dict:
+        """Метаданные таблицы"""
+        params = {"fields": fields} if fields else None
+        return await self.request("GET", "", params=params)
+
+    async def get_first_sheet(self) -> dict:
+        """Свойства первого листа (лист с заявками), кэшируются"""
+        if self._first_sheet is None:
+            metadata = await self.get_metadata("sheets.properties")
+            self._first_sheet = metadata["sheets"][0]["properties"]
+        return self._first_sheet
+
+    def reset(self):
+        """Сброс кэша свойств листов"""
+        self._first_sheet = None
+
+    async def get_values(self, range_: str) -> list:
+        """Значения диапазона (список строк)"""
+        data = await self.request("GET", f"/values/{quote(range_, safe='')}")
+        return data.get("values", [])
+
+    async def update_values(self, range_: str, rows: list):
+        """Запись значений в диапазон"""
+        return await self.request(
+            "PUT", f"/values/{quote(range_, safe='')}",
+            params={"valueInputOption": "RAW"},
+            json_data={"values": rows}
+        )
+
+    async def append_rows(self, range_: str, rows: list):
+        """Добавление строк в конец таблицы одним запросом"""
+        return await self.request(
+            "POST", f"/values/{quote(range_, safe='')}:append",
+            params={"valueInputOption": "RAW", "insertDataOption": "INSERT_ROWS"},
+            json_data={"values": rows}
+        )
+
+    async def batch_update(self, requests_list: list):
+        """Пакетное изменение структуры и оформления таблицы"""
+        return await self.request("POST", ":batchUpdate", json_data={"requests": requests_list})
+
+    async def insert_row(self, sheet: dict, values: list, index: int = 1):
+        """Вставка строки на позицию index (нумерация с 1)"""
+        await self.batch_update([{
+            "insertDimension": {
+                "range": {
+                    "sheetId": sheet["sheetId"],
+                    "dimension": "ROWS",
+                    "startIndex": index - 1,
+                    "endIndex": index
+                },
+                "inheritFromBefore": False
+            }
+        }])
+        return await self.update_values(quote_sheet_range(sheet["title"], f"A{index}"), [values])
+
+    async def format_row(self, sheet: dict, row: int, columns: int, cell_format: dict):
+        """Оформление первых columns ячеек строки row (нумерация с 1)"""
+        return await self.batch_update([{
+            "repeatCell": {
+                "range": {
+                    "sheetId": sheet["sheetId"],
+                    "startRowIndex": row - 1,
+                    "endRowIndex": row,
+                    "startColumnIndex": 0,
+                    "endColumnIndex": columns
+                },
+                "cell": {"userEnteredFormat": cell_format},
+                "fields": "userEnteredFormat({})".format(",".join(cell_format))
+            }
+        }])
+
+    async def close(self):
+        """Закрытие HTTP-сессии"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def stats(self) -> dict:
+        """Счетчики асинхронного слоя"""
+        return {
+            'requests_total': self.requests_total,
+            'errors_total': self.errors_total,
+            'max_concurrency': self.max_concurrency,
+            'timeout': self.timeout
+        }
+
+
+# =====================================================
+# ОЧЕРЕДЬ ЗАПИСИ В GOOGLE ТАБЛИЦЫ
+# =====================================================
+
+class _PendingRow:
+    """Строка, ожидающая записи в таблицу"""
+
+    __slots__ = ("row", "enqueued_at", "on_written", "on_rejected")
+
+    def __init__(self, row: list, on_written=None, on_rejected=None):
+        self.row = row
+        self.enqueued_at = time.monotonic()
+        self.on_written = on_written
+        self.on_rejected = on_rejected
+
+
+class SheetsWriter:
+    """Фоновая запись строк в таблицу пачками (write-behind)
+
+    Строки попадают в очередь в памяти. Фоновая задача отправляет их одним
+    запросом append, когда набирается batch_size строк или когда самая
+    старая строка ждет дольше max_delay секунд. Частота запросов ограничена
+    token bucket'ом, который подстраивается под ответы 429 и retry-after.
+    Пачка, которую не удалось записать, повторяется, а не теряется.
+
+    Пачка, которую API отклонил как неверный запрос (4xx), не повторяется:
+    она делится пополам, пока не останутся отдельные отклоненные строки,
+    которые откладываются в dead_letters (и передаются в on_rejected),
+    а очередь идет дальше. После таймаута
+    запрос мог быть выполнен, поэтому перед повтором вызывается
+    find_written(строки): если он вернул результат (как у append), пачка
+    уже в таблице и повторно не отправляется.
+    """
+
+    def __init__(self, write_rows, bucket: TokenBucket, batch_size: int = 50,
+                 max_delay: float = 2.0, max_backoff: float = 60.0, find_written=None,
+                 max_dead_letters: int = 100):
+        self._write_rows = write_rows
+        self._find_written = find_written
+        self.max_dead_letters = max_dead_letters
+        self.bucket = bucket
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_backoff = max_backoff
+        self.queue = asyncio.Queue()
+        self._in_flight = 0
+        self._task = None
+        self.dead_letters = []  # [{'rows', 'error', 'at'}] - пачки, отклоненные API
+
+        # Метрики для настройки параметров
+        self.rows_written = 0
+        self.batches_written = 0
+        self.failed_attempts = 0
+        self.dead_rows_total = 0
+        self.recovered_after_timeout = 0
+        self.last_batch_size = 0
+        self.max_batch_size_seen = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.last_write_duration = 0.0
+
+    def submit(self, row: list, on_written=None, on_rejected=None):
+        """Поставить строку в очередь на запись
+
+        on_written(result) вызывается с ответом API после успешной записи пачки,
+        on_rejected(error) - если API отклонил строку и она не будет повторяться.
+        """
+        self.queue.put_nowait(_PendingRow(row, on_written, on_rejected))
+
+    @property
+    def depth(self) -> int:
+        """Сколько строк ждет записи (включая отправляемую пачку)"""
+        return self.queue.qsize() + self._in_flight
+
+    def start(self):
+        """Запуск фоновой задачи записи"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def stop(self, timeout: float = 10.0):
+        """Дописать очередь и остановить фоновую задачу"""
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        left = self.depth
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logging.error(f"Ошибка фоновой записи в таблицу: {e}")
+        if left:
+            logging.warning(
+                f"Запись в таблицу остановлена, не записано строк: {left}. "
+                "Они остаются в базе заявок и будут дописаны после перезапуска"
+            )
+
+    async def _collect_batch(self) -> list:
+        first = await self.queue.get()
+        batch = [first]
+        # Строки набираемой пачки уже не в очереди, но еще не записаны
+        self._in_flight = 1
+        # Пока квота не позволяет писать, продолжаем набирать пачку
+        deadline = max(first.enqueued_at + self.max_delay, time.monotonic() + self.bucket.delay())
+
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                self._in_flight += 1
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        """Основной цикл фоновой записи"""
+        while True:
+            batch = await self._collect_batch()
+            try:
+                await self._flush(batch)
+            finally:
+                self._in_flight = 0
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def _flush(self, batch: list):
+        rows = [item.row for item in batch]
+        backoff = min(1.0, self.max_backoff)
+        check_written = False
+        while True:
+            if check_written and self._find_written is not None:
+                # Прошлый запрос завершился по таймауту, но мог быть выполнен - проверяем таблицу
+                try:
+                    result = await self._find_written(rows)
+                except Exception as e:
+                    logging.warning(f"Не удалось проверить запись пачки из {len(batch)} строк: {e}, "
+                                    f"повтор через {backoff:.0f} с")
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+                    continue
+                check_written = False
+                if result is not None:
+                    logging.info(f"Пачка из {len(batch)} строк уже записана в таблицу, повтор не нужен")
+                    self.recovered_after_timeout += 1
+                    self._written(batch, result, time.monotonic())
+                    return
+
+            await self.bucket.acquire()
+            started = time.monotonic()
+            try:
+                result = await self._write_rows(rows)
+            except CircuitOpenError as e:
+                # Таблица недоступна: ждем пробного запроса, заявки остаются в очереди
+                logging.warning(f"Запись пачки из {len(batch)} строк отложена: {e}")
+                await asyncio.sleep(max(1.0, e.retry_after))
+                continue
+            except SheetsAPIError as e:
+                self.failed_attempts += 1
+                if e.status == 429:
+                    # Паузу перед повтором выдерживает token bucket
+                    self.bucket.penalize(e.retry_after or backoff)
+                    logging.warning(f"Превышена квота записи, пачка из {len(batch)} строк будет повторена")
+                    backoff = min(backoff * 2, self.max_backoff)
+                    continue
+                if is_permanent_error(e):
+                    # Повтор не поможет и задержит все следующие строки.
+                    # Отклонить пачку могла одна строка - остальные пишем отдельно
+                    if len(batch) > 1:
+                        logging.warning(f"Пачка из {len(batch)} строк отклонена API ({e.status}), "
+                                        "запись по частям")
+                        middle = len(batch) // 2
+                        await self._flush(batch[:middle])
+                        await self._flush(batch[middle:])
+                        return
+                    self._dead_letter(batch, e)
+                    return
+                logging.warning(f"Ошибка записи пачки из {len(batch)} строк ({e.status}), повтор через {backoff:.0f} с")
+            except asyncio.TimeoutError:
+                self.failed_attempts += 1
+                check_written = True
+                logging.warning(f"Таймаут записи пачки из {len(batch)} строк, повтор через {backoff:.0f} с")
+            except Exception as e:
+                self.failed_attempts += 1
+                logging.warning(f"Ошибка записи пачки из {len(batch)} строк: {e}, повтор через {backoff:.0f} с")
+            else:
+                self.bucket.reward()
+                self._written(batch, result, started)
+                return
+
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def _written(self, batch: list, result, started: float):
+        finished = time.monotonic()
+        self.rows_written += len(batch)
+        self.batches_written += 1
+        self.last_batch_size = len(batch)
+        self.max_batch_size_seen = max(self.max_batch_size_seen, len(batch))
+        self.last_write_duration = finished - started
+        self.last_flush_latency = finished - batch[0].enqueued_at
+        self.max_flush_latency = max(self.max_flush_latency, self.last_flush_latency)
+
+        for item in batch:
+            if item.on_written is not None:
+                try:
+                    item.on_written(result)
+                except Exception as e:
+                    logging.error(f"Ошибка обработчика после записи строки: {e}")
+
+    def _dead_letter(self, batch: list, error: SheetsAPIError):
+        rows = [item.row for item in batch]
+        logging.error(f"Строки отклонены API ({error}), отложены без повтора: {rows}")
+        self.dead_rows_total += len(rows)
+        self.dead_letters.append({'rows': rows, 'error': str(error)[:200], 'at': time.time()})
+        if len(self.dead_letters) > self.max_dead_letters:
+            del self.dead_letters[0]
+
+        for item in batch:
+            if item.on_rejected is not None:
+                try:
+                    item.on_rejected(error)
+                except Exception as e:
+                    logging.error(f"Ошибка обработчика отклоненной строки: {e}")
+
+    def stats(self) -> dict:
+        """Метрики очереди записи"""
+        return {
+            'depth': self.depth,
+            'rows_written': self.rows_written,
+            'batches_written': self.batches_written,
+            'failed_attempts': self.failed_attempts,
+            'dead_letters': len(self.dead_letters),
+            'dead_rows_total': self.dead_rows_total,
+            'recovered_after_timeout': self.recovered_after_timeout,
+            'avg_batch_size': round(self.rows_written / self.batches_written, 1) if self.batches_written else 0,
+            'last_batch_size': self.last_batch_size,
+            'max_batch_size': self.max_batch_size_seen,
+            'last_flush_latency': round(self.last_flush_latency, 3),
+            'max_flush_latency': round(self.max_flush_latency, 3),
+            'last_write_duration': round(self.last_write_duration, 3),
+            'bucket': self.bucket.stats()
+        }
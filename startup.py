@@ -0,0 +1,121 @@
+"""
+Замер времени запуска бота.
+
+Отсчет идет от создания процесса (на Linux - по /proc, иначе - от импорта
+этого модуля), поэтому в отчет попадают запуск интерпретатора и импорт
+библиотек. Этапы прогрева, которые идут одновременно, замеряются каждый
+отдельно. Итог - время до готовности принимать обновления и до первого
+обработанного обновления.
+"""
+
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from aiogram import BaseMiddleware
+
+_IMPORTED_AT = time.monotonic()
+
+
+def process_started_at() -> float:
+    """Момент создания процесса по часам time.monotonic()"""
+    try:
+        with open("/proc/self/stat", "r") as f:
+            # Имя процесса в скобках может содержать пробелы - разбираем поля после него
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime", "r") as f:
+            uptime = float(f.read().split()[0])
+        # Поле starttime (22-е) - в тиках с загрузки системы
+        age = uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+        return time.monotonic() - max(0.0, age)
+    except (OSError, ValueError, IndexError):
+        return _IMPORTED_AT
+
+
+class StartupReport:
+    """Время этапов запуска процесса"""
+
+    def __init__(self, started_at: float = None):
+        self.started_at = process_started_at() if started_at is None else started_at
+        self.phases = []          # [(этап, секунды, ошибка или None)]
+        self.ready_at = None
+        self.first_update_at = None
+        self._last_mark = self.started_at
+
+    def since_start(self, at: float = None) -> float:
+        return (time.monotonic() if at is None else at) - self.started_at
+
+    def mark(self, name: str):
+        """Завершение последовательного этапа: время от предыдущей отметки"""
+        now = time.monotonic()
+        self.phases.append((name, now - self._last_mark, None))
+        self._last_mark = now
+
+    @contextmanager
+    def phase(self, name: str):
+        """Замер отдельного этапа (в том числе идущего одновременно с другими)"""
+        started = time.monotonic()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"[:200]
+            raise
+        finally:
+            self.phases.append((name, time.monotonic() - started, error))
+
+    async def measure(self, name: str, awaitable, required: bool = False):
+        """Замер этапа прогрева; ошибка записывается в отчет и прерывает запуск только при required"""
+        try:
+            with self.phase(name):
+                return await awaitable
+        except Exception as e:
+            if required:
+                raise
+            logging.error(f"Ошибка этапа запуска {name}: {e}")
+            return None
+
+    def ready(self):
+        """Бот готов принимать обновления"""
+        self.ready_at = time.monotonic()
+        self._last_mark = self.ready_at
+        logging.info(self.format())
+
+    def update_served(self):
+        """Обработано первое обновление после запуска"""
+        if self.first_update_at is not None:
+            return
+        self.first_update_at = time.monotonic()
+        logging.info(
+            f"Первое обновление обработано через {self.since_start(self.first_update_at):.2f} с после запуска процесса"
+        )
+
+    def format(self) -> str:
+        lines = [f"Запуск за {self.since_start(self.ready_at):.2f} с:"]
+        for name, seconds, error in self.phases:
+            lines.append(f"  {name:<20} {seconds:7.3f} с" + (f"  ошибка: {error}" if error else ""))
+        return "\n".join(lines)
+
+    def stats(self) -> dict:
+        return {
+            'phases': {name: round(seconds, 3) for name, seconds, _ in self.phases},
+            'failed': [name for name, _, error in self.phases if error],
+            'ready_seconds': round(self.since_start(self.ready_at), 3) if self.ready_at else None,
+            'first_update_seconds': (
+                round(self.since_start(self.first_update_at), 3) if self.first_update_at else None
+            )
+        }
+
+
+class FirstUpdateMiddleware(BaseMiddleware):
+    """Отмечает первое обработанное обновление; подключается как outer middleware dp.update"""
+
+    def __init__(self, report: StartupReport):
+        self.report = report
+
+    async def __call__(self, handler, event, data):
+        result = await handler(event, data)
+        if self.report.first_update_at is None:
+            self.report.update_served()
+        return result
@@ -0,0 +1,646 @@
+"""
+Хранилище заявок.
+
+SubmissionStore - интерфейс хранилища, через который бот сохраняет
+заявки и строит статистику. Реализация по умолчанию - SQLiteSubmissionStore:
+локальная база SQLite с индексами хранит все заявки и является основным
+источником данных. Google Таблица - копия для маркетинга: заявки
+дописываются в нее в фоне и отмечаются в базе как записанные, поэтому
+после перезапуска в таблицу дописываются только незаписанные.
+
+Счетчики для /stats (по дням, городам, часам, пользователям) хранятся
+в таблице submission_counts и обновляются триггерами при каждой вставке,
+поэтому статистика не пересчитывается по всем заявкам.
+
+Запись группируется: заявки, пришедшие почти одновременно, попадают
+в базу одной транзакцией (одним fsync). Запросы выполняются в отдельном
+потоке и не блокируют цикл событий.
+"""
+
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+# Формат даты заявки в таблице
+DATE_FORMAT = "%d.%m.%Y %H:%M"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS submissions (
+    id INTEGER PRIMARY KEY,
+    city TEXT NOT NULL,
+    name TEXT NOT NULL,
+    phone TEXT NOT NULL,
+    username TEXT,
+    user_id INTEGER,
+    date TEXT NOT NULL,
+    day TEXT,
+    hour INTEGER,
+    origin INTEGER NOT NULL DEFAULT 0,
+    replicated INTEGER NOT NULL DEFAULT 0,
+    key TEXT
+);
+CREATE INDEX IF NOT EXISTS submissions_day ON submissions (day);
+CREATE INDEX IF NOT EXISTS submissions_city ON submissions (city);
+CREATE INDEX IF NOT EXISTS submissions_hour ON submissions (hour);
+CREATE INDEX IF NOT EXISTS submissions_user_id ON submissions (user_id);
+CREATE INDEX IF NOT EXISTS submissions_phone ON submissions (phone);
+CREATE INDEX IF NOT EXISTS submissions_unreplicated ON submissions (origin, id) WHERE replicated = 0;
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS submission_counts (
+    kind TEXT NOT NULL,
+    value NOT NULL,
+    n INTEGER NOT NULL,
+    PRIMARY KEY (kind, value)
+) WITHOUT ROWID;
+"""
+
+# Счетчики заявок: kind - total, users, unreplicated, rejected (value = ''), day, city, hour
+COUNTS_TRIGGERS = (
+    """
+CREATE TRIGGER IF NOT EXISTS submissions_count_insert AFTER INSERT ON submissions
+BEGIN
+    INSERT INTO submission_counts (kind, value, n) SELECT 'total', '', 1 WHERE 1
+        ON CONFLICT (kind, value) DO UPDATE SET n = n + 1;
+    INSERT INTO submission_counts (kind, value, n) SELECT 'city', NEW.city, 1 WHERE 1
+        ON CONFLICT (kind, value) DO UPDATE SET n = n + 1;
+    INSERT INTO submission_counts (kind, value, n) SELECT 'day', NEW.day, 1 WHERE NEW.day IS NOT NULL
+        ON CONFLICT (kind, value) DO UPDATE SET n = n + 1;
+    INSERT INTO submission_counts (kind, value, n) SELECT 'hour', NEW.hour, 1 WHERE NEW.hour IS NOT NULL
+        ON CONFLICT (kind, value) DO UPDATE SET n = n + 1;
+    INSERT INTO submission_counts (kind, value, n) SELECT 'unreplicated', '', 1 WHERE NEW.replicated = 0
+        ON CONFLICT (kind, value) DO UPDATE SET n = n + 1;
+    -- Первая заявка пользователя (проверка по индексу submissions_user_id)
+    INSERT INTO submission_counts (kind, value, n) SELECT 'users', '', 1
+        WHERE NEW.user_id IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM submissions WHERE user_id = NEW.user_id AND id <> NEW.id)
+        ON CONFLICT (kind, value) DO UPDATE SET n = n + 1;
+END
+""",
+    """
+CREATE TRIGGER IF NOT EXISTS submissions_count_replicated AFTER UPDATE OF replicated ON submissions
+WHEN OLD.replicated = 0 AND NEW.replicated <> 0
+BEGIN
+    UPDATE submission_counts SET n = n - 1 WHERE kind = 'unreplicated' AND value = '';
+END
+""",
+    """
+CREATE TRIGGER IF NOT EXISTS submissions_count_rejected AFTER UPDATE OF replicated ON submissions
+WHEN OLD.replicated = 0 AND NEW.replicated = -1
+BEGIN
+    INSERT INTO submission_counts (kind, value, n) SELECT 'rejected', '', 1 WHERE 1
+        ON CONFLICT (kind, value) DO UPDATE SET n = n + 1;
+END
+"""
+)
+
+# Полный пересчет счетчиков по заявкам
+COUNTS_REBUILD = (
+    "DELETE FROM submission_counts",
+    "INSERT INTO submission_counts (kind, value, n) SELECT 'total', '', COUNT(*) FROM submissions",
+    "INSERT INTO submission_counts (kind, value, n) SELECT 'city', city, COUNT(*) FROM submissions GROUP BY city",
+    "INSERT INTO submission_counts (kind, value, n) "
+    "SELECT 'day', day, COUNT(*) FROM submissions WHERE day IS NOT NULL GROUP BY day",
+    "INSERT INTO submission_counts (kind, value, n) "
+    "SELECT 'hour', hour, COUNT(*) FROM submissions WHERE hour IS NOT NULL GROUP BY hour",
+    "INSERT INTO submission_counts (kind, value, n) "
+    "SELECT 'unreplicated', '', COUNT(*) FROM submissions WHERE replicated = 0",
+    "INSERT INTO submission_counts (kind, value, n) "
+    "SELECT 'rejected', '', COUNT(*) FROM submissions WHERE replicated = -1",
+    "INSERT INTO submission_counts (kind, value, n) "
+    "SELECT 'users', '', COUNT(DISTINCT user_id) FROM submissions WHERE user_id IS NOT NULL",
+    "INSERT OR REPLACE INTO meta (key, value) VALUES ('counts', '1')"
+)
+
+COLUMNS = ("id", "city", "name", "phone", "username", "user_id", "date")
+
+# replicated = -1: Google Таблица отклонила строку заявки, повторно она не отправляется
+REJECTED = -1
+
+
+def split_date(date: str):
+    """День (гггг-мм-дд) и час заявки по дате "дд.мм.гггг чч:мм" """
+    try:
+        moment = datetime.strptime(str(date).strip(), DATE_FORMAT)
+    except ValueError:
+        try:
+            moment = datetime.strptime(str(date).strip().split()[0], "%d.%m.%Y")
+            return moment.strftime("%Y-%m-%d"), None
+        except (ValueError, IndexError):
+            return None, None
+    return moment.strftime("%Y-%m-%d"), moment.hour
+
+
+def row_to_record(row: list) -> dict:
+    """Заявка из строки Google Таблицы"""
+    row = [str(value).strip() for value in row] + [""] * (6 - len(row))
+    try:
+        user_id = int(row[4])
+    except ValueError:
+        user_id = None
+    username = row[3] if row[3] and row[3] != "Не указан" else None
+    return {
+        'city': row[0] or "Не указан",
+        'name': row[1],
+        'phone': row[2],
+        'username': username,
+        'user_id': user_id,
+        'date': row[5]
+    }
+
+
+class SubmissionStore:
+    """Интерфейс хранилища заявок"""
+
+    async def open(self):
+        """Подготовка хранилища к работе"""
+        raise NotImplementedError
+
+    async def add(self, record: dict) -> dict:
+        """Сохранение заявки; возвращает заявку с присвоенным id
+
+        record['key'] (если есть) - ключ идемпотентности: повторное сохранение
+        заявки с тем же ключом возвращает id уже сохраненной, а не создает новую.
+        """
+        raise NotImplementedError
+
+    def mark_replicated(self, submission_id: int, sheet_row: int = None):
+        """Заявка записана в Google Таблицу (sheet_row - последняя строка записанной пачки)"""
+        raise NotImplementedError
+
+    def mark_rejected(self, submission_id: int):
+        """Google Таблица отклонила заявку: она остается в базе, но в таблицу больше не отправляется"""
+        raise NotImplementedError
+
+    async def unreplicated(self, origin: int = None) -> list:
+        """Заявки, еще не записанные в Google Таблицу, по порядку"""
+        raise NotImplementedError
+
+    async def import_records(self, key: str, records: list, replicated: bool, last_sheet_row: int = None) -> int:
+        """Однократная загрузка заявок из другого источника (key - название источника);
+        возвращает число загруженных заявок, 0 - источник уже загружен.
+        last_sheet_row - последняя строка таблицы, если заявки прочитаны из нее"""
+        raise NotImplementedError
+
+    async def merge_sheet_records(self, records: list, last_sheet_row: int) -> int:
+        """Загрузка заявок, добавленных в таблицу вне бота (уже сохраненные пропускаются);
+        возвращает число загруженных заявок"""
+        raise NotImplementedError
+
+    async def is_imported(self, key: str) -> bool:
+        """Источник key уже загружен (чтобы не читать его повторно)"""
+        raise NotImplementedError
+
+    async def get(self, submission_id: int):
+        """Заявка по id или None"""
+        raise NotImplementedError
+
+    async def registrations(self, after_id: int, limit: int) -> list:
+        """[(id заявки, телефон, user_id)] после заявки after_id - для индекса повторных регистраций"""
+        raise NotImplementedError
+
+    async def export_rows(self, after_id: int, limit: int, day_from: str = None, day_to: str = None,
+                          city: str = None) -> list:
+        """Заявки после after_id по фильтру (дни - ГГГГ-ММ-ДД включительно), по порядку id - для /export"""
+        raise NotImplementedError
+
+    async def summary(self, days: int = 7, cities: int = 10, hours: int = 3) -> dict:
+        """Сводная статистика для /stats"""
+        raise NotImplementedError
+
+    async def rebuild_counts(self):
+        """Пересчет счетчиков статистики по всем заявкам"""
+        raise NotImplementedError
+
+    async def replicated_count(self) -> int:
+        """Число заявок, записанных в Google Таблицу"""
+        raise NotImplementedError
+
+    async def user_ids_from(self, first_id: int, limit: int) -> list:
+        """[(id заявки, user_id)] начиная с заявки first_id - для рассылки"""
+        raise NotImplementedError
+
+    async def last_id(self) -> int:
+        raise NotImplementedError
+
+    @property
+    def last_sheet_row(self):
+        """Последняя строка таблицы, в которую точно записана заявка"""
+        raise NotImplementedError
+
+    async def close(self):
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        raise NotImplementedError
+
+
+class SQLiteSubmissionStore(SubmissionStore):
+    """Заявки в локальной базе SQLite с групповой записью"""
+
+    def __init__(self, path: str, origin: int = 0, commit_delay: float = 0.02, commit_batch: int = 256):
+        self.path = path
+        self.origin = origin          # Номер процесса, принявшего заявку
+        self.commit_delay = commit_delay
+        self.commit_batch = commit_batch
+
+        self._write_db = None
+        self._read_db = None
+        self._read_lock = threading.Lock()
+        self._pending = []            # [(заявка, future)] - ждут записи
+        self._replicated = {}         # {id заявки: строка таблицы} - ждут отметки
+        self._rejected = set()        # id заявок, отклоненных таблицей, - ждут отметки
+        self._last_sheet_row = None
+        self._wakeup = None
+        self._task = None
+        self._stopping = False
+
+        self.commits = 0
+        self.records_written = 0
+        self.last_query_ms = 0.0
+
+    # ---------------- Открытие ----------------
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        db.execute("PRAGMA journal_mode=WAL")
+        # FULL - каждая транзакция доходит до диска: принятая заявка не потеряется
+        db.execute("PRAGMA synchronous=FULL")
+        return db
+
+    def _open(self):
+        self._write_db = self._connect()
+        self._write_db.executescript(SCHEMA)
+        self._migrate(self._write_db)
+        self._read_db = self._connect()
+        row = self._read_db.execute("SELECT value FROM meta WHERE key = 'last_sheet_row'").fetchone()
+        self._last_sheet_row = int(row[0]) if row else None
+
+    @staticmethod
+    def _migrate(db: sqlite3.Connection):
+        """Изменения схемы для баз, созданных прежними версиями"""
+        # BEGIN IMMEDIATE: процессы, открывающие базу одновременно, не меняют схему дважды
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            columns = {row[1] for row in db.execute("PRAGMA table_info(submissions)")}
+            if "key" not in columns:
+                db.execute("ALTER TABLE submissions ADD COLUMN key TEXT")
+            db.execute("CREATE UNIQUE INDEX IF NOT EXISTS submissions_key ON submissions (key)")
+            for trigger in COUNTS_TRIGGERS:
+                db.execute(trigger)
+            # Счетчики появились позже заявок - один раз считаем их по уже сохраненным
+            if not db.execute("SELECT 1 FROM meta WHERE key = 'counts'").fetchone():
+                SQLiteSubmissionStore._rebuild_counts(db)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+    @staticmethod
+    def _rebuild_counts(db: sqlite3.Connection):
+        """Пересчет счетчиков (внутри транзакции вызывающего)"""
+        for statement in COUNTS_REBUILD:
+            db.execute(statement)
+
+    async def open(self):
+        await asyncio.to_thread(self._open)
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        stats = await self.summary(days=1, cities=0, hours=0)
+        logging.info(
+            f"Хранилище заявок {self.path} открыто: заявок {stats['total']}, "
+            f"не записано в таблицу {stats['unreplicated']}"
+        )
+
+    # ---------------- Запись ----------------
+
+    async def add(self, record: dict) -> dict:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((record, future))
+        self._wakeup.set()
+        submission_id = await future
+        return {**record, 'id': submission_id}
+
+    def mark_replicated(self, submission_id: int, sheet_row: int = None):
+        self._replicated[submission_id] = sheet_row
+        self._wakeup.set()
+
+    def mark_rejected(self, submission_id: int):
+        self._rejected.add(submission_id)
+        self._wakeup.set()
+
+    async def _run(self):
+        # Цикл не отменяется, а останавливается по _stopping: отмена прервала бы ожидание
+        # транзакции, а поток продолжил бы писать в базу, которую close() уже закрывает
+        while not self._stopping:
+            await self._wakeup.wait()
+            # Небольшое ожидание, чтобы собрать в транзакцию одновременные заявки
+            if len(self._pending) < self.commit_batch and not self._stopping:
+                await asyncio.sleep(self.commit_delay)
+            self._wakeup.clear()
+            await self._commit()
+
+    async def _commit(self):
+        pending, self._pending = self._pending, []
+        replicated, self._replicated = self._replicated, {}
+        rejected, self._rejected = self._rejected, set()
+        if not pending and not replicated and not rejected:
+            return
+        try:
+            ids = await asyncio.to_thread(self._write, [record for record, _ in pending], replicated, rejected)
+        except Exception as e:
+            logging.error(f"Ошибка записи в хранилище заявок: {e}")
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            # Отметки о записи в таблицу повторим со следующей транзакцией
+            self._replicated = {**replicated, **self._replicated}
+            self._rejected |= rejected
+            return
+
+        written = 0
+        for (record, future), submission_id in zip(pending, ids):
+            if isinstance(submission_id, Exception):
+                # Ошибка одной заявки не отменяет остальные заявки транзакции
+                logging.error(f"Заявка не сохранена ({submission_id}): {record}")
+                if not future.done():
+                    future.set_exception(submission_id)
+                continue
+            written += 1
+            if not future.done():
+                future.set_result(submission_id)
+        self.commits += 1
+        self.records_written += written
+
+    def _write(self, records: list, replicated: dict, rejected: set = ()) -> list:
+        """Запись пачки одной транзакцией; для каждой заявки - id или исключение"""
+        ids = []
+        with self._write_db:
+            for record in records:
+                ids.append(self._insert(record))
+            if replicated:
+                self._write_db.executemany(
+                    "UPDATE submissions SET replicated = 1 WHERE id = ?",
+                    [(submission_id,) for submission_id in replicated]
+                )
+                rows = [row for row in replicated.values() if row]
+                if rows:
+                    self._last_sheet_row = self._save_last_sheet_row(self._write_db, max(rows))
+            if rejected:
+                self._write_db.executemany(
+                    "UPDATE submissions SET replicated = ? WHERE id = ? AND replicated = 0",
+                    [(REJECTED, submission_id) for submission_id in rejected]
+                )
+        return ids
+
+    def _insert(self, record: dict):
+        """Вставка одной заявки внутри транзакции _write: id или исключение
+
+        Ошибка в SQLite откатывает только эту вставку, поэтому остальные заявки
+        пачки сохраняются.
+        """
+        try:
+            day, hour = split_date(record['date'])
+            # Заявка с тем же ключом уже сохранена (повтор после таймаута) - возвращаем ее id.
+            # ON CONFLICT (key), а не OR IGNORE: заявка с пустым обязательным полем
+            # должна завершиться ошибкой, а не пропуститься молча
+            cursor = self._write_db.execute(
+                "INSERT INTO submissions "
+                "(city, name, phone, username, user_id, date, day, hour, origin, key) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (key) DO NOTHING",
+                (record['city'], record['name'], record['phone'], record.get('username'),
+                 record.get('user_id'), record['date'], day, hour, self.origin, record.get('key'))
+            )
+            if cursor.rowcount:
+                return cursor.lastrowid
+            row = self._write_db.execute("SELECT id FROM submissions WHERE key = ?", (record.get('key'),)).fetchone()
+            if row is None:
+                return sqlite3.IntegrityError(f"заявка не записана и не найдена по ключу: {record}")
+            return row[0]
+        except (sqlite3.IntegrityError, KeyError, TypeError) as e:
+            return e
+
+    @staticmethod
+    def _save_last_sheet_row(db: sqlite3.Connection, row: int) -> int:
+        """Последняя строка таблицы не уменьшается: ее пишут и процессы, и загрузка из таблицы"""
+        db.execute(
+            "INSERT INTO meta (key, value) VALUES ('last_sheet_row', ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = MAX(CAST(value AS INTEGER), excluded.value)",
+            (row,)
+        )
+        return int(db.execute("SELECT value FROM meta WHERE key = 'last_sheet_row'").fetchone()[0])
+
+    async def import_records(self, key: str, records: list, replicated: bool, last_sheet_row: int = None) -> int:
+        return await asyncio.to_thread(self._import, key, records, replicated, last_sheet_row)
+
+    async def merge_sheet_records(self, records: list, last_sheet_row: int) -> int:
+        return await asyncio.to_thread(self._import, None, records, True, last_sheet_row)
+
+    def _import(self, key, records: list, replicated: bool, last_sheet_row: int = None) -> int:
+        # Отдельное соединение: транзакция загрузки не смешивается с групповой записью,
+        # которая в это же время идет через self._write_db в другом потоке.
+        # BEGIN IMMEDIATE: проверка и загрузка одной транзакцией, даже если процессов несколько
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                if key is not None and db.execute(
+                    "SELECT 1 FROM meta WHERE key = ?", ("import:" + key,)
+                ).fetchone():
+                    db.rollback()
+                    return 0
+                imported = 0
+                for record in records:
+                    values = (record['city'], record['name'], record['phone'], record.get('username'),
+                              record.get('user_id'), record['date'], *split_date(record['date']),
+                              self.origin, int(replicated))
+                    if db.execute(
+                        "SELECT 1 FROM submissions WHERE user_id IS ? AND date = ? AND phone = ?",
+                        (record.get('user_id'), record['date'], record['phone'])
+                    ).fetchone():
+                        # Заявка уже есть: записана ботом или загружена из другого источника
+                        continue
+                    db.execute(
+                        "INSERT INTO submissions (city, name, phone, username, user_id, date, day, hour, origin, replicated) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        values
+                    )
+                    imported += 1
+                sheet_row = None
+                if last_sheet_row:
+                    sheet_row = self._save_last_sheet_row(db, last_sheet_row)
+                if key is not None:
+                    db.execute("INSERT INTO meta (key, value) VALUES (?, ?)", ("import:" + key, str(imported)))
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+        finally:
+            db.close()
+        if sheet_row is not None:
+            self._last_sheet_row = max(sheet_row, self._last_sheet_row or 0)
+        return imported
+
+    # ---------------- Чтение ----------------
+
+    def _query(self, sql: str, params=()) -> list:
+        with self._read_lock:
+            return self._read_db.execute(sql, params).fetchall()
+
+    async def query(self, sql: str, params=()) -> list:
+        """Запрос на чтение в отдельном потоке"""
+        return await asyncio.to_thread(self._query, sql, params)
+
+    async def is_imported(self, key: str) -> bool:
+        return bool(await self.query("SELECT 1 FROM meta WHERE key = ?", ("import:" + key,)))
+
+    async def unreplicated(self, origin: int = None) -> list:
+        rows = await self.query(
+            f"SELECT {', '.join(COLUMNS)} FROM submissions WHERE replicated = 0 AND origin = ? ORDER BY id",
+            (self.origin if origin is None else origin,)
+        )
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+    async def get(self, submission_id: int):
+        rows = await self.query(f"SELECT {', '.join(COLUMNS)} FROM submissions WHERE id = ?", (submission_id,))
+        return dict(zip(COLUMNS, rows[0])) if rows else None
+
+    async def registrations(self, after_id: int, limit: int) -> list:
+        return await self.query(
+            "SELECT id, phone, user_id FROM submissions WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit)
+        )
+
+    async def export_rows(self, after_id: int, limit: int, day_from: str = None, day_to: str = None,
+                          city: str = None) -> list:
+        # Постраничная выборка по id: каждая порция - быстрый запрос по индексу, без OFFSET
+        conditions, params = ["id > ?"], [after_id]
+        if day_from:
+            conditions.append("day >= ?")
+            params.append(day_from)
+        if day_to:
+            conditions.append("day <= ?")
+            params.append(day_to)
+        if city:
+            conditions.append("city = ?")
+            params.append(city)
+        rows = await self.query(
+            f"SELECT {', '.join(COLUMNS)} FROM submissions WHERE {' AND '.join(conditions)} ORDER BY id LIMIT ?",
+            (*params, limit)
+        )
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+    def _summary(self, days: int, cities: int, hours: int) -> dict:
+        # Только чтение счетчиков submission_counts - без обхода заявок
+        started = time.perf_counter()
+        today = datetime.now()
+        first_day = (today - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+        with self._read_lock:
+            db = self._read_db
+            totals = dict(db.execute(
+                "SELECT kind, n FROM submission_counts WHERE kind IN ('total', 'users', 'unreplicated', 'rejected')"
+            ).fetchall())
+            by_day = dict(db.execute(
+                "SELECT value, n FROM submission_counts WHERE kind = 'day' AND value >= ?", (first_day,)
+            ).fetchall())
+            top_cities = db.execute(
+                "SELECT value, n FROM submission_counts WHERE kind = 'city' AND n > 0 "
+                "ORDER BY n DESC LIMIT ?", (cities,)
+            ).fetchall()
+            peak_hours = db.execute(
+                "SELECT value, n FROM submission_counts WHERE kind = 'hour' AND n > 0 "
+                "ORDER BY n DESC LIMIT ?", (hours,)
+            ).fetchall()
+        total = totals.get('total', 0)
+        users = totals.get('users', 0)
+        unreplicated = totals.get('unreplicated', 0)
+        rejected = totals.get('rejected', 0)
+
+        last_days = []
+        for offset in range(days):
+            day = today - timedelta(days=offset)
+            last_days.append((day.strftime("%d.%m.%Y"), by_day.get(day.strftime("%Y-%m-%d"), 0)))
+        self.last_query_ms = (time.perf_counter() - started) * 1000
+        return {
+            'total': total,
+            'today': by_day.get(today.strftime("%Y-%m-%d"), 0),
+            'users': users,
+            'last_days': last_days,
+            'top_cities': top_cities,
+            'peak_hours': peak_hours,
+            'unreplicated': unreplicated,
+            'rejected': rejected,
+            'query_ms': round(self.last_query_ms, 2)
+        }
+
+    async def summary(self, days: int = 7, cities: int = 10, hours: int = 3) -> dict:
+        return await asyncio.to_thread(self._summary, days, cities, hours)
+
+    def _rebuild_counts_now(self):
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                self._rebuild_counts(db)
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+        finally:
+            db.close()
+
+    async def rebuild_counts(self):
+        await asyncio.to_thread(self._rebuild_counts_now)
+
+    async def replicated_count(self) -> int:
+        rows = await self.query(
+            "SELECT COALESCE(SUM(CASE kind WHEN 'total' THEN n ELSE -n END), 0) "
+            "FROM submission_counts WHERE kind IN ('total', 'unreplicated', 'rejected')"
+        )
+        return rows[0][0]
+
+    async def user_ids_from(self, first_id: int, limit: int) -> list:
+        return await self.query(
+            "SELECT id, user_id FROM submissions WHERE id >= ? AND user_id IS NOT NULL ORDER BY id LIMIT ?",
+            (first_id, limit)
+        )
+
+    async def last_id(self) -> int:
+        return (await self.query("SELECT COALESCE(MAX(id), 0) FROM submissions"))[0][0]
+
+    @property
+    def last_sheet_row(self):
+        return self._last_sheet_row
+
+    # ---------------- Остановка ----------------
+
+    async def close(self):
+        """Запись оставшихся изменений и закрытие базы"""
+        self._stopping = True
+        if self._task is not None:
+            self._wakeup.set()
+            # Дожидаемся текущей транзакции - соединения закрываются только после нее
+            await self._task
+        await self._commit()
+        if self._write_db is not None:
+            await asyncio.to_thread(self._write_db.close)
+            await asyncio.to_thread(self._read_db.close)
+
+    def stats(self) -> dict:
+        return {
+            'pending': len(self._pending),
+            'replication_marks_pending': len(self._replicated) + len(self._rejected),
+            'commits': self.commits,
+            'records_written': self.records_written,
+            'avg_commit_size': round(self.records_written / self.commits, 1) if self.commits else 0,
+            'last_sheet_row': self._last_sheet_row,
+            'last_query_ms': round(self.last_query_ms, 2)
+        }
+
+
+def create_submission_store(kind: str, path: str, origin: int = 0, commit_delay: float = 0.02) -> SubmissionStore:
+    """Создание хранилища заявок по названию из настроек"""
+    if kind == "sqlite":
+        return SQLiteSubmissionStore(path, origin=origin, commit_delay=commit_delay)
+    raise ValueError(f"Неизвестное хранилище заявок: {kind}")
@@ -0,0 +1,343 @@
+"""
+Запуск бота в нескольких процессах.
+
+Супервизор запускает WORKERS процессов-обработчиков (python bot.py с
+переменными окружения BOT_WORKER_ID и BOT_WORKER_PORT) и перезапускает
+их при падении. Обновления от Telegram получает только супервизор
+(polling или webhook) и раздает их процессам по user_id: все обновления
+одного пользователя попадают в один процесс, поэтому шаги анкеты
+обрабатываются по порядку. Каждому процессу обновления уходят пачками
+по одному HTTP-соединению, порядок внутри пачки сохраняется.
+
+Встроенный тест масштабирования:
+    python supervisor.py --benchmark [--workers 1,2,4] [--updates 20000] [--work-ms 1]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import secrets
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+from webhook import SECRET_HEADER, WebhookServer, check_secret, shard
+
+
+class UpdateRouter:
+    """Раздача обновлений процессам-обработчикам по user_id"""
+
+    def __init__(self, worker_urls: list, secret: str, batch_size: int = 200, queue_size: int = 10000):
+        self.worker_urls = worker_urls
+        self.secret = secret
+        self.batch_size = batch_size
+        self._queues = [asyncio.Queue(maxsize=queue_size) for _ in worker_urls]
+        self._tasks = []
+        self._session = None
+
+        self.routed = 0
+        self.forwarded = [0] * len(worker_urls)
+        self.forward_errors = 0
+
+    def route(self, update: dict) -> bool:
+        """Постановка обновления в очередь процесса; False - очередь переполнена"""
+        queue = self._queues[shard(update, len(self._queues))]
+        if queue.full():
+            return False
+        queue.put_nowait(update)
+        self.routed += 1
+        return True
+
+    async def _forward(self, index: int):
+        queue = self._queues[index]
+        url = self.worker_urls[index]
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self.batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+
+            # Пачка отправляется, пока процесс ее не примет: при перезапуске процесса обновления не теряются
+            delay = 0.1
+            while True:
+                try:
+                    async with self._session.post(url, json=batch, headers={SECRET_HEADER: self.secret}) as response:
+                        if response.status == 200:
+                            break
+                        raise RuntimeError(f"HTTP {response.status}")
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.forward_errors += 1
+                    logging.warning(f"Процесс {index} не принял пачку обновлений: {e}")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 5)
+
+            self.forwarded[index] += len(batch)
+            for _ in batch:
+                queue.task_done()
+
+    def start(self):
+        self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60))
+        self._tasks = [asyncio.create_task(self._forward(index)) for index in range(len(self._queues))]
+
+    async def stop(self, timeout: float = 10):
+        """Остановка после отправки уже полученных обновлений"""
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Не все обновления переданы процессам при остановке")
+        for task in self._tasks:
+            task.cancel()
+        if self._session is not None:
+            await self._session.close()
+
+    async def poll(self, api_url: str, allowed_updates: list = None, timeout: int = 30):
+        """Получение обновлений long polling'ом (api_url - адрес метода getUpdates)"""
+        offset = None
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout + 10)) as session:
+            while True:
+                params = {'timeout': timeout}
+                if offset is not None:
+                    params['offset'] = offset
+                if allowed_updates is not None:
+                    params['allowed_updates'] = json.dumps(allowed_updates)
+                try:
+                    async with session.get(api_url, params=params) as response:
+                        data = await response.json()
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    logging.error(f"Ошибка получения обновлений: {e}")
+                    await asyncio.sleep(1)
+                    continue
+                if not data.get('ok'):
+                    retry_after = data.get('parameters', {}).get('retry_after', 1)
+                    logging.error(f"Telegram вернул ошибку getUpdates: {data.get('description')}")
+                    await asyncio.sleep(retry_after)
+                    continue
+
+                for update in data['result']:
+                    while not self.route(update):
+                        await asyncio.sleep(0.05)
+                    offset = update['update_id'] + 1
+
+    def create_app(self, path: str, secret: str, health=None) -> web.Application:
+        """Прием webhook-обновлений от Telegram для раздачи процессам"""
+        async def handle_update(request: web.Request) -> web.Response:
+            if not check_secret(request, secret):
+                return web.Response(status=401)
+            try:
+                update = await request.json()
+            except ValueError:
+                return web.Response(status=400)
+            # При переполнении Telegram повторит доставку позже
+            return web.Response(status=200 if self.route(update) else 503)
+
+        async def handle_health(request: web.Request) -> web.Response:
+            return web.json_response({'status': 'ok', 'mode': 'supervisor', **(health() if health else self.stats())})
+
+        app = web.Application()
+        app.router.add_post(path, handle_update)
+        app.router.add_get("/healthz", handle_health)
+        return app
+
+    def stats(self) -> dict:
+        return {
+            'routed': self.routed,
+            'forwarded': list(self.forwarded),
+            'queued': [queue.qsize() for queue in self._queues],
+            'forward_errors': self.forward_errors
+        }
+
+
+class Supervisor:
+    """Запуск и перезапуск процессов-обработчиков"""
+
+    def __init__(self, command: list, count: int, base_port: int, host: str = "127.0.0.1",
+                 path: str = "/worker", env: dict = None):
+        self.command = command
+        self.count = count
+        self.base_port = base_port
+        self.host = host
+        self.path = path
+        self.secret = secrets.token_urlsafe(24)
+        self.env = env or {}
+        self._processes = [None] * count
+        self._tasks = []
+        self._stopping = False
+
+        self.restarts = 0
+
+    @property
+    def worker_urls(self) -> list:
+        return [f"http://{self.host}:{self.base_port + index}{self.path}" for index in range(self.count)]
+
+    async def _spawn(self, index: int):
+        env = {
+            **os.environ,
+            **self.env,
+            'BOT_WORKER_ID': str(index),
+            'BOT_WORKER_COUNT': str(self.count),
+            'BOT_WORKER_PORT': str(self.base_port + index),
+            'BOT_WORKER_PATH': self.path,
+            'BOT_WORKER_SECRET': self.secret
+        }
+        return await asyncio.create_subprocess_exec(*self.command, env=env)
+
+    async def _watch(self, index: int):
+        delay = 1
+        while not self._stopping:
+            started_at = time.monotonic()
+            process = self._processes[index] = await self._spawn(index)
+            logging.info(f"Процесс {index} запущен (pid {process.pid})")
+            code = await process.wait()
+            if self._stopping:
+                return
+            self.restarts += 1
+            # Быстро падающий процесс перезапускаем все реже
+            delay = 1 if time.monotonic() - started_at > 60 else min(delay * 2, 60)
+            logging.error(f"Процесс {index} завершился с кодом {code}, перезапуск через {delay} с")
+            await asyncio.sleep(delay)
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._watch(index)) for index in range(self.count)]
+
+    async def wait_ready(self, timeout: float = 60):
+        """Ожидание, пока все процессы начнут принимать обновления"""
+        deadline = time.monotonic() + timeout
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=2)) as session:
+            for index in range(self.count):
+                url = f"http://{self.host}:{self.base_port + index}/healthz"
+                while True:
+                    try:
+                        async with session.get(url) as response:
+                            if response.status == 200:
+                                break
+                    except (aiohttp.ClientError, asyncio.TimeoutError):
+                        pass
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(f"Процесс {index} не запустился за {timeout} с")
+                    await asyncio.sleep(0.2)
+
+    async def workers_health(self) -> list:
+        """Состояние процессов по их /healthz"""
+        result = []
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=2)) as session:
+            for index in range(self.count):
+                try:
+                    async with session.get(f"http://{self.host}:{self.base_port + index}/healthz") as response:
+                        result.append(await response.json())
+                except Exception as e:
+                    result.append({'status': 'down', 'error': str(e)})
+        return result
+
+    async def stop(self, timeout: float = 20):
+        """Остановка процессов: SIGTERM, затем SIGKILL"""
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        running = [process for process in self._processes if process and process.returncode is None]
+        for process in running:
+            process.terminate()
+        try:
+            await asyncio.wait_for(asyncio.gather(*(process.wait() for process in running)), timeout)
+        except asyncio.TimeoutError:
+            for process in running:
+                if process.returncode is None:
+                    process.kill()
+
+
+# =====================================================
+# ТЕСТ МАСШТАБИРОВАНИЯ
+# =====================================================
+
+class _BenchDispatcher:
+    """Обработчик для теста: фиксированная нагрузка на процессор на каждое обновление"""
+
+    def __init__(self, work_ms: float):
+        self.work = work_ms / 1000
+
+    async def feed_raw_update(self, bot, update):
+        deadline = time.perf_counter() + self.work
+        while time.perf_counter() < deadline:
+            json.loads(json.dumps(update))
+
+
+async def _bench_worker(work_ms: float):
+    server = WebhookServer(
+        _BenchDispatcher(work_ms), None, os.environ['BOT_WORKER_PATH'],
+        secret=os.environ['BOT_WORKER_SECRET'], workers=8
+    )
+    await server.start("127.0.0.1", int(os.environ['BOT_WORKER_PORT']))
+    await asyncio.Event().wait()
+
+
+async def _bench_run(count: int, updates: int, work_ms: float, base_port: int) -> dict:
+    supervisor = Supervisor(
+        [sys.executable, os.path.abspath(__file__), "--bench-worker", "--work-ms", str(work_ms)],
+        count, base_port
+    )
+    supervisor.start()
+    try:
+        await supervisor.wait_ready()
+        router = UpdateRouter(supervisor.worker_urls, supervisor.secret)
+        router.start()
+
+        started = time.perf_counter()
+        for update_id in range(updates):
+            update = {'update_id': update_id, 'message': {'from': {'id': 100000 + update_id % 5000}, 'text': 'x'}}
+            while not router.route(update):
+                await asyncio.sleep(0.001)
+        await router.stop(timeout=600)
+
+        # Ждем, пока процессы обработают все обновления
+        while True:
+            processed = sum(health.get('processed', 0) for health in await supervisor.workers_health())
+            if processed >= updates:
+                break
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+    finally:
+        await supervisor.stop()
+
+    return {'workers': count, 'seconds': round(elapsed, 3), 'updates_per_second': round(updates / elapsed)}
+
+
+async def _benchmark(counts: list, updates: int, work_ms: float, base_port: int):
+    results = []
+    for count in counts:
+        result = await _bench_run(count, updates, work_ms, base_port)
+        if results:
+            result['speedup'] = round(result['updates_per_second'] / results[0]['updates_per_second'], 2)
+            result['efficiency'] = round(result['speedup'] / (count / results[0]['workers']), 2)
+        results.append(result)
+        print(json.dumps(result, ensure_ascii=False), flush=True)
+
+    print(f"\nЯдер процессора: {os.cpu_count()}, обновлений: {updates}, нагрузка: {work_ms} мс на обновление")
+    print(f"{'процессов':>10} {'обн/с':>10} {'ускорение':>10} {'эффективность':>14}")
+    for result in results:
+        print(
+            f"{result['workers']:>10} {result['updates_per_second']:>10} "
+            f"{result.get('speedup', 1.0):>10} {result.get('efficiency', 1.0):>14}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Тест масштабирования бота по процессам")
+    parser.add_argument("--benchmark", action="store_true")
+    parser.add_argument("--bench-worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--workers", default=",".join(str(n) for n in (1, 2, 4, 8) if n <= (os.cpu_count() or 1)))
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--work-ms", type=float, default=1.0)
+    parser.add_argument("--base-port", type=int, default=8200)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.bench_worker:
+        asyncio.run(_bench_worker(args.work_ms))
+    elif args.benchmark:
+        asyncio.run(_benchmark([int(n) for n in args.workers.split(",")], args.updates, args.work_ms, args.base_port))
+    else:
+        parser.print_help()
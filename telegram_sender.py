@@ -0,0 +1,227 @@
+"""
+Ограничение частоты исходящих запросов к Telegram Bot API.
+
+Подключается как middleware сессии бота, поэтому действует на все
+вызовы (message.answer, answer_photo, bot.send_message и т.д.) без
+изменения обработчиков. Запросы не отбрасываются, а ждут своей очереди:
+общий token bucket ограничивает скорость всего бота, отдельные bucket'ы -
+скорость в каждом чате. Ответы пользователям обслуживаются раньше
+сообщений в канал админов и массовых рассылок. При ответе RetryAfter
+запрос повторяется после указанной паузы.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from ratelimit import TokenBucket
+
+# Приоритеты (меньше - важнее)
+PRIORITY_USER = 0
+PRIORITY_ADMIN = 1
+PRIORITY_BULK = 2
+
+# Приоритет, явно заданный для текущей задачи (например, для рассылки)
+current_priority = ContextVar("current_priority", default=None)
+
+
+@contextmanager
+def sending_priority(priority: int):
+    """Задать приоритет всех отправок внутри блока"""
+    token = current_priority.set(priority)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+def is_group_chat(chat_id) -> bool:
+    """Группы и каналы имеют отрицательный ID или @username"""
+    try:
+        return int(chat_id) < 0
+    except (TypeError, ValueError):
+        return True
+
+
+class OutboundLimiter:
+    """Планировщик исходящих запросов с общим и поканальными лимитами"""
+
+    def __init__(self, global_rate: float = 30, private_rate: float = 1,
+                 private_burst: float = 3, group_rate: float = 20 / 60, group_burst: float = 3,
+                 idle_chat_ttl: float = 300):
+        self.global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self.private_rate = private_rate
+        self.private_burst = private_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.idle_chat_ttl = idle_chat_ttl
+
+        self._chats = {}  # {chat_id: (bucket, время последнего использования)}
+        self._waiters = []  # куча (приоритет, порядковый номер, chat_id, future)
+        self._counter = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self._last_cleanup = time.monotonic()
+
+        self.granted = {PRIORITY_USER: 0, PRIORITY_ADMIN: 0, PRIORITY_BULK: 0}
+        self.retry_after_total = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        key = str(chat_id)
+        entry = self._chats.get(key)
+        if entry is None:
+            if is_group_chat(chat_id):
+                bucket = TokenBucket(self.group_rate, capacity=self.group_burst)
+            else:
+                bucket = TokenBucket(self.private_rate, capacity=self.private_burst)
+        else:
+            bucket = entry[0]
+        self._chats[key] = (bucket, time.monotonic())
+        return bucket
+
+    def _cleanup(self):
+        # Удаляем bucket'ы давно неактивных чатов, чтобы словарь не рос бесконечно
+        now = time.monotonic()
+        if now - self._last_cleanup < self.idle_chat_ttl:
+            return
+        self._last_cleanup = now
+        waiting = {str(chat_id) for _, _, chat_id, _ in self._waiters}
+        for key, (_, last_used) in list(self._chats.items()):
+            if now - last_used > self.idle_chat_ttl and key not in waiting:
+                del self._chats[key]
+
+    async def acquire(self, chat_id, priority: int = PRIORITY_USER):
+        """Дождаться разрешения на отправку в чат"""
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        queued_at = time.monotonic()
+        heapq.heappush(self._waiters, (priority, next(self._counter), chat_id, future))
+        self._wakeup.set()
+        await future
+
+        waited = time.monotonic() - queued_at
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    async def _run(self):
+        while True:
+            self._cleanup()
+            # Отменённые ожидания убираем из очереди
+            if any(entry[3].done() for entry in self._waiters):
+                self._waiters = [entry for entry in self._waiters if not entry[3].done()]
+                heapq.heapify(self._waiters)
+
+            if not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            global_wait = self.global_bucket.delay()
+            if global_wait > 0:
+                await asyncio.sleep(global_wait)
+                continue
+
+            # Первый по приоритету запрос, чат которого может принять сообщение
+            chosen = None
+            min_wait = None
+            for entry in sorted(self._waiters):
+                chat_wait = self._chat_bucket(entry[2]).delay()
+                if chat_wait <= 0:
+                    chosen = entry
+                    break
+                min_wait = chat_wait if min_wait is None else min(min_wait, chat_wait)
+
+            if chosen is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), min_wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._waiters.remove(chosen)
+            heapq.heapify(self._waiters)
+            self.global_bucket.try_acquire()
+            self._chat_bucket(chosen[2]).try_acquire()
+            self.granted[chosen[0]] = self.granted.get(chosen[0], 0) + 1
+            chosen[3].set_result(None)
+
+    def retry_after(self, chat_id, seconds: float):
+        """Telegram попросил подождать: пауза для чата"""
+        self.retry_after_total += 1
+        self._chat_bucket(chat_id).penalize(seconds)
+
+    def sent(self, chat_id):
+        """Успешная отправка: скорость чата постепенно восстанавливается после RetryAfter"""
+        self._chat_bucket(chat_id).reward()
+
+    def queued(self) -> dict:
+        """Сколько запросов ждет отправки, по приоритетам"""
+        result = {PRIORITY_USER: 0, PRIORITY_ADMIN: 0, PRIORITY_BULK: 0}
+        for priority, _, _, future in self._waiters:
+            if not future.done():
+                result[priority] = result.get(priority, 0) + 1
+        return result
+
+    def stats(self) -> dict:
+        granted_total = sum(self.granted.values())
+        return {
+            'queued': self.queued(),
+            'granted': dict(self.granted),
+            'retry_after_total': self.retry_after_total,
+            'avg_wait': round(self.total_wait / granted_total, 3) if granted_total else 0,
+            'max_wait': round(self.max_wait, 3),
+            'tracked_chats': len(self._chats)
+        }
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: все запросы с chat_id проходят через OutboundLimiter"""
+
+    def __init__(self, limiter: OutboundLimiter, admin_chats=(), max_retries: int = 5):
+        self.limiter = limiter
+        self.admin_chats = {str(chat_id) for chat_id in admin_chats}
+        self.max_retries = max_retries
+
+    def _priority(self, chat_id) -> int:
+        priority = current_priority.get()
+        if priority is not None:
+            return priority
+        if str(chat_id) in self.admin_chats:
+            return PRIORITY_ADMIN
+        return PRIORITY_USER
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            # Служебные запросы (getUpdates, answerCallbackQuery и т.п.) не ограничиваем
+            return await make_request(bot, method)
+
+        priority = self._priority(chat_id)
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire(chat_id, priority)
+            try:
+                response = await make_request(bot, method)
+                self.limiter.sent(chat_id)
+                return response
+            except TelegramRetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                logging.warning(
+                    f"Telegram ограничил отправку в чат {chat_id}, повтор через {e.retry_after} с "
+                    f"(попытка {attempt + 1})"
+                )
+                self.limiter.retry_after(chat_id, e.retry_after)
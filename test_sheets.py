@@ -49,6 +49,7 @@ def test_google_sheets():
         for i, sheet_info in enumerate(info['sheets'], 1):
             status = "🟢 Активный" if sheet_info['is_active'] else "⚪ Неактивный"
             print(f"  {i}. {sheet_info['title']} {status} (ID: {sheet_info['id']}, {sheet_info['rows']}x{sheet_info['cols']})")
+        print(f"🔌 Обновлений токена: {info['client']['token_refreshes']}, открыто сессий: {info['client']['sessions_opened']}")
     else:
         print("⚠️ Не удалось получить полную информацию о таблице")
     
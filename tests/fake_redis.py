@@ -0,0 +1,89 @@
+"""
+Локальная замена сервера Redis для тестов: протокол RESP и несколько команд.
+"""
+
+import asyncio
+import time
+
+
+class FakeRedisServer:
+    """Сервер на 127.0.0.1 со случайным портом; данные - в словаре"""
+
+    def __init__(self):
+        self.data = {}          # {ключ: (значение, срок истечения или None)}
+        self.commands = []      # Все полученные команды
+        self.failures = {}      # {команда: сколько следующих таких команд получат ошибку}
+        self.drop_connections = 0  # Столько следующих пакетов команд оборвут соединение
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f"redis://{host}:{port}/0"
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    def get(self, key: str):
+        value, expires = self.data.get(key, (None, None))
+        if expires is not None and expires < time.time():
+            return None
+        return value
+
+    async def _read_command(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        count = int(line[1:-2])
+        command = []
+        for _ in range(count):
+            length = int((await reader.readline())[1:-2])
+            command.append((await reader.readexactly(length + 2))[:-2].decode("utf-8"))
+        return command
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                command = await self._read_command(reader)
+                if command is None:
+                    break
+                if self.drop_connections:
+                    self.drop_connections -= 1
+                    break
+                self.commands.append(command)
+                writer.write(self._execute(command))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _execute(self, command: list) -> bytes:
+        name, args = command[0].upper(), command[1:]
+        if self.failures.get(name):
+            self.failures[name] -= 1
+            return b"-ERR injected failure\r\n"
+        if name in ("AUTH", "SELECT", "PING"):
+            return b"+OK\r\n"
+        if name == "GET":
+            value = self.get(args[0])
+            if value is None:
+                return b"$-1\r\n"
+            data = value.encode("utf-8")
+            return f"${len(data)}\r\n".encode() + data + b"\r\n"
+        if name == "SET":
+            key, value, options = args[0], args[1], [option.upper() for option in args[2:]]
+            if "NX" in options and self.get(key) is not None:
+                return b"$-1\r\n"
+            expires = time.time() + int(args[2 + options.index("EX") + 1]) if "EX" in options else None
+            self.data[key] = (value, expires)
+            return b"+OK\r\n"
+        if name == "DEL":
+            removed = sum(1 for key in args if self.data.pop(key, None) is not None)
+            return f":{removed}\r\n".encode()
+        return f"-ERR unknown command '{name}'\r\n".encode()
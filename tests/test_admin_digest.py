@@ -0,0 +1,55 @@
+"""
+Проверка дайджеста заявок для канала админов.
+"""
+
+import asyncio
+
+from admin_digest import MESSAGE_LIMIT, MODE_ON, AdminDigest
+
+
+def lead(number: int, name: str = None, city: str = "Москва") -> dict:
+    return {
+        'city': city,
+        'name': name or f"Имя {number}",
+        'phone': f"+7916{number:07d}",
+        'username': f"user{number}",
+        'user_id': 1000 + number,
+        'time': "10:00"
+    }
+
+
+def test_long_name_does_not_break_markup():
+    digest = AdminDigest(None, mode=MODE_ON)
+    leads = [lead(1, name="Очень & длинное <имя> " * 500)] + [lead(number) for number in range(2, 200)]
+    parts = digest.format(leads)
+
+    assert len(parts) > 1
+    for text, _ in parts:
+        assert len(text) <= MESSAGE_LIMIT
+        # Ссылки и сущности HTML не разрезаны
+        assert text.count("<a href=") == text.count("</a>")
+        assert text.count("&") == text.count("&amp;") + text.count("&lt;") + text.count("&gt;")
+    assert sum(len(part_leads) for _, part_leads in parts) == len(leads)
+
+
+def test_failed_part_keeps_only_unsent_leads():
+    sent = []
+
+    async def send(text):
+        if len(sent) == 1:
+            raise RuntimeError("Bad Request")
+        sent.append(text)
+
+    async def main():
+        digest = AdminDigest(send, mode=MODE_ON)
+        leads = [lead(number) for number in range(200)]
+        parts = digest.format(leads)
+        digest._buffer = list(leads)
+        await digest.flush()
+        return digest, parts
+
+    digest, parts = asyncio.run(main())
+    assert len(sent) == 1
+    # Заявки первого (отправленного) сообщения повторно не публикуются
+    assert len(digest._buffer) == 200 - len(parts[0][1])
+    assert digest.leads_in_digests == len(parts[0][1])
@@ -0,0 +1,187 @@
+"""
+Проверка AsyncSheets на локальном фейковом HTTP-сервере Google Sheets API.
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from circuit_breaker import STATE_CLOSED, STATE_HALF_OPEN, CircuitBreaker
+from sheets import AsyncSheets, SheetsAPIError, is_outage_error
+
+
+class FakeClient:
+    """Клиент с готовым токеном: сервисный аккаунт для проверки не нужен"""
+
+    sheet_id = "sheet"
+
+    def __init__(self):
+        self.credentials = SimpleNamespace(token="test-token")
+        self.sessions_opened = 0
+
+    def token_is_fresh(self) -> bool:
+        return True
+
+
+def run_with_server(handler, check, timeout: float = 5, breaker: CircuitBreaker = None):
+    """Запуск фейкового API с обработчиком handler и проверка check(api)"""
+    async def main():
+        app = web.Application()
+        app.router.add_route("*", "/{tail:.*}", handler)
+        server = TestServer(app)
+        await server.start_server()
+        api = AsyncSheets(FakeClient(), base_url=str(server.make_url("/v4/spreadsheets")), timeout=timeout,
+                          breaker=breaker)
+        try:
+            await check(api)
+        finally:
+            await api.close()
+            await server.close()
+    asyncio.run(main())
+
+
+def test_get_values_success():
+    requests = []
+
+    async def handler(request):
+        requests.append(request)
+        return web.json_response({"values": [["Москва", "Иван"]]})
+
+    async def check(api):
+        assert await api.get_values("'Лист 1'!A2:F") == [["Москва", "Иван"]]
+
+    run_with_server(handler, check)
+    request = requests[0]
+    assert request.method == "GET"
+    assert request.path == "/v4/spreadsheets/sheet/values/'Лист 1'!A2:F"
+    assert request.headers["Authorization"] == "Bearer test-token"
+
+
+def test_append_rows_sends_json_body():
+    bodies = []
+
+    async def handler(request):
+        bodies.append((request.path, dict(request.query), await request.json()))
+        return web.json_response({"updates": {"updatedRange": "'Лист1'!A5:F6"}})
+
+    async def check(api):
+        result = await api.append_rows("A1", [["a"], ["b"]])
+        assert result["updates"]["updatedRange"].endswith("A5:F6")
+
+    run_with_server(handler, check)
+    path, query, body = bodies[0]
+    assert path.endswith("/values/A1:append")
+    assert query["valueInputOption"] == "RAW"
+    assert body == {"values": [["a"], ["b"]]}
+
+
+def test_rate_limit_with_retry_after():
+    async def handler(request):
+        return web.Response(status=429, text="Quota exceeded", headers={"Retry-After": "7"})
+
+    async def check(api):
+        with pytest.raises(SheetsAPIError) as info:
+            await api.get_values("A1")
+        assert info.value.status == 429
+        assert info.value.retry_after == 7.0
+        # Квота - не недоступность API
+        assert not is_outage_error(info.value)
+        assert api.errors_total == 1
+
+    run_with_server(handler, check)
+
+
+def test_rate_limit_with_http_date_retry_after():
+    async def handler(request):
+        return web.Response(status=429, text="Quota exceeded",
+                            headers={"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"})
+
+    async def check(api):
+        # Дата в прошлом - повтор можно сразу; ошибка остается SheetsAPIError
+        with pytest.raises(SheetsAPIError) as info:
+            await api.get_values("A1")
+        assert info.value.retry_after == 0.0
+
+    run_with_server(handler, check)
+
+
+def test_unparsable_retry_after_is_ignored():
+    async def handler(request):
+        return web.Response(status=503, text="Backend Error", headers={"Retry-After": "soon"})
+
+    async def check(api):
+        with pytest.raises(SheetsAPIError) as info:
+            await api.get_values("A1")
+        assert info.value.retry_after is None
+
+    run_with_server(handler, check)
+
+
+def test_server_error():
+    async def handler(request):
+        return web.Response(status=503, text="Backend Error")
+
+    async def check(api):
+        with pytest.raises(SheetsAPIError) as info:
+            await api.get_values("A1")
+        assert info.value.status == 503
+        assert info.value.retry_after is None
+        assert "Backend Error" in info.value.message
+        assert is_outage_error(info.value)
+
+    run_with_server(handler, check)
+
+
+def test_timeout():
+    async def handler(request):
+        await asyncio.sleep(2)
+        return web.json_response({})
+
+    async def check(api):
+        with pytest.raises(asyncio.TimeoutError) as info:
+            await api.get_values("A1")
+        assert is_outage_error(info.value)
+        assert api.errors_total == 1
+
+    run_with_server(handler, check, timeout=0.2)
+
+
+def test_cancelled_probe_does_not_close_breaker():
+    breaker = CircuitBreaker("sheets", failure_threshold=1, reset_timeout=60)
+    breaker.record_failure(TimeoutError())
+    breaker.opened_at -= 60
+
+    async def handler(request):
+        await asyncio.sleep(2)
+        return web.json_response({"values": []})
+
+    async def check(api):
+        probe = asyncio.create_task(api.get_values("A1"))
+        await asyncio.sleep(0.1)
+        assert breaker.state == STATE_HALF_OPEN
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        # Ответа не было - предохранитель не замкнут, но следующий запрос может быть пробным
+        assert breaker.state == STATE_HALF_OPEN
+        breaker.before_call()
+
+    run_with_server(handler, check, breaker=breaker)
+
+
+def test_successful_probe_closes_breaker():
+    breaker = CircuitBreaker("sheets", failure_threshold=1, reset_timeout=60)
+    breaker.record_failure(TimeoutError())
+    breaker.opened_at -= 60
+
+    async def handler(request):
+        return web.json_response({"values": []})
+
+    async def check(api):
+        await api.get_values("A1")
+        assert breaker.state == STATE_CLOSED
+
+    run_with_server(handler, check, breaker=breaker)
@@ -0,0 +1,29 @@
+"""
+Проверка выгрузки заявок.
+"""
+
+import csv
+
+from export import CSVWriter
+
+
+def test_csv_cells_are_not_formulas(tmp_path):
+    path = str(tmp_path / "export.csv")
+    writer = CSVWriter(path, ["Имя", "Телефон", "ID"])
+    writer.write_rows([
+        ["=HYPERLINK(\"http://x\")", "+79161234567", 100],
+        ["@SUM(A1)", "+7 (916) 123-45-67", 200],
+        ["\tИван", "\rПетр", None],
+        ["Иван", "89161234567", 300],
+        ["-2+3+cmd|' /C calc'!A0", "+1+1", 400],
+    ])
+    writer.close()
+
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        rows = list(csv.reader(f, delimiter=";"))
+    # Телефоны остаются как есть, формулы экранируются
+    assert rows[1] == ["'=HYPERLINK(\"http://x\")", "+79161234567", "100"]
+    assert rows[2] == ["'@SUM(A1)", "+7 (916) 123-45-67", "200"]
+    assert rows[3] == ["'\tИван", "'\rПетр", ""]
+    assert rows[4] == ["Иван", "89161234567", "300"]
+    assert rows[5] == ["'-2+3+cmd|' /C calc'!A0", "'+1+1", "400"]
@@ -0,0 +1,120 @@
+"""
+Проверка хранилищ FSM: SQLiteStorage и RedisStorage на локальной замене сервера Redis.
+"""
+
+import asyncio
+import json
+import time
+
+import pytest
+from aiogram.fsm.storage.base import StorageKey
+
+from fake_redis import FakeRedisServer
+from fsm_storage import RedisError, RedisStorage, SQLiteStorage
+
+KEY = StorageKey(bot_id=1, chat_id=42, user_id=42)
+
+
+def run_with_redis(check):
+    async def main():
+        server = await FakeRedisServer().start()
+        try:
+            await check(server)
+        finally:
+            await server.close()
+    asyncio.run(main())
+
+
+def test_state_and_data_are_shared_between_processes():
+    async def check(server):
+        storage = RedisStorage(server.url, ttl=600)
+        await storage.set_state(KEY, "RegistrationForm:waiting_for_name")
+        await storage.set_data(KEY, {'city': "Москва"})
+
+        # Другой процесс читает то же состояние из Redis
+        other = RedisStorage(server.url, ttl=600)
+        assert await other.get_state(KEY) == "RegistrationForm:waiting_for_name"
+        assert await other.get_data(KEY) == {'city': "Москва"}
+        assert json.loads(server.get("f:42:42")) == {"s": "RegistrationForm:waiting_for_name", "d": {"city": "Москва"}}
+        assert ["SET", "f:42:42", server.get("f:42:42"), "EX", "600"] in server.commands
+
+        # После state.clear() запись удаляется
+        await storage.set_state(KEY, None)
+        await storage.set_data(KEY, {})
+        assert server.get("f:42:42") is None
+        await storage.close()
+        await other.close()
+
+    run_with_redis(check)
+
+
+def test_concurrent_updates_go_in_one_pipeline():
+    async def check(server):
+        storage = RedisStorage(server.url, flush_interval=0.05)
+        keys = [StorageKey(bot_id=1, chat_id=user, user_id=user) for user in range(1, 21)]
+        await asyncio.gather(*(storage.set_state(key, "S") for key in keys))
+        assert storage.flushes == 1
+        assert storage.keys_flushed == 20
+        await storage.close()
+
+    run_with_redis(check)
+
+
+def test_failed_flush_is_retried_without_new_writes():
+    async def check(server):
+        storage = RedisStorage(server.url, flush_interval=0.01)
+        storage.max_retry_delay = 0.05
+        server.failures["SET"] = 1
+        # Ошибка записи доходит до обработчика
+        with pytest.raises(RedisError):
+            await storage.set_state(KEY, "S")
+        # Изменение не потеряно: повторная запись идет сама, без новых изменений
+        for _ in range(100):
+            if server.get("f:42:42") is not None:
+                break
+            await asyncio.sleep(0.01)
+        assert json.loads(server.get("f:42:42"))["s"] == "S"
+        assert await storage.get_state(KEY) == "S"
+        await storage.close()
+
+    run_with_redis(check)
+
+
+def test_reconnects_after_dropped_connection():
+    async def check(server):
+        storage = RedisStorage(server.url)
+        await storage.set_state(KEY, "A")
+        server.drop_connections = 1
+        await storage.set_state(KEY, "B")
+        assert json.loads(server.get("f:42:42"))["s"] == "B"
+        await storage.close()
+
+    run_with_redis(check)
+
+
+def test_sqlite_close_waits_for_running_flush(tmp_path):
+    path = str(tmp_path / "fsm.sqlite3")
+
+    async def main():
+        storage = SQLiteStorage(path, flush_interval=0.01)
+        write = storage._write
+
+        def slow_write(upserts, deletes):
+            time.sleep(0.2)
+            write(upserts, deletes)
+
+        storage._write = slow_write
+        await storage.set_state(KEY, "S")
+        await storage.set_data(KEY, {'name': "Иван"})
+        await asyncio.sleep(0.05)
+        # Запись идет в потоке: закрытие не должно закрыть базу у нее из-под ног
+        await storage.close()
+
+        reopened = SQLiteStorage(path)
+        try:
+            assert await reopened.get_state(KEY) == "S"
+            assert await reopened.get_data(KEY) == {'name': "Иван"}
+        finally:
+            await reopened.close()
+
+    asyncio.run(main())
@@ -0,0 +1,35 @@
+"""
+Проверка общего для процессов кэша file_id изображений.
+"""
+
+from photo_cache import PhotoCache
+
+
+def test_processes_do_not_lose_each_others_file_ids(tmp_path):
+    path = str(tmp_path / "photo_cache.json")
+    first, second = PhotoCache(path), PhotoCache(path)
+    first.load()
+    second.load()
+
+    first.remember("a", "file-a")
+    second.remember("b", "file-b")
+
+    cache = PhotoCache(path)
+    cache.load()
+    assert cache.get("a") == "file-a"
+    assert cache.get("b") == "file-b"
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_forget_keeps_file_id_uploaded_by_another_process(tmp_path):
+    path = str(tmp_path / "photo_cache.json")
+    first, second = PhotoCache(path), PhotoCache(path)
+    first.remember("a", "old")
+    second.load()
+    first.remember("a", "new")
+
+    # Второй процесс узнал, что старый file_id недействителен, - новый не удаляется
+    second.forget("a")
+    cache = PhotoCache(path)
+    cache.load()
+    assert cache.get("a") == "new"
@@ -0,0 +1,26 @@
+"""
+Проверка индекса повторных регистраций.
+"""
+
+from registrations import RegistrationIndex
+
+
+def test_repeat_is_matched_by_normalized_phone():
+    index = RegistrationIndex()
+    index.load([(1, "+7 (916) 123-45-67", 100)])
+
+    assert index.find("89161234567", 100) == (1, "phone")
+    # Тот же номер от другого пользователя Telegram - тоже повтор
+    assert index.find("+79161234567", 200) == (1, "phone")
+    assert index.stats()['duplicates'] == 2
+
+
+def test_known_user_with_new_phone_is_a_new_registration():
+    index = RegistrationIndex()
+    index.load([(1, "+79161234567", 100)])
+
+    assert index.find("+79169999999", 100) is None
+    assert index.find("+79168888888", 300) is None
+    stats = index.stats()
+    assert stats['duplicates'] == 0
+    assert stats['new_phone_users'] == 1
@@ -0,0 +1,38 @@
+"""
+Проверка сохранения множества поприветствованных пользователей.
+"""
+
+import os
+
+import pytest
+
+from seen_users import SeenUsers
+
+
+def test_failed_write_keeps_set_dirty(tmp_path):
+    seen = SeenUsers(str(tmp_path / "missing" / "welcomed.bin"))
+    seen.add(1)
+    version = seen.version
+    with pytest.raises(OSError):
+        seen.write_snapshot(seen.snapshot(), version)
+    assert seen.dirty
+
+    seen.path = str(tmp_path / "welcomed.bin")
+    seen.write_snapshot(seen.snapshot(), version)
+    assert not seen.dirty
+    assert os.path.exists(seen.path)
+
+
+def test_changes_after_snapshot_stay_dirty(tmp_path):
+    seen = SeenUsers(str(tmp_path / "welcomed.bin"))
+    seen.add(1)
+    version = seen.version
+    data = seen.snapshot()
+    seen.add(2)
+    seen.write_snapshot(data, version)
+    assert seen.dirty
+
+    loaded = SeenUsers(seen.path)
+    loaded.load()
+    assert 1 in loaded and 2 not in loaded
+    assert not loaded.dirty
@@ -0,0 +1,171 @@
+"""
+Проверка очереди записи SheetsWriter: ошибки запроса и таймауты.
+"""
+
+import asyncio
+
+from ratelimit import TokenBucket
+from sheets import SheetsAPIError, SheetsWriter
+
+
+def make_writer(write_rows, **kwargs) -> SheetsWriter:
+    return SheetsWriter(write_rows, TokenBucket(rate=1000, capacity=1000), batch_size=10, max_delay=0.01, **kwargs)
+
+
+async def drain(writer: SheetsWriter):
+    writer.start()
+    await asyncio.wait_for(writer.queue.join(), 5)
+    await writer.stop()
+
+
+def test_bad_request_goes_to_dead_letters():
+    written = []
+
+    async def write_rows(rows):
+        if rows[0] == ["bad"]:
+            raise SheetsAPIError(400, "Invalid values")
+        written.extend(rows)
+        return {}
+
+    async def main():
+        writer = make_writer(write_rows)
+        writer.submit(["bad"])
+        await asyncio.sleep(0.05)
+        writer.submit(["good"])
+        await drain(writer)
+        return writer
+
+    writer = asyncio.run(main())
+    # Отклоненная пачка не повторяется и не задерживает следующие строки
+    assert written == [["good"]]
+    assert writer.dead_rows_total == 1
+    assert writer.dead_letters[0]['rows'] == [["bad"]]
+
+
+def test_rejected_batch_is_split_to_isolate_bad_row():
+    written = []
+    rejected = []
+
+    async def write_rows(rows):
+        if ["bad"] in rows:
+            raise SheetsAPIError(400, "Invalid values")
+        written.extend(rows)
+        return {}
+
+    async def main():
+        writer = make_writer(write_rows)
+        for row in (["a"], ["b"], ["bad"], ["c"], ["d"]):
+            writer.submit(row, on_rejected=lambda error, row=row: rejected.append((row, error.status)))
+        await drain(writer)
+        return writer
+
+    writer = asyncio.run(main())
+    assert written == [["a"], ["b"], ["c"], ["d"]]
+    assert rejected == [(["bad"], 400)]
+    assert writer.dead_rows_total == 1
+
+
+def test_server_error_is_retried():
+    attempts = []
+
+    async def write_rows(rows):
+        attempts.append(rows)
+        if len(attempts) == 1:
+            raise SheetsAPIError(503, "Backend Error")
+        return {}
+
+    async def main():
+        writer = make_writer(write_rows, max_backoff=0.01)
+        writer.submit(["row"])
+        await drain(writer)
+        return writer
+
+    writer = asyncio.run(main())
+    assert len(attempts) == 2
+    assert writer.rows_written == 1
+    assert not writer.dead_letters
+
+
+def test_timeout_applied_by_server_is_not_resent():
+    sheet = []
+
+    async def write_rows(rows):
+        # Запрос выполнен, но ответ не дошел
+        sheet.extend(rows)
+        raise asyncio.TimeoutError()
+
+    async def find_written(rows):
+        return {'updates': {'updatedRange': "A2:F2"}} if all(row in sheet for row in rows) else None
+
+    results = []
+
+    async def main():
+        writer = make_writer(write_rows, find_written=find_written, max_backoff=0.01)
+        writer.submit(["row"], on_written=results.append)
+        await drain(writer)
+        return writer
+
+    writer = asyncio.run(main())
+    assert sheet == [["row"]]
+    assert writer.recovered_after_timeout == 1
+    assert results == [{'updates': {'updatedRange': "A2:F2"}}]
+
+
+def test_timeout_not_applied_is_resent():
+    sheet = []
+    attempts = []
+
+    async def write_rows(rows):
+        attempts.append(rows)
+        if len(attempts) == 1:
+            raise asyncio.TimeoutError()
+        sheet.extend(rows)
+        return {}
+
+    async def find_written(rows):
+        return None
+
+    async def main():
+        writer = make_writer(write_rows, find_written=find_written, max_backoff=0.01)
+        writer.submit(["row"])
+        await drain(writer)
+
+    asyncio.run(main())
+    assert sheet == [["row"]]
+    assert len(attempts) == 2
+
+
+def test_max_backoff_below_one_second_is_respected():
+    attempts = []
+
+    async def write_rows(rows):
+        attempts.append(asyncio.get_running_loop().time())
+        if len(attempts) == 1:
+            raise SheetsAPIError(503, "Backend Error")
+        return {}
+
+    async def main():
+        writer = make_writer(write_rows, max_backoff=0.05)
+        writer.submit(["row"])
+        await drain(writer)
+
+    asyncio.run(main())
+    assert attempts[1] - attempts[0] < 0.5
+
+
+def test_stop_reports_rows_left_in_queue(caplog):
+    async def write_rows(rows):
+        await asyncio.sleep(10)
+
+    async def main():
+        writer = make_writer(write_rows)
+        writer.start()
+        writer.submit(["row"])
+        writer.submit(["other"])
+        await asyncio.sleep(0.05)
+        await writer.stop(timeout=0.05)
+        return writer
+
+    writer = asyncio.run(main())
+    assert writer._task.done()
+    assert "не записано строк: 2" in caplog.text
@@ -0,0 +1,50 @@
+"""
+Проверка статистики /stats: счетчики по дням, городам, часам и пользователям.
+"""
+
+from datetime import datetime, timedelta
+
+from test_submissions import record, run_with_store
+
+
+def moment(days_ago: int, hour: int) -> str:
+    day = datetime.now() - timedelta(days=days_ago)
+    return day.replace(hour=hour, minute=15).strftime("%d.%m.%Y %H:%M")
+
+
+def test_summary_counts_days_cities_hours_and_users(tmp_path):
+    async def check(store):
+        await store.add(record(1, city="Тула", user_id=1, date=moment(0, 10)))
+        await store.add(record(2, city="Тула", user_id=1, date=moment(0, 10)))
+        await store.add(record(3, city="Москва", user_id=2, date=moment(1, 18)))
+        await store.add(record(4, city="Тула", user_id=3, date=moment(8, 10)))
+
+        summary = await store.summary(days=7, cities=1, hours=2)
+        # "Сегодня" и последние дни - по столбцу даты заявки
+        assert summary['total'] == 4
+        assert summary['today'] == 2
+        assert summary['users'] == 3
+        assert [count for _, count in summary['last_days'][:2]] == [2, 1]
+        assert sum(count for _, count in summary['last_days']) == 3
+        assert summary['top_cities'] == [("Тула", 3)]
+        assert summary['peak_hours'] == [(10, 3), (18, 1)]
+
+    run_with_store(tmp_path / "s.sqlite3", check)
+
+
+def test_rows_added_to_sheet_outside_bot_reach_stats(tmp_path):
+    async def check(store):
+        added = await store.add(record(1, city="Тула"))
+        store.mark_replicated(added['id'], 2)
+        await store.add(record(2, city="Тула"))
+
+        # В таблице строка бота и строка, дописанная вручную
+        sheet = [record(1, city="Тула"), record(50, city="Казань", user_id=None)]
+        assert await store.merge_sheet_records(sheet, last_sheet_row=3) == 1
+
+        summary = await store.summary(days=1)
+        assert summary['total'] == 3
+        assert dict(summary['top_cities']) == {"Тула": 2, "Казань": 1}
+        assert await store.replicated_count() == 2
+
+    run_with_store(tmp_path / "s.sqlite3", check)
@@ -0,0 +1,208 @@
+"""
+Проверка хранилища заявок SQLiteSubmissionStore.
+"""
+
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+from submissions import SQLiteSubmissionStore
+
+
+def record(number: int, **fields) -> dict:
+    return {
+        'city': "Москва",
+        'name': f"Имя {number}",
+        'phone': f"+7916{number:07d}",
+        'username': None,
+        'user_id': 1000 + number,
+        'date': "01.05.2025 10:00",
+        **fields
+    }
+
+
+def run_with_store(path, check, commit_delay: float = 0.001):
+    async def main():
+        store = SQLiteSubmissionStore(str(path), commit_delay=commit_delay)
+        await store.open()
+        try:
+            return await check(store)
+        finally:
+            await store.close()
+    return asyncio.run(main())
+
+
+def test_add_with_same_key_returns_same_submission(tmp_path):
+    async def check(store):
+        first = await store.add(record(1, key="k1"))
+        again = await store.add(record(1, key="k1"))
+        other = await store.add(record(2, key="k2"))
+        assert again['id'] == first['id']
+        assert other['id'] != first['id']
+        return await store.last_id()
+
+    assert run_with_store(tmp_path / "s.sqlite3", check) == 2
+
+
+def test_add_interrupted_by_timeout_is_not_duplicated(tmp_path):
+    async def check(store):
+        # Первая попытка прервана до ответа, но заявка уже ушла в очередь записи
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(store.add(record(1, key="k1")), 0.05)
+        retry = await store.add(record(1, key="k1"))
+        rows = await store.query("SELECT id FROM submissions")
+        assert rows == [(retry['id'],)]
+
+    run_with_store(tmp_path / "s.sqlite3", check, commit_delay=0.2)
+
+
+def test_database_of_previous_version_is_migrated(tmp_path):
+    path = tmp_path / "old.sqlite3"
+    db = sqlite3.connect(path)
+    db.executescript(
+        "CREATE TABLE submissions (id INTEGER PRIMARY KEY, city TEXT NOT NULL, name TEXT NOT NULL, "
+        "phone TEXT NOT NULL, username TEXT, user_id INTEGER, date TEXT NOT NULL, day TEXT, hour INTEGER, "
+        "origin INTEGER NOT NULL DEFAULT 0, replicated INTEGER NOT NULL DEFAULT 0);"
+        "INSERT INTO submissions (city, name, phone, user_id, date, day, hour, replicated) "
+        "VALUES ('Тула', 'Иван', '+79160000001', 5, '30.04.2025 09:00', '2025-04-30', 9, 1);"
+    )
+    db.commit()
+    db.close()
+
+    async def check(store):
+        added = await store.add(record(1, key="k1"))
+        summary = await store.summary(days=1, cities=5, hours=5)
+        # Счетчики посчитаны по заявке, сохраненной до их появления
+        assert summary['total'] == 2
+        assert summary['users'] == 2
+        assert summary['unreplicated'] == 1
+        assert dict(summary['top_cities']) == {"Тула": 1, "Москва": 1}
+        return added['id']
+
+    assert run_with_store(path, check) == 2
+
+
+def full_scan_counts(store) -> dict:
+    """Те же показатели, что у summary, запросами по всем заявкам"""
+    db = store._read_db
+    return {
+        'total': db.execute("SELECT COUNT(*) FROM submissions").fetchone()[0],
+        'users': db.execute("SELECT COUNT(DISTINCT user_id) FROM submissions WHERE user_id IS NOT NULL").fetchone()[0],
+        'unreplicated': db.execute("SELECT COUNT(*) FROM submissions WHERE replicated = 0").fetchone()[0],
+        'cities': dict(db.execute("SELECT city, COUNT(*) FROM submissions GROUP BY city").fetchall()),
+        'hours': dict(db.execute(
+            "SELECT hour, COUNT(*) FROM submissions WHERE hour IS NOT NULL GROUP BY hour"
+        ).fetchall()),
+    }
+
+
+def test_counts_follow_inserts_and_replication(tmp_path):
+    async def check(store):
+        added = []
+        for number in range(20):
+            added.append(await store.add(record(
+                number, city=("Москва", "Тула", "Казань")[number % 3], user_id=1000 + number % 7,
+                date=f"01.05.2025 {number % 5 + 9:02d}:00"
+            )))
+        for item in added[:8]:
+            store.mark_replicated(item['id'], item['id'] + 1)
+        await store.add(record(99, key="last"))
+        await store.import_records("sheet", [record(50, date="бланк")], replicated=True, last_sheet_row=30)
+
+        summary = await store.summary(days=1, cities=10, hours=24)
+        expected = full_scan_counts(store)
+        assert summary['total'] == expected['total'] == 22
+        assert summary['users'] == expected['users']
+        assert summary['unreplicated'] == expected['unreplicated'] == 13
+        assert dict(summary['top_cities']) == expected['cities']
+        assert dict(summary['peak_hours']) == expected['hours']
+        assert await store.replicated_count() == 9
+
+        await store.rebuild_counts()
+        assert await store.summary(days=1, cities=10, hours=24) == {
+            **summary, 'query_ms': store.stats()['last_query_ms']
+        }
+
+    run_with_store(tmp_path / "s.sqlite3", check)
+
+
+def test_import_keeps_real_last_row_and_runs_beside_writes(tmp_path):
+    async def check(store):
+        writes = [asyncio.create_task(store.add(record(number))) for number in range(50)]
+        # В таблице есть пустые строки: последняя строка - 12, хотя заявок 3
+        imported = await store.import_records(
+            "sheet", [record(100 + number) for number in range(3)], replicated=True, last_sheet_row=12
+        )
+        await asyncio.gather(*writes)
+        assert imported == 3
+        assert store.last_sheet_row == 12
+
+        # Повторная однократная загрузка пропускается, добавленные вне бота строки догружаются
+        assert await store.import_records("sheet", [record(200)], replicated=True, last_sheet_row=13) == 0
+        assert await store.merge_sheet_records([record(100), record(201)], last_sheet_row=14) == 1
+        assert store.last_sheet_row == 14
+        return await store.last_id()
+
+    assert run_with_store(tmp_path / "s.sqlite3", check) == 54
+
+
+def test_rejected_submissions_are_not_replayed(tmp_path):
+    async def check(store):
+        first = await store.add(record(1))
+        second = await store.add(record(2))
+        store.mark_rejected(first['id'])
+        await store.add(record(3))
+        assert [item['id'] for item in await store.unreplicated()] == [second['id'], 3]
+
+        summary = await store.summary(days=1)
+        assert summary['unreplicated'] == 2
+        assert summary['rejected'] == 1
+        assert await store.replicated_count() == 0
+        await store.rebuild_counts()
+        assert (await store.summary(days=1))['rejected'] == 1
+
+    run_with_store(tmp_path / "s.sqlite3", check)
+
+
+def test_invalid_record_fails_alone_in_group_commit(tmp_path):
+    async def check(store):
+        results = await asyncio.gather(
+            store.add(record(1, key="k1")),
+            store.add(record(2, name=None)),
+            store.add(record(3)),
+            return_exceptions=True
+        )
+        assert isinstance(results[1], sqlite3.IntegrityError)
+        saved = await store.query("SELECT name FROM submissions ORDER BY id")
+        assert saved == [("Имя 1",), ("Имя 3",)]
+        assert results[2]['id'] == 2
+        assert store.stats()['records_written'] == 2
+
+    run_with_store(tmp_path / "s.sqlite3", check, commit_delay=0.05)
+
+
+def test_close_waits_for_running_commit(tmp_path):
+    path = tmp_path / "s.sqlite3"
+
+    async def main():
+        store = SQLiteSubmissionStore(str(path), commit_delay=0.001)
+        await store.open()
+        write = store._write
+
+        def slow_write(*args):
+            time.sleep(0.2)
+            return write(*args)
+
+        store._write = slow_write
+        adding = asyncio.ensure_future(store.add(record(1)))
+        await asyncio.sleep(0.05)
+        # Транзакция идет в потоке: закрытие дожидается ее, а не закрывает базу под ней
+        await store.close()
+        assert (await adding)['id'] == 1
+
+    asyncio.run(main())
+    db = sqlite3.connect(path)
+    assert db.execute("SELECT COUNT(*) FROM submissions").fetchone()[0] == 1
+    db.close()
@@ -0,0 +1,50 @@
+"""
+Проверка ограничения исходящих запросов к Telegram: очередь вместо потерь.
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from telegram_sender import OutboundLimiter, RateLimitMiddleware
+
+ADMIN_CHAT = -100123
+
+
+def test_admin_posts_beyond_burst_wait_in_queue():
+    sent = []
+
+    async def make_request(bot, method):
+        sent.append(method.text)
+        return True
+
+    async def main():
+        limiter = OutboundLimiter(group_rate=20, group_burst=3)
+        middleware = RateLimitMiddleware(limiter, admin_chats=[ADMIN_CHAT])
+        posts = [SimpleNamespace(chat_id=ADMIN_CHAT, text=f"lead {number}") for number in range(8)]
+        await asyncio.gather(*(middleware(make_request, None, post) for post in posts))
+        return limiter
+
+    limiter = asyncio.run(main())
+    # Сверх запаса в 3 сообщения посты ждут своей очереди, а не теряются
+    assert sorted(sent) == [f"lead {number}" for number in range(8)]
+    assert limiter.max_wait > 0
+
+
+def test_retry_after_is_repeated_by_middleware():
+    attempts = []
+
+    async def make_request(bot, method):
+        attempts.append(method.text)
+        if len(attempts) == 1:
+            raise TelegramRetryAfter(method=method, message="Flood control", retry_after=0)
+        return True
+
+    async def main():
+        limiter = OutboundLimiter(group_rate=100, group_burst=3)
+        middleware = RateLimitMiddleware(limiter, admin_chats=[ADMIN_CHAT])
+        return await middleware(make_request, None, SimpleNamespace(chat_id=ADMIN_CHAT, text="lead"))
+
+    assert asyncio.run(main()) is True
+    assert attempts == ["lead", "lead"]
@@ -0,0 +1,156 @@
+"""
+Режим webhook: встроенный HTTP-сервер для приема обновлений от Telegram.
+
+Telegram присылает обновления POST-запросами. Запрос проверяется по
+секретному токену (заголовок X-Telegram-Bot-Api-Secret-Token), обновление
+кладется в очередь, и сервер сразу отвечает 200. Обработкой занимаются
+workers фоновых задач. Все обновления одного пользователя попадают
+к одному и тому же worker'у, поэтому порядок шагов анкеты сохраняется.
+Эндпоинт /healthz нужен для балансировщика и мониторинга.
+
+Тот же сервер принимает пачки обновлений от супервизора, когда бот
+запущен в нескольких процессах.
+"""
+
+import asyncio
+import hmac
+import logging
+import time
+
+from aiohttp import web
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def update_user_id(update: dict):
+    """ID пользователя, от которого пришло обновление (для маршрутизации)"""
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user")
+        if isinstance(user, dict) and "id" in user:
+            return user["id"]
+        chat = value.get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return chat["id"]
+    return None
+
+
+def shard(update: dict, count: int) -> int:
+    """Номер обработчика для обновления: один пользователь - всегда один обработчик"""
+    user_id = update_user_id(update)
+    key = user_id if user_id is not None else update.get("update_id", 0)
+    # Остаток от деления, а не hash(): номер не зависит от процесса и PYTHONHASHSEED
+    return int(key) % count
+
+
+def check_secret(request: web.Request, secret: str) -> bool:
+    """Проверка секретного токена из заголовка запроса"""
+    return not secret or hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret)
+
+
+class WebhookServer:
+    """HTTP-сервер webhook с очередями обработки по пользователям"""
+
+    def __init__(self, dp, bot, path: str, secret: str = "", workers: int = 32,
+                 queue_size: int = 1000):
+        self.dp = dp
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.workers = workers
+        self._queues = [asyncio.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._tasks = []
+        self._runner = None
+        self.started_at = time.monotonic()
+
+        self.received = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get("/healthz", self.handle_health)
+        return app
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        """Прием обновления от Telegram"""
+        if not check_secret(request, self.secret):
+            self.rejected += 1
+            return web.Response(status=401)
+
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        if isinstance(update, list):
+            # Пачка обновлений от супервизора (см. supervisor.py): ждем места в очередях,
+            # супервизор не отправит следующую пачку, пока не получит ответ
+            for item in update:
+                await self._queues[shard(item, self.workers)].put(item)
+            self.received += len(update)
+            return web.Response()
+
+        # Обновления одного пользователя всегда обрабатывает один worker
+        queue = self._queues[shard(update, self.workers)]
+        if queue.full():
+            # Telegram повторит доставку позже
+            self.rejected += 1
+            return web.Response(status=503)
+
+        self.received += 1
+        queue.put_nowait(update)
+        return web.Response()
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        """Проверка работоспособности"""
+        return web.json_response({
+            'status': 'ok',
+            'mode': 'webhook',
+            'uptime': round(time.monotonic() - self.started_at),
+            **self.stats()
+        })
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            update = await queue.get()
+            try:
+                await self.dp.feed_raw_update(self.bot, update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logging.error(f"Ошибка обработки обновления {update.get('update_id')}: {e}")
+            finally:
+                queue.task_done()
+
+    async def start(self, host: str, port: int):
+        """Запуск HTTP-сервера и workers"""
+        self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+        self._runner = web.AppRunner(self.create_app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logging.info(f"Webhook-сервер запущен на {host}:{port}{self.path}, workers: {self.workers}")
+
+    async def stop(self, timeout: float = 10):
+        """Остановка: прием прекращается, очереди дорабатываются"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Не все обновления обработаны при остановке webhook-сервера")
+        for task in self._tasks:
+            task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            'queued': sum(queue.qsize() for queue in self._queues),
+            'received': self.received,
+            'rejected': self.rejected,
+            'processed': self.processed,
+            'failed': self.failed,
+            'workers': self.workers
+        }